@@ -16,14 +16,19 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import logging
 
 from utils.misc import (
     light_gpt4_wrapper_autogen,
 )
 
-from utils.rag_tools import get_informed_answer
+from utils.domain_catalog import get_domain_catalog
+from utils.domain_matcher import DomainMatcher
+from utils.rag_tools import get_index_service_context, get_informed_answer
 from utils.search_tools import find_relevant_github_repo
 
+logger = logging.getLogger(__name__)
+
 google_search_api_key = os.environ["GOOGLE_SEARCH_API_KEY"]
 google_custom_search_id = os.environ["GOOGLE_CUSTOM_SEARCH_ENGINE_ID"]
 github_personal_access_token = os.environ["GITHUB_PERSONAL_ACCESS_TOKEN"]
@@ -55,6 +60,13 @@ COMM_DIR = "url_search_results"
 
 SEARCH_RESULTS_FILE = f"{COMM_DIR}\search_results.json"
 
+# Minimum LLM judge rating (1 to 10) of a matching domain, and the number of most
+# similar domains the judge rates when the embedding ranking is ambiguous
+DOMAIN_RESPONSE_THRESHOLD = 5
+DOMAIN_MATCH_LLM_CANDIDATES = 5
+
+domain_matcher = None
+
 agent_functions = [
     {
         "name": "read_file",
@@ -245,22 +257,30 @@ def execute_code_block(lang, code_block):
     exitcode2str = "execution succeeded" if exitcode == 0 else "execution failed"
     return f"exitcode: {exitcode} ({exitcode2str})\nCode output: {logs}"
 
-def consult_archive_agent(domain_description, question):
-    # Traverse the first level of DOMAIN_KNOWLEDGE_DOCS_DIR and find the best match for the domain_description
-    domain_descriptions = []
-    for root, dirs, files in os.walk(DOMAIN_KNOWLEDGE_DOCS_DIR):
-        print("FOUND DIRS:", dirs, root, files)
-        for dir in dirs:
-            # Get the files in the directory
-            domain_name = dir
-            for file in os.listdir(os.path.join(root, dir)):
-                if file == "domain_description.txt":
-                    with open(os.path.join(root, dir, file), "r") as f:
-                        domain_descriptions.append(
-                            {"domain_name": domain_name, "domain_description": f.read()}
-                        )
-        break
+def get_domain_matcher():
+    """
+    Returns the shared domain matcher, creating it on first use.
+
+    Returns:
+        DomainMatcher: The matcher, embedding through the shared embedding cache.
+    """
+    global domain_matcher
+    if domain_matcher is None:
+        domain_matcher = DomainMatcher(get_index_service_context().embed_model)
+    return domain_matcher
+
+
+def llm_match_domain(domain_description, domain_descriptions):
+    """
+    Asks the LLM judge which domain matches a domain description.
 
+    Args:
+        domain_description (str): The requested domain description.
+        domain_descriptions (List[dict]): The "domain_name" and "domain_description" of each candidate domain.
+
+    Returns:
+        Optional[dict]: The "domain" and "domain_description" of the matching domain, or None if no domain is rated high enough.
+    """
     # Convert the list of domain descriptions to a string
     str_desc = ""
     for desc in domain_descriptions:
@@ -281,11 +301,65 @@ def consult_archive_agent(domain_description, question):
 
     top_domain = domain_response[0]
 
-    DOMAIN_RESPONSE_THRESHOLD = 5
+    # If the top result has a rating below the threshold, no domain matches
+    if int(top_domain["rating"]) < DOMAIN_RESPONSE_THRESHOLD:
+        return None
+    return top_domain
+
+
+def match_domain(domain_description, domain_descriptions):
+    """
+    Finds the domain matching a domain description.
 
-    # If the top result has a rating below the threshold, research the domain knowledge online
+    Domains are ranked by embedding similarity first. The LLM judge is consulted, with
+    the top ranked candidates, unless the top domain is a clear match, so low
+    similarity alone never sends a question to online research.
 
-    if top_domain["rating"] < DOMAIN_RESPONSE_THRESHOLD:
+    Args:
+        domain_description (str): The requested domain description.
+        domain_descriptions (List[dict]): The "domain_name" and "domain_description" of each available domain.
+
+    Returns:
+        Optional[dict]: The "domain" and "domain_description" of the matching domain, or None if no domain matches.
+    """
+    decided, match, ranking = get_domain_matcher().match(
+        domain_description, domain_descriptions
+    )
+    top_similarities = [
+        (domain["domain_name"], round(similarity, 3))
+        for domain, similarity in ranking[:DOMAIN_MATCH_LLM_CANDIDATES]
+    ]
+    logger.debug(f"Top domain similarities: {top_similarities}")
+    if decided:
+        if match is None:
+            return None
+        return {
+            "domain": match["domain_name"],
+            "domain_description": match["domain_description"],
+        }
+
+    candidates = [domain for domain, _ in ranking[:DOMAIN_MATCH_LLM_CANDIDATES]]
+    return llm_match_domain(domain_description, candidates)
+
+
+def consult_archive_agent(domain_description, question, on_token=None):
+    """
+    Answers a question from the domain knowledge that best matches a domain description.
+
+    Args:
+        domain_description (str): The description of the domain the question is about.
+        question (str): The question to answer.
+        on_token (Optional[Callable[[str], None]]): Called with every answer token as it is synthesized, so callers can show progress. None waits for the complete answer.
+
+    Returns:
+        Response: The answer, with its source nodes and trace.
+    """
+    domain_descriptions = get_domain_catalog(DOMAIN_KNOWLEDGE_DOCS_DIR).get_domains()
+
+    top_domain = match_domain(domain_description, domain_descriptions)
+
+    # If no domain matches, research the domain knowledge online
+    if top_domain is None:
         print(f"Domain not found for domain description: {domain_description}")
         print("Searching for domain knowledge online...")
         domain, domain_description = find_relevant_github_repo(domain_description)
@@ -293,7 +367,7 @@ def consult_archive_agent(domain_description, question):
         domain = top_domain["domain"]
         domain_description = top_domain["domain_description"]
 
-    return get_informed_answer(
+    response = get_informed_answer(
         domain=domain,
         domain_description=domain_description,
         question=question,
@@ -303,5 +377,14 @@ def consult_archive_agent(domain_description, question):
         reranker_top_n=20,
         rerank=True,
         fusion=True,
+        stream=on_token is not None,
     )
-
+    if on_token is None:
+        return response
+
+    answer_tokens = []
+    for token in response.response_gen:
+        on_token(token)
+        answer_tokens.append(token)
+    response.response_txt = "".join(answer_tokens)
+    return response.get_response()
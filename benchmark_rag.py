@@ -0,0 +1,714 @@
+"""
+This script benchmarks the rag tools offline. It builds, loads and queries an index of a docs domain (by default "llama_index") with deterministic local stand-ins for the OpenAI LLMs and embedding model, so no API access is needed, and reports per-stage latency percentiles, peak memory and throughput.
+
+The stand-ins sleep for a configurable latency per request, so the results can show the pipeline overhead alone (no latency) or approximate a production run.
+
+Example:
+    python benchmark_rag.py --rounds 3 --llm-latency 0.5 --embed-latency 0.1 --output benchmark.json
+    python benchmark_rag.py --baseline benchmark.json
+    python benchmark_rag.py --embedding-quantization int8 --min-recall 0.95
+
+NOTE: Token counting uses tiktoken, whose encodings must already be cached for a fully offline run.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import asyncio
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Any, List
+
+import numpy as np
+from llama_index import ServiceContext, set_global_service_context
+from llama_index.bridge.pydantic import Field
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms import CompletionResponse, CustomLLM, LLMMetadata
+from llama_index.llms.base import llm_completion_callback
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DOCS_DIR = "./docs"
+DOMAIN = "llama_index"
+DOMAIN_DESCRIPTION = "indexing and retrieval of documents for llms"
+
+BENCHMARK_QUESTIONS = [
+    "How can I index various types of documents?",
+    "How do I persist an index to disk and load it again?",
+    "What is the difference between a retriever and a query engine?",
+    "How do I use a custom embedding model?",
+    "How can I add metadata filters to a vector store query?",
+    "What node parsers are available for splitting documents?",
+    "How do I stream the response of a query engine?",
+    "How can I rerank retrieved nodes with an LLM?",
+    "How do I build a chat engine over my documents?",
+    "What is a response synthesizer and which modes does it support?",
+    "How can I combine keyword and vector retrieval?",
+    "How do I count the tokens used by my queries?",
+]
+
+# Suffixes of the fake RAG fusion query variations
+FUSION_VARIATION_SUFFIXES = ["example", "tutorial", "api reference", "step by step"]
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# Rates this fraction of documents as relevant, like a selective reranker would
+RELEVANT_DOCUMENT_RATE = 0.6
+
+
+class FakeEmbedding(BaseEmbedding):
+    """
+    A deterministic embedding model: hashed bag of words vectors, normalized to unit length.
+    """
+
+    dim: int = Field(default=1536, description="The embedding dimension.")
+    latency: float = Field(default=0.0, description="Seconds slept per embedding request.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        words = WORD_PATTERN.findall(text.lower())
+        buckets = [zlib.crc32(word.encode("utf-8")) % self.dim for word in words]
+        vector = np.bincount(buckets, minlength=self.dim).astype(np.float32)
+        norm = np.linalg.norm(vector) or 1.0
+        return (vector / norm).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return self._embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+
+class FakeLLM(CustomLLM):
+    """
+    A deterministic completion LLM that answers rerank prompts with JSON document ratings and any other prompt with a fixed length answer.
+    """
+
+    latency: float = Field(default=0.0, description="Seconds slept per completion request.")
+    answer_tokens: int = Field(default=200, description="Number of words in an answer.")
+    context_window: int = Field(default=16385, description="The context window size.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.answer_tokens,
+            model_name="fake",
+        )
+
+    def _respond(self, prompt: str) -> str:
+        documents = prompt.split("DOCUMENTS:\n", 1)[-1]
+        if "DOCUMENT_NUMBER: " in documents:
+            return json.dumps({"answer": get_fake_ratings(documents)})
+        words = WORD_PATTERN.findall(prompt)[-50:] or ["answer"]
+        return " ".join(words[idx % len(words)] for idx in range(self.answer_tokens))
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        time.sleep(self.latency)
+        return CompletionResponse(text=self._respond(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        await asyncio.sleep(self.latency)
+        return CompletionResponse(text=self._respond(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, **kwargs: Any):
+        def gen():
+            time.sleep(self.latency)
+            text = ""
+            for word in self._respond(prompt).split(" "):
+                delta = word if not text else f" {word}"
+                text += delta
+                yield CompletionResponse(text=text, delta=delta)
+
+        return gen()
+
+
+def get_fake_ratings(documents):
+    """
+    Rates the numbered documents of a rerank prompt by a hash of their content.
+
+    Args:
+        documents (str): The documents section of the prompt.
+
+    Returns:
+        List[dict]: The "document_number" and "rating" of every relevant document.
+    """
+    ratings = []
+    sections = re.split(r"DOCUMENT_NUMBER: (\d+)\n", documents)[1:]
+    for number, content in zip(sections[::2], sections[1::2]):
+        content_hash = zlib.crc32(content.encode("utf-8"))
+        if (content_hash % 100) / 100 < RELEVANT_DOCUMENT_RATE:
+            ratings.append(
+                {"document_number": int(number), "rating": 1 + content_hash % 10}
+            )
+    return ratings
+
+
+def get_fake_query_variations(query, return_json=True, latency=0.0):
+    """
+    Stands in for the RAG fusion LLM call with fixed rewrites of the question.
+
+    Args:
+        query (str): The RAG fusion prompt.
+        return_json (bool): Unused, the response is always JSON.
+        latency (float): Seconds to sleep.
+
+    Returns:
+        dict: The RAG fusion response.
+    """
+    time.sleep(latency)
+    return build_fake_query_variations(query)
+
+
+async def a_get_fake_query_variations(query, return_json=True, latency=0.0):
+    """
+    Async counterpart of get_fake_query_variations.
+    """
+    await asyncio.sleep(latency)
+    return build_fake_query_variations(query)
+
+
+def build_fake_query_variations(prompt):
+    """
+    Builds the fake RAG fusion response to a RAG fusion prompt.
+
+    Args:
+        prompt (str): The RAG fusion prompt.
+
+    Returns:
+        dict: The "original_query" and its "query_variations".
+    """
+    question = re.search(r"QUESTION: (.*)\nRESPONSE:", prompt).group(1)
+    number_of_variations = int(re.search(r"generate (\d+) ", prompt).group(1))
+    return {
+        "original_query": question,
+        "query_variations": [
+            {
+                "query_number": idx + 1,
+                "query": f"{question} {FUSION_VARIATION_SUFFIXES[idx % len(FUSION_VARIATION_SUFFIXES)]}",
+            }
+            for idx in range(number_of_variations)
+        ],
+    }
+
+
+def install_fake_backends(rag_tools, args):
+    """
+    Replaces the OpenAI LLMs and embedding model used by the rag tools with the fake ones.
+
+    Args:
+        rag_tools (module): The utils.rag_tools module.
+        args (argparse.Namespace): The benchmark arguments.
+    """
+    llm = FakeLLM(latency=args.llm_latency, answer_tokens=args.answer_tokens)
+    embed_model = FakeEmbedding(dim=args.embed_dim, latency=args.embed_latency)
+    set_global_service_context(
+        ServiceContext.from_defaults(llm=llm, embed_model=embed_model)
+    )
+    rag_tools.llm3_general = llm
+    rag_tools.llm3_synthesizer = llm
+    rag_tools.llm4 = llm
+
+    def fusion_wrapper(query, return_json=False):
+        return get_fake_query_variations(query, latency=args.llm_latency)
+
+    async def a_fusion_wrapper(query, return_json=False):
+        return await a_get_fake_query_variations(query, latency=args.llm_latency)
+
+    rag_tools.light_gpt4_wrapper_autogen = fusion_wrapper
+    rag_tools.a_light_gpt4_wrapper = a_fusion_wrapper
+
+
+def get_peak_rss_mb():
+    """
+    Gets the peak resident memory of the process so far.
+
+    Returns:
+        Optional[float]: The peak RSS in MB, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def summarize_latencies(latencies):
+    """
+    Summarizes a list of latencies.
+
+    Args:
+        latencies (List[float]): The latencies in seconds.
+
+    Returns:
+        Dict[str, float]: The count and the mean, p50, p90, p99 and max latency in milliseconds.
+    """
+    values = np.asarray(latencies, dtype=np.float64) * 1000
+    if not len(values):
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def run_phase(name, calls, concurrency=1, trace_memory=False):
+    """
+    Runs and times the calls of a benchmark phase.
+
+    Args:
+        name (str): The phase name.
+        calls (List[Callable[[], Any]]): The calls to time.
+        concurrency (int): The number of calls to run in parallel.
+        trace_memory (bool): Flag to measure the peak Python heap allocations of the phase with tracemalloc.
+
+    Returns:
+        Tuple[dict, List[Any]]: The phase results, and the return value of each call.
+    """
+
+    def timed(call):
+        start = perf_counter()
+        result = call()
+        return perf_counter() - start, result
+
+    print(f"Running {name} ({len(calls)} calls)...", flush=True)
+    if trace_memory:
+        tracemalloc.start()
+    start = perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            timed_results = list(executor.map(timed, calls))
+    else:
+        timed_results = [timed(call) for call in calls]
+    wall_time = perf_counter() - start
+
+    phase = {
+        "latency": summarize_latencies([latency for latency, _ in timed_results]),
+        "wall_time_s": wall_time,
+        "throughput_per_s": len(calls) / wall_time if wall_time else None,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+    if trace_memory:
+        phase["peak_heap_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+    return phase, [result for _, result in timed_results]
+
+
+def summarize_traces(traces):
+    """
+    Summarizes the stage latencies of RAG traces.
+
+    Args:
+        traces (List[dict]): The trace records.
+
+    Returns:
+        Dict[str, dict]: The latency summary of every stage, plus its total LLM calls and tokens.
+    """
+    stages = {}
+    for trace in traces:
+        # Stages that run several times per question (e.g. one per variation) are
+        # summarized per run, and their totals are summed per question
+        for stage in trace["stages"]:
+            summary = stages.setdefault(
+                stage["stage"],
+                {"wall_times": [], "llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0},
+            )
+            summary["wall_times"].append(stage["wall_time"])
+            for key in ("llm_calls", "prompt_tokens", "completion_tokens"):
+                summary[key] += stage.get(key, 0)
+
+    return {
+        name: {
+            "latency": summarize_latencies(summary.pop("wall_times")),
+            **summary,
+        }
+        for name, summary in stages.items()
+    }
+
+
+def run_benchmark(args):
+    """
+    Runs every benchmark phase.
+
+    Args:
+        args (argparse.Namespace): The benchmark arguments.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="rag_benchmark_")
+    # The persistent caches must be isolated before the rag tools are imported
+    os.environ["RAG_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    import utils.rag_tools as rag_tools
+    from utils.embedding_cache import EmbeddingCache
+    from utils.rag_trace import RAGTrace
+
+    install_fake_backends(rag_tools, args)
+
+    docs_dir = os.path.join(args.docs_dir, args.domain)
+    storage_dir = os.path.join(work_dir, "storage", args.domain)
+    questions = [
+        BENCHMARK_QUESTIONS[idx % len(BENCHMARK_QUESTIONS)]
+        for idx in range(args.questions)
+    ] * args.rounds
+    num_files = len(rag_tools.list_doc_files(docs_dir))
+
+    results = {
+        "settings": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline", "work_dir")
+        },
+        "num_files": num_files,
+        "phases": {},
+    }
+    phases = results["phases"]
+
+    def build_index(run):
+        # A new embedding cache per build, so every build embeds every node
+        rag_tools.embedding_cache = EmbeddingCache(
+            os.path.join(work_dir, "cache", f"embeddings_{run}")
+        )
+        build_dir = storage_dir if run == 0 else f"{storage_dir}_{run}"
+        return rag_tools.create_index(
+            docs_dir,
+            build_dir,
+            num_workers=args.ingest_workers,
+            shard_max_bytes=args.shard_max_bytes,
+            embedding_quantization=args.embedding_quantization,
+        )
+
+    phases["create_index"], indexes = run_phase(
+        "create_index",
+        [lambda run=run: build_index(run) for run in range(args.build_runs)],
+        trace_memory=args.tracemalloc,
+    )
+    num_nodes = len(indexes[0].docstore.docs)
+    results["num_nodes"] = num_nodes
+    build_time = phases["create_index"]["latency"]["mean_ms"] / 1000
+    phases["create_index"]["files_per_s"] = num_files / build_time
+    phases["create_index"]["nodes_per_s"] = num_nodes / build_time
+    del indexes
+
+    def load_index_cold():
+        rag_tools.index_cache.invalidate()
+        rag_tools.lexical_index_cache.invalidate()
+        index = rag_tools.load_index(storage_dir)
+        rag_tools.load_lexical_index(storage_dir)
+        return index
+
+    phases["load_index"], _ = run_phase(
+        "load_index",
+        [load_index_cold] * args.load_runs,
+        trace_memory=args.tracemalloc,
+    )
+    phases["load_index_cached"], _ = run_phase(
+        "load_index_cached",
+        [lambda: rag_tools.load_index(storage_dir)] * args.load_runs,
+    )
+
+    index = rag_tools.load_index(storage_dir)
+    lexical_index = rag_tools.load_lexical_index(storage_dir)
+    results["recall"] = measure_recall(rag_tools, index, questions, args)
+    retrieval_settings = dict(
+        vector_top_k=args.vector_top_k,
+        reranker_top_n=args.reranker_top_n,
+        rerank=args.rerank,
+        fusion=args.fusion,
+    )
+
+    def clear_caches():
+        if not args.warm_caches:
+            rag_tools.rerank_cache.clear()
+            rag_tools.answer_cache.clear()
+
+    retrieval_traces = []
+
+    def retrieve(question):
+        clear_caches()
+        trace = RAGTrace(question)
+        nodes = rag_tools.get_retrieved_nodes(
+            question,
+            index,
+            query_context=DOMAIN_DESCRIPTION,
+            lexical_index=lexical_index if args.hybrid else None,
+            trace=trace,
+            **retrieval_settings,
+        )
+        retrieval_traces.append(trace.finish())
+        return nodes
+
+    phases["get_retrieved_nodes"], _ = run_phase(
+        "get_retrieved_nodes",
+        [lambda question=question: retrieve(question) for question in questions],
+        concurrency=args.concurrency,
+        trace_memory=args.tracemalloc,
+    )
+    phases["get_retrieved_nodes"]["stages"] = summarize_traces(retrieval_traces)
+
+    def answer(question):
+        clear_caches()
+        return rag_tools.get_informed_answer(
+            question,
+            docs_dir=docs_dir,
+            storage_dir=storage_dir,
+            domain_description=DOMAIN_DESCRIPTION,
+            use_answer_cache=args.warm_caches,
+            hybrid=args.hybrid,
+            trace_path=None,
+            **retrieval_settings,
+        )
+
+    phases["get_informed_answer"], responses = run_phase(
+        "get_informed_answer",
+        [lambda question=question: answer(question) for question in questions],
+        concurrency=args.concurrency,
+        trace_memory=args.tracemalloc,
+    )
+    phases["get_informed_answer"]["stages"] = summarize_traces(
+        [response.metadata["trace"] for response in responses]
+    )
+
+    return results
+
+
+def measure_recall(rag_tools, index, questions, args):
+    """
+    Checks the vector search of a (possibly quantized) index against an exact float32 search.
+
+    The queries are the benchmark questions plus a sample of the indexed node
+    embeddings, so the check also covers queries with close neighbours.
+
+    Args:
+        rag_tools (module): The rag tools module.
+        index (Union[VectorStoreIndex, ShardedIndex]): The loaded index.
+        questions (List[str]): The benchmark questions.
+        args (argparse.Namespace): The benchmark arguments.
+
+    Returns:
+        Optional[dict]: The recall at vector_top_k and the size of the scanned, float32 and persisted embeddings, or None if the index does not use numpy vector stores.
+    """
+    from utils.vector_stores import NumpyVectorStore, measure_recall as store_recall
+
+    shards = index.get_shards() if hasattr(index, "get_shards") else [index]
+    stores = [shard.vector_store for shard in shards]
+    if not all(isinstance(store, NumpyVectorStore) for store in stores):
+        return None
+
+    embed_model = rag_tools.get_index_service_context().embed_model
+    query_embeddings = [
+        embed_model.get_query_embedding(question) for question in sorted(set(questions))
+    ]
+    rng = np.random.default_rng(0)
+    for store in stores:
+        for node_id in rng.permutation(store.get_node_ids())[: args.recall_samples // len(stores)]:
+            query_embeddings.append(store.get(node_id))
+
+    memory_usage = [store.get_memory_usage() for store in stores]
+    return {
+        "quantization": stores[0].quantization or "float32",
+        "top_k": args.vector_top_k,
+        "recall": store_recall(stores, query_embeddings, args.vector_top_k),
+        "num_queries": len(query_embeddings),
+        "scan_mb": sum(usage["scan_bytes"] for usage in memory_usage) / 1024**2,
+        "float32_mb": sum(usage["float32_bytes"] for usage in memory_usage) / 1024**2,
+        "disk_mb": sum(usage["disk_bytes"] for usage in memory_usage) / 1024**2,
+    }
+
+
+def print_results(results):
+    """
+    Prints the benchmark results as tables.
+
+    Args:
+        results (dict): The benchmark results.
+    """
+    print(f"\nCorpus: {results['num_files']} files, {results['num_nodes']} nodes")
+    header = f"{'':<34}{'count':>6}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"
+
+    def latency_row(name, latency):
+        return (
+            f"{name:<34}{latency['count']:>6}"
+            + "".join(
+                f"{latency[key]:>10.1f}"
+                for key in ("mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms")
+            )
+        )
+
+    print("\nLatency (ms)")
+    print(header)
+    for name, phase in results["phases"].items():
+        print(latency_row(name, phase["latency"]))
+        for stage_name, stage in phase.get("stages", {}).items():
+            print(latency_row(f"  {stage_name}", stage["latency"]))
+
+    print("\nThroughput and memory")
+    for name, phase in results["phases"].items():
+        details = [f"{phase['throughput_per_s']:.2f} calls/s"]
+        if "nodes_per_s" in phase:
+            details.append(f"{phase['nodes_per_s']:.1f} nodes/s")
+            details.append(f"{phase['files_per_s']:.1f} files/s")
+        if phase.get("peak_rss_mb") is not None:
+            details.append(f"peak RSS {phase['peak_rss_mb']:.0f} MB")
+        if "peak_heap_mb" in phase:
+            details.append(f"peak heap {phase['peak_heap_mb']:.0f} MB")
+        print(f"{name:<34}" + ", ".join(details))
+
+    recall = results.get("recall")
+    if recall:
+        print(
+            f"\nVector search ({recall['quantization']}): recall@{recall['top_k']} "
+            f"{recall['recall']:.3f} over {recall['num_queries']} queries, "
+            f"scans {recall['scan_mb']:.1f} MB of embeddings ({recall['float32_mb']:.1f} MB as float32), "
+            f"{recall['disk_mb']:.1f} MB on disk"
+        )
+
+
+def compare_to_baseline(results, baseline, tolerance, min_delta_ms):
+    """
+    Finds the phases and stages whose median latency regressed against a baseline run.
+
+    Args:
+        results (dict): The benchmark results.
+        baseline (dict): The results of the baseline run.
+        tolerance (float): The allowed relative p50 increase.
+        min_delta_ms (float): The allowed absolute p50 increase, so noise on very fast stages is ignored.
+
+    Returns:
+        List[str]: A description of every regression.
+    """
+    regressions = []
+
+    def compare(name, latency, baseline_latency):
+        if not latency.get("count") or not baseline_latency.get("count"):
+            return
+        current, previous = latency["p50_ms"], baseline_latency["p50_ms"]
+        if current > previous * (1 + tolerance) and current - previous > min_delta_ms:
+            regressions.append(f"{name}: p50 {previous:.1f} ms -> {current:.1f} ms")
+
+    for name, phase in results["phases"].items():
+        baseline_phase = baseline["phases"].get(name)
+        if baseline_phase is None:
+            continue
+        compare(name, phase["latency"], baseline_phase["latency"])
+        for stage_name, stage in phase.get("stages", {}).items():
+            baseline_stage = baseline_phase.get("stages", {}).get(stage_name)
+            if baseline_stage is not None:
+                compare(f"{name}/{stage_name}", stage["latency"], baseline_stage["latency"])
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the rag tools offline.")
+    parser.add_argument("--docs-dir", default=DOCS_DIR)
+    parser.add_argument("--domain", default=DOMAIN)
+    parser.add_argument("--work-dir", default=None, help="Directory for the benchmark indexes and caches. Defaults to a new temporary directory.")
+    parser.add_argument("--questions", type=int, default=len(BENCHMARK_QUESTIONS), help="Number of distinct questions.")
+    parser.add_argument("--rounds", type=int, default=1, help="Number of times every question is asked.")
+    parser.add_argument("--build-runs", type=int, default=1)
+    parser.add_argument("--load-runs", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of questions answered in parallel.")
+    parser.add_argument("--ingest-workers", type=int, default=None)
+    parser.add_argument("--shard-max-bytes", type=int, default=None, help="Shard indexes over this total file size (0 never shards). Defaults to RAG_SHARD_MAX_BYTES.")
+    parser.add_argument("--embedding-quantization", choices=["float32", "float16", "int8"], default=None, help="Embeddings scanned by the vector search. Defaults to RAG_EMBEDDING_QUANTIZATION.")
+    parser.add_argument("--recall-samples", type=int, default=200, help="Number of node embeddings used as extra queries of the recall check.")
+    parser.add_argument("--min-recall", type=float, default=None, help="Fail if the vector search recall against an exact search is lower.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds per fake LLM request.")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="Seconds per fake embedding request.")
+    parser.add_argument("--embed-dim", type=int, default=1536)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--vector-top-k", type=int, default=40)
+    parser.add_argument("--reranker-top-n", type=int, default=20)
+    parser.add_argument("--no-rerank", dest="rerank", action="store_false")
+    parser.add_argument("--no-fusion", dest="fusion", action="store_false")
+    parser.add_argument("--no-hybrid", dest="hybrid", action="store_false")
+    parser.add_argument("--warm-caches", action="store_true", help="Keep the rerank and answer caches between questions.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Measure the peak Python heap of each phase (slows the phases down).")
+    parser.add_argument("--output", default=None, help="JSON file to write the results to.")
+    parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to check for regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative p50 increase over the baseline.")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="Allowed absolute p50 increase over the baseline.")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    results = run_benchmark(args)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to: {args.output}")
+
+    recall = results.get("recall")
+    if args.min_recall is not None and recall and recall["recall"] < args.min_recall:
+        print(f"\nRECALL {recall['recall']:.3f} is below the minimum of {args.min_recall}")
+        return 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != results["settings"]:
+            print("\nWARNING: The baseline was run with different settings.")
+        regressions = compare_to_baseline(
+            results, baseline, args.tolerance, args.min_delta_ms
+        )
+        if regressions:
+            print("\nREGRESSIONS:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,7 +5,7 @@ This script demonstrates the rag tools available in this project. The rag tool s
 from dotenv import load_dotenv
 import logging
 
-from utils.rag_tools import get_informed_answer
+from utils.rag_tools import iter_informed_answer
 
 # Set to DEBUG for more verbose logging
 logging.basicConfig(level=logging.INFO)
@@ -23,7 +23,8 @@ domain_description = "indexing and retrieval of documents for llms"
 def main():
     question = "How can I index various types of documents?"
     
-    answer = get_informed_answer(
+    print("GOT ANSWER: ", end="", flush=True)
+    for token in iter_informed_answer(
         question,
         docs_dir=DOCS_DIR,
         storage_dir=STORAGE_DIR,
@@ -33,9 +34,9 @@ def main():
         reranker_top_n=5,
         rerank=True,
         fusion=True,
-    )
-
-    print("GOT ANSWER: ", answer.response)
+    ):
+        print(token, end="", flush=True)
+    print()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,258 @@
+"""
+This file contains the shared pytest fixtures: offline tokenizer, embedding and LLM models, and small document directories.
+"""
+
+import os
+import re
+import sys
+import json
+import asyncio
+import time
+import hashlib
+import tempfile
+import threading
+from typing import Dict, List
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# rag_tools reads its configuration and opens its caches when it is imported
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("RAG_CACHE_DIR", tempfile.mkdtemp(prefix="rag_cache_"))
+# llama_index's default sentence splitter downloads nltk's punkt data unless it is found,
+# although the tokenizer it creates does not use it. An empty punkt directory is found.
+os.environ["NLTK_DATA"] = tempfile.mkdtemp(prefix="nltk_data_")
+os.makedirs(os.path.join(os.environ["NLTK_DATA"], "tokenizers", "punkt"))
+
+import tiktoken
+
+
+class WordEncoding:
+    """
+    An offline stand-in for a tiktoken encoding, with one token per word, punctuation mark, or whitespace run.
+
+    llama_index loads the gpt2 encoding when it is imported, which downloads its vocabulary.
+    """
+
+    name = "words"
+
+    def __init__(self):
+        self._ids = {}
+        self._tokens = []
+
+    def encode(self, text, **kwargs):
+        tokens = re.findall(r"\s+|\w+|[^\w\s]", text)
+        for token in tokens:
+            if token not in self._ids:
+                self._ids[token] = len(self._tokens)
+                self._tokens.append(token)
+        return [self._ids[token] for token in tokens]
+
+    def encode_ordinary(self, text):
+        return self.encode(text)
+
+    def decode(self, tokens, **kwargs):
+        return "".join(self._tokens[token] for token in tokens)
+
+
+WORD_ENCODING = WordEncoding()
+tiktoken.get_encoding = lambda *args, **kwargs: WORD_ENCODING
+tiktoken.encoding_for_model = lambda *args, **kwargs: WORD_ENCODING
+
+import pytest
+from llama_index import ServiceContext, set_global_service_context
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms import CompletionResponse, CustomLLM, LLMMetadata, MockLLM
+from llama_index.llms.base import llm_completion_callback
+from llama_index.readers.base import BaseReader
+
+EMBEDDING_DIM = 32
+
+
+class HashEmbedding(BaseEmbedding):
+    """
+    An offline embedding model: a normalized bag of hashed words.
+
+    Texts that share words are similar, so retrieval results are meaningful without an embedding API.
+    """
+
+    def _embed(self, text):
+        vector = [0.0] * EMBEDDING_DIM
+        for word in re.findall(r"\w+", text.lower()):
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % EMBEDDING_DIM] += 1.0
+        norm = sum(x * x for x in vector) ** 0.5 or 1.0
+        return [x / norm for x in vector]
+
+    def _get_query_embedding(self, query):
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._embed(query)
+
+    def _get_text_embedding(self, text):
+        return self._embed(text)
+
+
+# A document of the rerank prompt, see ModifiedLLMRerank._format_node_batch_fn
+RERANK_DOCUMENT_PATTERN = re.compile(
+    r"DOCUMENT_NUMBER: (\d+)\nDOCUMENT_CONTENT\n[-#]+\n(.*?)\n[-#]+\n", re.S
+)
+
+
+class RerankLLM(CustomLLM):
+    """
+    An offline rerank LLM that rates every document of a batch with the rating of its text (1 if not listed).
+
+    It also records how many batches it was asked to rate at the same time.
+    """
+
+    ratings: Dict[str, float] = Field(default_factory=dict)
+    # Number of calls to fail for batches with the given document text
+    failures: Dict[str, int] = Field(default_factory=dict)
+    latency: float = 0.0
+    calls: int = 0
+    max_active: int = 0
+    _active: int = PrivateAttr(default=0)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def metadata(self):
+        return LLMMetadata(model_name="rerank")
+
+    @llm_completion_callback()
+    def complete(self, prompt, **kwargs):
+        self._start()
+        try:
+            time.sleep(self.latency)
+        finally:
+            self._finish()
+        return self._rate(prompt)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt, **kwargs):
+        self._start()
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self._finish()
+        return self._rate(prompt)
+
+    def _start(self):
+        with self._lock:
+            self.calls += 1
+            self._active += 1
+            self.max_active = max(self.max_active, self._active)
+
+    def _finish(self):
+        with self._lock:
+            self._active -= 1
+
+    def _rate(self, prompt):
+        documents = RERANK_DOCUMENT_PATTERN.findall(prompt)
+        with self._lock:
+            for _, text in documents:
+                if self.failures.get(text):
+                    self.failures[text] -= 1
+                    raise ValueError(f"Failed to rate: {text}")
+        answer = [
+            {"document_number": int(number), "rating": self.ratings.get(text, 1)}
+            for number, text in documents
+        ]
+        return CompletionResponse(text=json.dumps({"answer": answer}))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, **kwargs):
+        raise NotImplementedError
+
+
+class AnswerLLM(CustomLLM):
+    """
+    An offline synthesis LLM that gives the same answer to every prompt, word by word when streaming, and records the prompts.
+    """
+
+    answer: str = "Install the package with pip."
+    # Private attributes are shared with the copies the RAG tools make of an LLM
+    _prompts: List[str] = PrivateAttr(default_factory=list)
+
+    @property
+    def metadata(self):
+        return LLMMetadata(model_name="answer")
+
+    @property
+    def prompts(self):
+        return self._prompts
+
+    @llm_completion_callback()
+    def complete(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return CompletionResponse(text=self.answer)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+
+        def gen():
+            text = ""
+            for token in re.findall(r"\s*\S+", self.answer):
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+
+class NotebookReader(BaseReader):
+    """Stands in for the llama_hub notebook reader, which is downloaded on first use."""
+
+    def __init__(self, concatenate=True):
+        pass
+
+    def load_data(self, file, extra_info=None):
+        raise NotImplementedError("The tests do not read notebooks")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def fake_service_context():
+    """Routes every embedding and LLM call to offline models."""
+    set_global_service_context(
+        ServiceContext.from_defaults(
+            llm=MockLLM(), embed_model=HashEmbedding(model_name="hash")
+        )
+    )
+
+
+@pytest.fixture
+def rag_tools(monkeypatch):
+    """The rag_tools module, with an empty index cache."""
+    import utils.ingest as ingest
+    import utils.rag_tools as rag_tools
+
+    monkeypatch.setattr(ingest, "download_loader", lambda name: NotebookReader)
+    rag_tools.index_cache.invalidate()
+    yield rag_tools
+    rag_tools.index_cache.invalidate()
+
+
+@pytest.fixture
+def answer_llm(rag_tools, monkeypatch):
+    """The synthesis LLM of the RAG tools."""
+    llm = AnswerLLM()
+    monkeypatch.setattr(rag_tools, "llm4", llm)
+    return llm
+
+
+def write_file(path, text):
+    """Writes a text file, creating its directory."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def docs_dir(tmp_path):
+    """A document directory with two top-level subdirectories."""
+    docs = tmp_path / "docs"
+    write_file(str(docs / "guides" / "install.md"), "Install the package with pip.")
+    write_file(str(docs / "guides" / "usage.md"), "Call the query engine to ask questions.")
+    write_file(str(docs / "api" / "retrievers.txt"), "Retrievers fetch the top nodes.")
+    return str(docs)
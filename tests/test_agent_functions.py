@@ -0,0 +1,78 @@
+import importlib
+import logging
+import os
+
+import pytest
+
+from conftest import RerankLLM, write_file
+
+DOMAIN_DESCRIPTION = "indexing and retrieval of documents for llms"
+
+
+@pytest.fixture
+def agent_functions(rag_tools, answer_llm, docs_dir, tmp_path, monkeypatch):
+    """The agent functions, answering from a single archived domain."""
+    for name in [
+        "GOOGLE_SEARCH_API_KEY",
+        "GOOGLE_CUSTOM_SEARCH_ENGINE_ID",
+        "GITHUB_PERSONAL_ACCESS_TOKEN",
+        "SERP_API_KEY",
+    ]:
+        monkeypatch.setenv(name, "test")
+    agent_functions = importlib.import_module("agents.agent_functions")
+
+    domains_dir = os.path.dirname(docs_dir)
+    write_file(os.path.join(docs_dir, "domain_description.txt"), DOMAIN_DESCRIPTION)
+    monkeypatch.setattr(agent_functions, "DOMAIN_KNOWLEDGE_DOCS_DIR", domains_dir)
+    monkeypatch.setattr(
+        agent_functions, "DOMAIN_KNOWLEDGE_STORAGE_DIR", str(tmp_path / "storage")
+    )
+    monkeypatch.setattr(agent_functions, "domain_matcher", None)
+    install_path = os.path.join(docs_dir, "guides", "install.md")
+    monkeypatch.setattr(
+        rag_tools,
+        "llm3_general",
+        # The reranker rates documents by their content, including the file path
+        RerankLLM(
+            ratings={
+                f"file_path: {install_path}\n\nInstall the package with pip.": 10
+            }
+        ),
+    )
+    monkeypatch.setattr(
+        rag_tools, "rag_fusion", lambda query, *args, **kwargs: [f"{query} example"]
+    )
+    return agent_functions
+
+
+def test_consult_archive_agent(agent_functions, answer_llm):
+    response = agent_functions.consult_archive_agent(
+        DOMAIN_DESCRIPTION, "How do I install the package?"
+    )
+
+    assert response.response == answer_llm.answer
+    assert response.source_nodes
+    assert "trace" in response.metadata
+
+
+def test_consult_archive_agent_streams_to_a_callback(agent_functions, answer_llm):
+    tokens = []
+
+    response = agent_functions.consult_archive_agent(
+        DOMAIN_DESCRIPTION, "How do I install the package?", on_token=tokens.append
+    )
+
+    assert tokens == ["Install", " the", " package", " with", " pip."]
+    assert response.response == answer_llm.answer
+    assert response.source_nodes
+
+
+def test_domain_ranking_is_logged(agent_functions, capsys, caplog):
+    caplog.set_level(logging.DEBUG, logger=agent_functions.__name__)
+
+    agent_functions.consult_archive_agent(
+        DOMAIN_DESCRIPTION, "How do I install the package?"
+    )
+
+    assert "Top domain similarities: [('docs', 1.0)]" in caplog.text
+    assert "DOMAIN" not in capsys.readouterr().out
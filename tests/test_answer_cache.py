@@ -0,0 +1,142 @@
+import os
+import time
+
+import pytest
+
+from conftest import write_file
+from utils.answer_cache import AnswerCache
+
+SCOPE = "llama_index"
+VERSION = "v1"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnswerCache(str(tmp_path / "answers.sqlite"), ttl=3600, max_entries=2)
+
+
+def put(cache, question, embedding, answer, index_version=VERSION):
+    cache.put(SCOPE, index_version, question, embedding, answer, [("node", 0.5)])
+
+
+def test_lookup_matches_similar_questions(cache):
+    put(cache, "What is a node?", [1.0, 0.0], "A chunk of a document.")
+
+    hit = cache.lookup(SCOPE, VERSION, [0.99, 0.05], similarity_threshold=0.95)
+    assert hit["answer"] == "A chunk of a document."
+    assert hit["source_nodes"] == [("node", 0.5)]
+    assert cache.lookup(SCOPE, VERSION, [0.0, 1.0], similarity_threshold=0.95) is None
+    assert cache.lookup("other", VERSION, [1.0, 0.0], similarity_threshold=0.95) is None
+
+
+def test_new_index_version_drops_old_answers(cache):
+    put(cache, "What is a node?", [1.0, 0.0], "old")
+    put(cache, "What is a node?", [1.0, 0.0], "new", index_version="v2")
+
+    assert cache.lookup(SCOPE, VERSION, [1.0, 0.0], 0.95) is None
+    assert cache.lookup(SCOPE, "v2", [1.0, 0.0], 0.95)["answer"] == "new"
+
+
+def test_expired_answers_are_not_returned(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answers.sqlite"), ttl=0.05, max_entries=10)
+    put(cache, "What is a node?", [1.0, 0.0], "A chunk of a document.")
+    assert cache.lookup(SCOPE, VERSION, [1.0, 0.0], 0.95) is not None
+
+    time.sleep(0.1)
+
+    assert cache.lookup(SCOPE, VERSION, [1.0, 0.0], 0.95) is None
+
+
+def test_least_recently_used_answer_is_evicted(cache):
+    put(cache, "first", [1.0, 0.0, 0.0], "1")
+    put(cache, "second", [0.0, 1.0, 0.0], "2")
+    # Using the first answer makes the second one the least recently used
+    assert cache.lookup(SCOPE, VERSION, [1.0, 0.0, 0.0], 0.95) is not None
+
+    put(cache, "third", [0.0, 0.0, 1.0], "3")
+
+    assert cache.lookup(SCOPE, VERSION, [1.0, 0.0, 0.0], 0.95)["answer"] == "1"
+    assert cache.lookup(SCOPE, VERSION, [0.0, 1.0, 0.0], 0.95) is None
+    assert cache.lookup(SCOPE, VERSION, [0.0, 0.0, 1.0], 0.95)["answer"] == "3"
+
+
+def test_clear(cache):
+    put(cache, "What is a node?", [1.0, 0.0], "A chunk of a document.")
+    cache.clear()
+    assert cache.lookup(SCOPE, VERSION, [1.0, 0.0], 0.95) is None
+
+
+def test_similar_question_gets_the_cached_answer(
+    rag_tools, answer_llm, docs_dir, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(
+        rag_tools,
+        "answer_cache",
+        AnswerCache(str(tmp_path / "answers.sqlite"), ttl=3600, max_entries=10),
+    )
+    storage_dir = str(tmp_path / "storage")
+
+    def ask(question, **kwargs):
+        return rag_tools.get_informed_answer(
+            question, docs_dir, storage_dir, use_answer_cache=True, **kwargs
+        )
+
+    first = ask("How do I install the package?")
+    assert len(answer_llm.prompts) == 1
+
+    # The hash embedding ignores punctuation and case, so the question is identical
+    second = ask("how do I install the package")
+    assert second.response == first.response
+    assert second.metadata["answer_cache"]["cached_question"] == (
+        "How do I install the package?"
+    )
+    assert [node.node_id for node in second.source_nodes] == [
+        node.node_id for node in first.source_nodes
+    ]
+    assert len(answer_llm.prompts) == 1
+
+    ask("Which retrievers fetch the nodes?")
+    assert len(answer_llm.prompts) == 2
+
+    # A changed index has new answers
+    write_file(os.path.join(docs_dir, "guides", "install.md"), "Install it with conda.")
+    ask("How do I install the package?", refresh=True)
+    assert len(answer_llm.prompts) == 3
+
+
+def test_answer_cache_is_opt_in(rag_tools, answer_llm, docs_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        rag_tools,
+        "answer_cache",
+        AnswerCache(str(tmp_path / "answers.sqlite"), ttl=3600, max_entries=10),
+    )
+    storage_dir = str(tmp_path / "storage")
+
+    for _ in range(2):
+        rag_tools.get_informed_answer("How do I install the package?", docs_dir, storage_dir)
+
+    assert len(answer_llm.prompts) == 2
+
+
+def test_question_is_embedded_once(rag_tools, answer_llm, docs_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        rag_tools,
+        "answer_cache",
+        AnswerCache(str(tmp_path / "answers.sqlite"), ttl=3600, max_entries=10),
+    )
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir)
+    batches = []
+    embed_queries = rag_tools.embed_queries
+
+    def embed(index, queries, *args, **kwargs):
+        batches.append(list(queries))
+        return embed_queries(index, queries, *args, **kwargs)
+
+    monkeypatch.setattr(rag_tools, "embed_queries", embed)
+
+    rag_tools.get_informed_answer(
+        "How do I install the package?", docs_dir, storage_dir, use_answer_cache=True
+    )
+
+    assert batches == [["How do I install the package?"]]
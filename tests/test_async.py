@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+VARIATIONS = ["install with pip", "ask the query engine", "top nodes of a retriever"]
+
+
+@pytest.fixture
+def storage_dir(rag_tools, monkeypatch, tmp_path):
+    async def a_rag_fusion(query, *args, **kwargs):
+        return list(VARIATIONS)
+
+    monkeypatch.setattr(
+        rag_tools, "rag_fusion", lambda query, *args, **kwargs: list(VARIATIONS)
+    )
+    monkeypatch.setattr(rag_tools, "a_rag_fusion", a_rag_fusion)
+    return str(tmp_path / "storage")
+
+
+def test_async_retrieval_matches_sync(rag_tools, docs_dir, storage_dir):
+    index = rag_tools.create_index(docs_dir, storage_dir)
+    kwargs = dict(vector_top_k=12, rerank=False, fusion=True)
+
+    expected = rag_tools.get_retrieved_nodes("How do I install it?", index, **kwargs)
+    nodes = asyncio.run(
+        rag_tools.a_get_retrieved_nodes("How do I install it?", index, **kwargs)
+    )
+
+    assert [(node.node_id, node.score) for node in nodes] == [
+        (node.node_id, node.score) for node in expected
+    ]
+
+
+def test_async_answer_matches_sync(rag_tools, answer_llm, docs_dir, storage_dir):
+    kwargs = dict(fusion=True, use_answer_cache=False)
+    expected = rag_tools.get_informed_answer(
+        "How do I install the package?", docs_dir, storage_dir, **kwargs
+    )
+
+    response = asyncio.run(
+        rag_tools.a_get_informed_answer(
+            "How do I install the package?", docs_dir, storage_dir, **kwargs
+        )
+    )
+
+    assert response.response == expected.response
+    assert [node.node_id for node in response.source_nodes] == [
+        node.node_id for node in expected.source_nodes
+    ]
+    assert answer_llm.prompts[1] == answer_llm.prompts[0]
+
+
+def test_questions_are_answered_concurrently(
+    rag_tools, answer_llm, docs_dir, storage_dir, monkeypatch
+):
+    # The index is created by the first question, while the others wait for it
+    created_indexes = []
+    create_index = rag_tools.create_index
+    monkeypatch.setattr(
+        rag_tools,
+        "create_index",
+        lambda **kwargs: created_indexes.append(create_index(**kwargs))
+        or created_indexes[-1],
+    )
+    questions = ["How do I install it?", "What do retrievers do?", "What is a node?"]
+
+    async def ask_all():
+        return await asyncio.gather(
+            *(
+                rag_tools.a_get_informed_answer(
+                    question, docs_dir, storage_dir, use_answer_cache=False
+                )
+                for question in questions
+            )
+        )
+
+    responses = asyncio.run(ask_all())
+
+    assert [response.response for response in responses] == [answer_llm.answer] * 3
+    assert len(answer_llm.prompts) == 3
+    assert len(created_indexes) == 1
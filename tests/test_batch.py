@@ -0,0 +1,76 @@
+import pytest
+
+from utils.answer_cache import AnswerCache
+
+QUESTIONS = [
+    "How do I install the package?",
+    "What do retrievers fetch?",
+    "How do I install the package?",
+]
+
+
+@pytest.fixture
+def storage_dir(rag_tools, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        rag_tools,
+        "rag_fusion",
+        lambda query, *args, **kwargs: [f"{query} example", f"{query} tutorial"],
+    )
+    monkeypatch.setattr(
+        rag_tools,
+        "answer_cache",
+        AnswerCache(str(tmp_path / "answers.sqlite"), ttl=3600, max_entries=10),
+    )
+    return str(tmp_path / "storage")
+
+
+def test_batch_matches_single_answers(rag_tools, answer_llm, docs_dir, storage_dir):
+    kwargs = dict(fusion=True, use_answer_cache=False)
+
+    responses = rag_tools.get_informed_answers(QUESTIONS, docs_dir, storage_dir, **kwargs)
+
+    # Repeated questions are answered once
+    assert len(answer_llm.prompts) == 2
+    assert len(responses) == len(QUESTIONS)
+    for question, response in zip(QUESTIONS, responses):
+        expected = rag_tools.get_informed_answer(question, docs_dir, storage_dir, **kwargs)
+        assert response.response == expected.response
+        assert [node.node_id for node in response.source_nodes] == [
+            node.node_id for node in expected.source_nodes
+        ]
+
+
+def test_batch_embeds_queries_together(rag_tools, answer_llm, docs_dir, storage_dir, monkeypatch):
+    rag_tools.create_index(docs_dir, storage_dir)
+    batches = []
+    embed_queries = rag_tools.embed_queries
+
+    def embed(index, queries, *args, **kwargs):
+        batches.append(list(queries))
+        return embed_queries(index, queries, *args, **kwargs)
+
+    monkeypatch.setattr(rag_tools, "embed_queries", embed)
+
+    rag_tools.get_informed_answers(
+        QUESTIONS, docs_dir, storage_dir, fusion=True, use_answer_cache=True
+    )
+
+    assert len(batches) == 2
+    assert batches[0] == QUESTIONS[:2]
+    # The questions embedded for the answer cache are not embedded again
+    assert sorted(batches[1]) == sorted(
+        f"{question} {suffix}" for question in QUESTIONS[:2] for suffix in ["example", "tutorial"]
+    )
+
+
+def test_batch_reuses_cached_answers(rag_tools, answer_llm, docs_dir, storage_dir):
+    rag_tools.get_informed_answer(
+        QUESTIONS[0], docs_dir, storage_dir, fusion=True, use_answer_cache=True
+    )
+
+    responses = rag_tools.get_informed_answers(
+        QUESTIONS, docs_dir, storage_dir, fusion=True, use_answer_cache=True
+    )
+
+    assert [response.response for response in responses] == [answer_llm.answer] * 3
+    assert len(answer_llm.prompts) == 2
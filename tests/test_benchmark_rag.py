@@ -0,0 +1,108 @@
+import json
+import os
+
+import pytest
+from llama_index import ServiceContext, set_global_service_context
+from llama_index.llms import MockLLM
+
+import benchmark_rag
+from conftest import HashEmbedding, write_file
+
+
+def latency(p50_ms):
+    return {"count": 3, "p50_ms": p50_ms}
+
+
+def test_summarize_latencies():
+    summary = benchmark_rag.summarize_latencies([0.1, 0.2, 0.3])
+
+    assert summary["count"] == 3
+    assert summary["p50_ms"] == pytest.approx(200)
+    assert summary["max_ms"] == pytest.approx(300)
+    assert benchmark_rag.summarize_latencies([]) == {"count": 0}
+
+
+def test_compare_to_baseline():
+    baseline = {
+        "phases": {
+            "answer": {"latency": latency(100), "stages": {"rerank": {"latency": latency(2)}}}
+        }
+    }
+    results = {
+        "phases": {
+            "answer": {"latency": latency(130), "stages": {"rerank": {"latency": latency(4)}}},
+            "new_phase": {"latency": latency(500)},
+        }
+    }
+
+    # The rerank stage doubled, but by less than the minimum delta
+    assert benchmark_rag.compare_to_baseline(results, baseline, 0.2, 5.0) == [
+        "answer: p50 100.0 ms -> 130.0 ms"
+    ]
+    assert benchmark_rag.compare_to_baseline(results, baseline, 0.5, 5.0) == []
+
+
+def test_fake_query_variations():
+    response = benchmark_rag.get_fake_query_variations(
+        "Please generate 2 variations.\nQUESTION: What is a node?\nRESPONSE:"
+    )
+
+    assert response["original_query"] == "What is a node?"
+    assert [variation["query"] for variation in response["query_variations"]] == [
+        "What is a node? example",
+        "What is a node? tutorial",
+    ]
+
+
+@pytest.fixture
+def benchmark_globals(rag_tools, monkeypatch):
+    """Restores the models and caches that the benchmark replaces."""
+    for name in (
+        "llm3_general",
+        "llm3_synthesizer",
+        "llm4",
+        "light_gpt4_wrapper_autogen",
+        "a_light_gpt4_wrapper",
+        "embedding_cache",
+    ):
+        monkeypatch.setattr(rag_tools, name, getattr(rag_tools, name))
+    monkeypatch.setenv("RAG_CACHE_DIR", os.environ["RAG_CACHE_DIR"])
+    yield
+    set_global_service_context(
+        ServiceContext.from_defaults(llm=MockLLM(), embed_model=HashEmbedding(model_name="hash"))
+    )
+
+
+def test_benchmark_runs_offline(benchmark_globals, docs_dir, tmp_path):
+    write_file(os.path.join(docs_dir, "domain", "guide.md"), "Install it with pip.")
+    output = str(tmp_path / "results.json")
+
+    def run(work_dir, *args):
+        return benchmark_rag.main(
+            [
+                "--docs-dir", docs_dir,
+                "--domain", "domain",
+                "--work-dir", str(tmp_path / work_dir),
+                "--questions", "2",
+                "--load-runs", "1",
+                "--embed-dim", "16",
+                "--answer-tokens", "5",
+                *args,
+            ]
+        )
+
+    assert run("work", "--output", output) == 0
+
+    with open(output) as f:
+        results = json.load(f)
+    assert results["num_files"] == 1
+    assert set(results["phases"]) == {
+        "create_index",
+        "load_index",
+        "load_index_cached",
+        "get_retrieved_nodes",
+        "get_informed_answer",
+    }
+    assert results["phases"]["get_informed_answer"]["latency"]["count"] == 2
+    assert "synthesis" in results["phases"]["get_informed_answer"]["stages"]
+    assert run("work_2", "--baseline", output, "--min-delta-ms", "1000") == 0
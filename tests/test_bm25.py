@@ -0,0 +1,124 @@
+import os
+
+from conftest import write_file
+from utils.bm25 import BM25Index
+
+TEXTS = [
+    ("install", "Install the package with pip install llama-index."),
+    ("query", "Build a query engine from the VectorStoreIndex and query it."),
+    ("retriever", "The retriever returns the top k nodes for a query."),
+]
+
+
+def test_query_ranks_matching_documents():
+    index = BM25Index.from_texts(TEXTS)
+
+    results = index.query("how do I install it with pip", top_k=2)
+
+    assert results[0][0] == "install"
+    assert all(score > 0 for _, score in results)
+
+
+def test_query_without_matches():
+    index = BM25Index.from_texts(TEXTS)
+
+    assert index.query("zebra", top_k=3) == []
+    assert index.query("install", top_k=0) == []
+    assert BM25Index.from_texts([]).query("install", top_k=3) == []
+
+
+def test_persist_and_load_round_trip(tmp_path):
+    index = BM25Index.from_texts(TEXTS, k1=1.5, b=0.5)
+    index.persist(str(tmp_path))
+
+    assert BM25Index.exists(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path))
+    assert (loaded.k1, loaded.b) == (1.5, 0.5)
+    for query in ["query engine", "top k nodes", "pip"]:
+        assert loaded.query(query, top_k=3) == index.query(query, top_k=3)
+
+
+def test_identifiers_are_split_into_terms():
+    index = BM25Index.from_texts(TEXTS)
+
+    assert index.query("vector store", top_k=3)[0][0] == "query"
+    assert index.query("vectorstoreindex", top_k=3)[0][0] == "query"
+
+
+def test_hybrid_retrieval_finds_lexical_matches(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    index = rag_tools.create_index(docs_dir, storage_dir)
+
+    lexical_index = rag_tools.load_lexical_index(storage_dir)
+    assert lexical_index is not None
+    nodes = rag_tools.get_retrieved_nodes(
+        "pip",
+        index,
+        vector_top_k=1,
+        rerank=False,
+        fusion=False,
+        lexical_index=lexical_index,
+    )
+
+    assert "install.md" in {node.node.metadata["file_name"] for node in nodes}
+
+
+def assert_same_index(index, expected):
+    assert index.node_ids.tolist() == expected.node_ids.tolist()
+    for name in ["doc_lengths", "vocab", "indptr", "doc_ids", "tfs"]:
+        assert getattr(index, name).tolist() == getattr(expected, name).tolist()
+
+
+def test_update_matches_a_rebuild():
+    index = BM25Index.from_texts(TEXTS)
+    new_texts = [("faq", "Zebras answer questions about the query engine.")]
+
+    updated = index.update(["install"], new_texts)
+
+    assert_same_index(updated, BM25Index.from_texts(TEXTS[1:] + new_texts))
+    assert index.query("pip", top_k=3)[0][0] == "install"
+    assert updated.query("pip", top_k=3) == []
+    assert_same_index(
+        BM25Index.from_texts([]).update([], TEXTS), BM25Index.from_texts(TEXTS)
+    )
+    assert len(index.update([node_id for node_id, _ in TEXTS], []).vocab) == 0
+
+
+def test_refresh_updates_lexical_index(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir)
+    write_file(os.path.join(docs_dir, "guides", "faq.md"), "Zebras answer questions.")
+
+    index = rag_tools.refresh_index(docs_dir, storage_dir)
+
+    lexical_index = rag_tools.load_lexical_index(storage_dir)
+    nodes = rag_tools.retrieve_lexical_nodes(index, lexical_index, "zebras", top_k=3)
+    assert [node.node.metadata["file_name"] for node in nodes] == ["faq.md"]
+
+
+def test_refresh_only_tokenizes_changed_nodes(
+    rag_tools, docs_dir, tmp_path, monkeypatch
+):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir)
+    write_file(os.path.join(docs_dir, "guides", "faq.md"), "Zebras answer questions.")
+    os.remove(os.path.join(docs_dir, "api", "retrievers.txt"))
+    lexical_texts = []
+    get_lexical_text = rag_tools.get_lexical_text
+    monkeypatch.setattr(
+        rag_tools,
+        "get_lexical_text",
+        lambda node: lexical_texts.append(node.get_content()) or get_lexical_text(node),
+    )
+
+    index = rag_tools.refresh_index(docs_dir, storage_dir)
+
+    assert lexical_texts == ["Zebras answer questions."]
+    rag_tools.lexical_index_cache.invalidate()
+    assert_same_index(
+        rag_tools.load_lexical_index(storage_dir),
+        BM25Index.from_texts(
+            (node_id, get_lexical_text(node))
+            for node_id, node in index.docstore.docs.items()
+        ),
+    )
@@ -0,0 +1,11 @@
+import os
+
+from utils.cache_dir import REPO_DIR, resolve_cache_dir
+
+
+def test_cache_dirs_do_not_depend_on_the_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    assert os.path.isdir(os.path.join(REPO_DIR, "utils"))
+    assert resolve_cache_dir(".cache") == os.path.join(REPO_DIR, ".cache")
+    assert resolve_cache_dir(str(tmp_path / "cache")) == str(tmp_path / "cache")
@@ -0,0 +1,54 @@
+from llama_index.schema import MetadataMode, NodeWithScore, TextNode
+
+
+def make_node(rag_tools, node_id, score, token_count):
+    node = TextNode(
+        id_=node_id,
+        text=f"Text of {node_id}",
+        metadata={rag_tools.NODE_TOKEN_COUNT_KEY: token_count},
+    )
+    return NodeWithScore(node=node, score=score)
+
+
+def test_pack_skips_nodes_that_do_not_fit(rag_tools):
+    nodes = [
+        make_node(rag_tools, "small", 0.6, 10),
+        make_node(rag_tools, "first", 0.9, 50),
+        make_node(rag_tools, "large", 0.8, 60),
+        make_node(rag_tools, "third", 0.7, 30),
+    ]
+
+    packed = rag_tools.pack_context_nodes(nodes, token_budget=100)
+
+    assert [node.node_id for node in packed] == ["first", "third", "small"]
+
+
+def test_pack_keeps_the_top_node_if_none_fits(rag_tools):
+    nodes = [make_node(rag_tools, "a", 0.5, 500), make_node(rag_tools, "b", 0.9, 200)]
+
+    packed = rag_tools.pack_context_nodes(nodes, token_budget=100)
+
+    assert [node.node_id for node in packed] == ["b"]
+
+
+def test_token_counts_are_stored_at_index_time(rag_tools, docs_dir, tmp_path):
+    index = rag_tools.create_index(docs_dir, str(tmp_path / "storage"))
+
+    for node in index.docstore.docs.values():
+        token_count = node.metadata[rag_tools.NODE_TOKEN_COUNT_KEY]
+        assert token_count == rag_tools.count_token(
+            node.get_content(metadata_mode=MetadataMode.LLM)
+        )
+        assert rag_tools.get_node_token_count(node) == token_count
+        # The count changes neither the embedded text nor the prompts
+        for metadata_mode in (MetadataMode.EMBED, MetadataMode.LLM):
+            metadata_str = node.get_metadata_str(mode=metadata_mode)
+            assert f"{rag_tools.NODE_TOKEN_COUNT_KEY}: " not in metadata_str
+
+
+def test_token_count_of_nodes_indexed_without_one(rag_tools):
+    node = TextNode(text="Three little words")
+
+    assert rag_tools.get_node_token_count(node) == rag_tools.count_token(
+        "Three little words"
+    )
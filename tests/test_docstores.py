@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from conftest import write_file
+from utils.docstores import LazyDocumentStore, OffsetKVStore
+
+
+def test_put_get_delete_before_persist():
+    store = OffsetKVStore()
+    store.put("a", {"text": "alpha"})
+    store.put("b", {"text": "beta"}, collection="other")
+
+    assert store.get("a") == {"text": "alpha"}
+    assert store.get("b") is None
+    assert store.get("b", collection="other") == {"text": "beta"}
+    assert store.delete("a")
+    assert not store.delete("a")
+    assert store.get("a") is None
+
+
+def test_persist_and_reopen(tmp_path):
+    base = str(tmp_path / "store" / "docstore")
+    store = OffsetKVStore()
+    store.put("a", {"text": "alpha"})
+    store.put("b", {"text": "beta"})
+    store.put("c", {"text": "gamma"}, collection="other")
+    store.persist(base)
+
+    reopened = OffsetKVStore(base)
+    assert reopened.get("a") == {"text": "alpha"}
+    assert reopened.get_all() == {"a": {"text": "alpha"}, "b": {"text": "beta"}}
+    assert reopened.get_all(collection="other") == {"c": {"text": "gamma"}}
+    assert reopened.count() == 2
+
+
+def test_changes_after_reopen_are_persisted(tmp_path):
+    base = str(tmp_path / "docstore")
+    store = OffsetKVStore()
+    store.put("a", {"text": "alpha"})
+    store.put("b", {"text": "beta"})
+    store.persist(base)
+
+    store = OffsetKVStore(base)
+    store.delete("a")
+    store.put("b", {"text": "beta 2"})
+    store.put("d", {"text": "delta"})
+    assert store.count() == 2
+    store.persist(base)
+
+    reopened = OffsetKVStore(base)
+    assert reopened.get("a") is None
+    assert reopened.get_all() == {"b": {"text": "beta 2"}, "d": {"text": "delta"}}
+
+
+def test_get_returns_a_copy():
+    store = OffsetKVStore()
+    store.put("a", {"text": "alpha"})
+    store.get("a")["text"] = "changed"
+    assert store.get("a") == {"text": "alpha"}
+
+
+@pytest.mark.parametrize("docstore_backend", ["lazy", "simple"])
+def test_index_docstore_backends(
+    rag_tools, docs_dir, tmp_path, monkeypatch, docstore_backend
+):
+    monkeypatch.setattr(rag_tools, "DOCSTORE_BACKEND", docstore_backend)
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir)
+    write_file(os.path.join(docs_dir, "guides", "faq.md"), "Zebras answer questions.")
+    rag_tools.index_cache.invalidate()
+
+    index = rag_tools.refresh_index(docs_dir, storage_dir)
+    rag_tools.index_cache.invalidate()
+    index = rag_tools.load_index(storage_dir)
+
+    assert isinstance(index.docstore, LazyDocumentStore) == (docstore_backend == "lazy")
+    assert len(index.docstore.docs) == 4
+    nodes = rag_tools.get_retrieved_nodes(
+        "zebras", index, vector_top_k=1, rerank=False, fusion=False
+    )
+    assert nodes[0].node.get_content() == "Zebras answer questions."
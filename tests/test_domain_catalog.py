@@ -0,0 +1,89 @@
+import os
+import shutil
+
+import pytest
+
+from conftest import write_file
+from utils.domain_catalog import DOMAIN_DESCRIPTION_FNAME, DomainCatalog
+
+
+def write_domain(docs_dir, domain_name, description):
+    write_file(os.path.join(docs_dir, domain_name, DOMAIN_DESCRIPTION_FNAME), description)
+
+
+@pytest.fixture
+def docs_dir(tmp_path):
+    docs = str(tmp_path / "docs")
+    write_domain(docs, "llama_index", "indexing of documents for llms")
+    write_domain(docs, "autogen", "multi agent conversations")
+    os.makedirs(os.path.join(docs, "no_description"))
+    return docs
+
+
+def get_catalog(docs_dir, tmp_path, refresh_interval=0.0):
+    return DomainCatalog(
+        docs_dir,
+        manifest_path=str(tmp_path / "catalog" / "manifest.json"),
+        refresh_interval=refresh_interval,
+    )
+
+
+def get_descriptions(catalog):
+    return {
+        domain["domain_name"]: domain["domain_description"]
+        for domain in catalog.get_domains()
+    }
+
+
+def test_domains_are_listed(docs_dir, tmp_path):
+    catalog = get_catalog(docs_dir, tmp_path)
+
+    assert get_descriptions(catalog) == {
+        "autogen": "multi agent conversations",
+        "llama_index": "indexing of documents for llms",
+    }
+    assert catalog.get_domain("autogen")["description_hash"]
+    assert catalog.get_domain("no_description") is None
+
+
+def test_unchanged_descriptions_are_not_read_again(docs_dir, tmp_path):
+    get_catalog(docs_dir, tmp_path).refresh()
+    # Same size and mtime, so the persisted manifest is trusted
+    path = os.path.join(docs_dir, "autogen", DOMAIN_DESCRIPTION_FNAME)
+    stat = os.stat(path)
+    write_file(path, "MULTI AGENT CONVERSATIONS")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    catalog = get_catalog(docs_dir, tmp_path)
+
+    assert catalog.refresh() is False
+    assert get_descriptions(catalog)["autogen"] == "multi agent conversations"
+
+
+def test_changes_are_detected(docs_dir, tmp_path):
+    catalog = get_catalog(docs_dir, tmp_path)
+    catalog.refresh()
+
+    write_domain(docs_dir, "autogen", "agents that talk to each other")
+    write_domain(docs_dir, "langchain", "chains of llm calls")
+    shutil.rmtree(os.path.join(docs_dir, "llama_index"))
+
+    assert catalog.refresh() is True
+    assert get_descriptions(catalog) == {
+        "autogen": "agents that talk to each other",
+        "langchain": "chains of llm calls",
+    }
+
+
+def test_refreshes_are_throttled(docs_dir, tmp_path):
+    catalog = get_catalog(docs_dir, tmp_path, refresh_interval=3600)
+    catalog.refresh()
+    write_domain(docs_dir, "langchain", "chains of llm calls")
+    write_domain(docs_dir, "haystack", "search pipelines")
+
+    assert catalog.get_domain("langchain") is None
+    catalog.update_domain("langchain")
+    assert catalog.get_domain("langchain") is not None
+    assert catalog.get_domain("haystack") is None
+    catalog.refresh(force=True)
+    assert catalog.get_domain("haystack") is not None
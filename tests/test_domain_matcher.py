@@ -0,0 +1,73 @@
+from typing import List
+
+import pytest
+from llama_index.bridge.pydantic import Field
+
+from conftest import HashEmbedding
+from utils.domain_matcher import DomainMatcher
+
+
+class CountingEmbedding(HashEmbedding):
+    """Records the texts it embeds."""
+
+    texts: List[str] = Field(default_factory=list)
+
+    def _get_text_embedding(self, text):
+        self.texts.append(text)
+        return super()._get_text_embedding(text)
+
+
+def domain(name, description):
+    return {"domain_name": name, "domain_description": description}
+
+
+DOMAINS = [
+    domain("llama_index", "indexing and retrieval of documents for llms"),
+    domain("autogen", "multi agent conversation framework"),
+]
+
+
+@pytest.fixture
+def embed_model():
+    return CountingEmbedding(model_name="hash")
+
+
+def test_clear_match_is_decided(embed_model):
+    matcher = DomainMatcher(embed_model)
+
+    decided, match, ranking = matcher.match("retrieval of documents for llms", DOMAINS)
+
+    assert decided
+    assert match["domain_name"] == "llama_index"
+    assert [domain["domain_name"] for domain, _ in ranking] == ["llama_index", "autogen"]
+
+
+def test_dissimilar_domains_are_left_to_the_judge(embed_model):
+    matcher = DomainMatcher(embed_model)
+
+    # The judge may still recognize a domain described in other words
+    assert matcher.match("zebra migration", DOMAINS)[:2] == (False, None)
+    assert matcher.match("zebra migration", []) == (True, None, [])
+
+
+def test_close_candidates_are_left_to_the_judge(embed_model):
+    domains = DOMAINS + [domain("llama_hub", DOMAINS[0]["domain_description"])]
+    matcher = DomainMatcher(embed_model)
+
+    decided, match, ranking = matcher.match("retrieval of documents for llms", domains)
+
+    assert (decided, match) == (False, None)
+    assert {domain["domain_name"] for domain, _ in ranking[:2]} == {"llama_index", "llama_hub"}
+
+
+def test_descriptions_are_embedded_once(embed_model):
+    matcher = DomainMatcher(embed_model)
+    matcher.rank("retrieval of documents", DOMAINS)
+    assert len(embed_model.texts) == 2
+
+    matcher.rank("agent conversations", DOMAINS)
+    assert len(embed_model.texts) == 2
+
+    changed = [DOMAINS[0], domain("autogen", "agents that talk to each other")]
+    matcher.rank("agent conversations", changed)
+    assert embed_model.texts[2:] == ["agents that talk to each other"]
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from conftest import HashEmbedding
+from utils.embedding_cache import CachedEmbedding, EmbeddingCache
+
+
+class CountingEmbedding(HashEmbedding):
+    """A HashEmbedding that counts the texts it embeds."""
+
+    texts_embedded: int = 0
+
+    def _get_text_embedding(self, text):
+        self.texts_embedded += 1
+        return super()._get_text_embedding(text)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(str(tmp_path / "embeddings"))
+
+
+def test_get_many_returns_stored_embeddings(cache):
+    cache.set_many("model", ["alpha", "beta"], [[1.0, 0.5], [0.25, 0.0]])
+
+    assert cache.get_many("model", ["beta", "gamma", "alpha"]) == [
+        [0.25, 0.0],
+        None,
+        [1.0, 0.5],
+    ]
+    assert cache.get_many("other model", ["alpha"]) == [None]
+
+
+def test_embeddings_are_shared_across_cache_instances(cache):
+    texts = [f"text {idx}" for idx in range(1200)]
+    embeddings = np.random.default_rng(0).normal(size=(len(texts), 8))
+    cache.set_many("model", texts, embeddings.tolist())
+
+    reopened = EmbeddingCache(cache.cache_dir)
+
+    np.testing.assert_allclose(
+        reopened.get_many("model", texts), embeddings.astype(np.float32)
+    )
+
+
+def test_cached_embedding_only_embeds_new_texts(cache):
+    embed_model = CountingEmbedding(model_name="hash")
+    cached_model = CachedEmbedding(embed_model, cache)
+    embeddings = cached_model.get_text_embedding_batch(["alpha", "beta"])
+
+    assert cached_model.get_text_embedding_batch(["beta", "gamma", "alpha"]) == [
+        embeddings[1],
+        embed_model.get_text_embedding("gamma"),
+        embeddings[0],
+    ]
+    # alpha, beta, gamma, and gamma again for the expected value
+    assert embed_model.texts_embedded == 4
+    assert cached_model.get_stats() == {"hits": 2, "misses": 3}
+
+
+def test_queries_are_not_cached(cache):
+    cached_model = CachedEmbedding(HashEmbedding(model_name="hash"), cache)
+
+    cached_model.get_query_embedding("What is a node?")
+
+    assert cache.get_many(cached_model.cache_model_name, ["What is a node?"]) == [None]
+    assert cached_model.uncached_model.model_name == "hash"
+
+
+def test_rebuild_embeds_no_unchanged_nodes(rag_tools, docs_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        rag_tools, "embedding_cache", EmbeddingCache(str(tmp_path / "embeddings"))
+    )
+
+    index = rag_tools.create_index(docs_dir, str(tmp_path / "first"))
+    assert index.service_context.embed_model.get_stats() == {"hits": 0, "misses": 3}
+
+    index = rag_tools.create_index(docs_dir, str(tmp_path / "second"))
+    assert index.service_context.embed_model.get_stats() == {"hits": 3, "misses": 0}
+
+    # Query embeddings bypass the cache
+    rag_tools.embed_queries(index, ["Which nodes are cached?"])
+    assert index.service_context.embed_model.get_stats() == {"hits": 3, "misses": 0}
@@ -0,0 +1,47 @@
+import pytest
+from llama_index.schema import NodeWithScore, TextNode
+
+from utils.rag_tools import fuse_ranked_nodes
+
+
+def ranked(*node_ids):
+    return [
+        NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=1.0)
+        for node_id in node_ids
+    ]
+
+
+def test_nodes_ranked_by_several_lists_rise_to_the_top():
+    fused = fuse_ranked_nodes(
+        [ranked("a", "b", "c"), ranked("b", "c", "d"), ranked("e", "b")], k=60
+    )
+
+    assert [node.node.node_id for node in fused] == ["b", "c", "a", "e", "d"]
+    assert fused[0].score == pytest.approx(1 / 62 + 1 / 61 + 1 / 62)
+
+
+def test_duplicates_in_a_list_count_once_at_their_best_rank():
+    fused = fuse_ranked_nodes([ranked("a", "a", "b")], k=1)
+
+    assert [(node.node.node_id, node.score) for node in fused] == [
+        ("a", pytest.approx(1 / 2)),
+        ("b", pytest.approx(1 / 4)),
+    ]
+
+
+def test_ties_keep_the_retrieval_order_and_top_n():
+    fused = fuse_ranked_nodes([ranked("a"), ranked("b"), ranked("c")], top_n=2)
+
+    assert [node.node.node_id for node in fused] == ["a", "b"]
+    assert fuse_ranked_nodes([], top_n=2) == []
+
+
+def test_candidate_top_n_limits_the_retrieved_nodes(rag_tools, docs_dir, tmp_path):
+    index = rag_tools.create_index(docs_dir, str(tmp_path / "storage"))
+
+    nodes = rag_tools.get_retrieved_nodes(
+        "pip", index, vector_top_k=3, rerank=False, fusion=False, candidate_top_n=2
+    )
+
+    assert len(nodes) == 2
+    assert nodes[0].score >= nodes[1].score
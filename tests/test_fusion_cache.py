@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from utils.fusion_cache import FusionCache
+from utils.rag_trace import RAGTrace
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return FusionCache(str(tmp_path / "fusion.sqlite"), ttl=3600)
+
+
+def test_get_and_set(cache):
+    assert cache.get("What is a node?", "llama_index", 2) is None
+
+    cache.set("What is a node?", "llama_index", 2, ["node meaning", "node definition"])
+
+    assert cache.get("  what is a NODE? ", "llama_index", 2) == [
+        "node meaning",
+        "node definition",
+    ]
+    assert cache.get("What is a node?", "other", 2) is None
+    assert cache.get("What is a node?", "llama_index", 3) is None
+    cache.clear()
+    assert cache.get("What is a node?", "llama_index", 2) is None
+
+
+def test_expired_variations_are_not_returned(tmp_path):
+    cache = FusionCache(str(tmp_path / "fusion.sqlite"), ttl=0.05)
+    cache.set("What is a node?", None, 2, ["node meaning"])
+
+    time.sleep(0.1)
+
+    assert cache.get("What is a node?", None, 2) is None
+
+
+@pytest.fixture
+def fusion_llm(rag_tools, cache, monkeypatch):
+    """Records the queries sent to the fusion LLM."""
+    prompts = []
+
+    def light_gpt4_wrapper_autogen(query, return_json=False):
+        prompts.append(query)
+        return {"query_variations": [{"query": "variation 1"}, {"query": "variation 2"}]}
+
+    monkeypatch.setattr(rag_tools, "light_gpt4_wrapper_autogen", light_gpt4_wrapper_autogen)
+    monkeypatch.setattr(rag_tools, "fusion_cache", cache)
+    monkeypatch.setattr(rag_tools, "fusion_latency_estimate", 0.0)
+    return prompts
+
+
+def test_variations_are_cached(rag_tools, fusion_llm, monkeypatch):
+    monkeypatch.setattr(rag_tools, "fusion_cache_executor", None)
+    variations = rag_tools.rag_fusion("What is a node?", number_of_variations=2)
+
+    trace = RAGTrace("What is a node?")
+    assert rag_tools.rag_fusion("what is a node", number_of_variations=2, trace=trace) == (
+        variations
+    )
+    assert len(fusion_llm) == 1
+    assert trace.record["stages"][0]["cache_hit"]
+    # The background executor is only started when fusion is skipped
+    assert rag_tools.fusion_cache_executor is None
+
+
+def test_slow_fusion_is_skipped_and_warmed(rag_tools, fusion_llm, monkeypatch):
+    monkeypatch.setattr(rag_tools, "fusion_latency_estimate", 10.0)
+    monkeypatch.setattr(rag_tools, "fusion_cache_executor", None)
+
+    trace = RAGTrace("What is a node?")
+    variations = rag_tools.rag_fusion(
+        "What is a node?", number_of_variations=2, trace=trace, latency_budget=1.0
+    )
+
+    assert variations == []
+    assert trace.record["stages"][0]["skipped"]
+    # The variations are generated in the background for the next time
+    assert rag_tools.fusion_cache_executor is not None
+    rag_tools.get_fusion_cache_executor().submit(lambda: None).result()
+    assert rag_tools.rag_fusion(
+        "What is a node?", number_of_variations=2, latency_budget=1.0
+    ) == ["variation 1", "variation 2"]
+    assert len(fusion_llm) == 1
+
+
+def test_latency_estimate_is_smoothed(rag_tools, monkeypatch):
+    monkeypatch.setattr(rag_tools, "fusion_latency_estimate", 6.0)
+
+    rag_tools.record_fusion_latency(1.0)
+
+    assert rag_tools.fusion_latency_estimate == pytest.approx(
+        6.0 + rag_tools.FUSION_LATENCY_SMOOTHING * (1.0 - 6.0)
+    )
+    assert rag_tools.should_skip_fusion(1.0)
+    assert not rag_tools.should_skip_fusion(None)
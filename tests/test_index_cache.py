@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import write_file
+from utils.index_cache import IndexCache, get_signature_size, get_storage_signature
+
+
+class CountingLoader:
+    """Loads a new object on every call, taking latency seconds, and counts the calls and concurrent loads."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.max_active = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, storage_dir):
+        with self._lock:
+            self.calls += 1
+            self._active += 1
+            self.max_active = max(self.max_active, self._active)
+        time.sleep(self.latency)
+        with self._lock:
+            self._active -= 1
+        return object()
+
+
+def make_storage(tmp_path, name, size):
+    storage_dir = str(tmp_path / name)
+    write_file(os.path.join(storage_dir, "docstore.json"), "x" * size)
+    return storage_dir
+
+
+def test_get_loads_once(tmp_path):
+    storage_dir = make_storage(tmp_path, "a", 10)
+    cache = IndexCache(max_bytes=1000)
+    loader = CountingLoader()
+
+    index = cache.get(storage_dir, loader)
+
+    assert cache.get(storage_dir, loader) is index
+    assert loader.calls == 1
+
+
+def test_changed_files_are_reloaded(tmp_path):
+    storage_dir = make_storage(tmp_path, "a", 10)
+    cache = IndexCache(max_bytes=1000)
+    loader = CountingLoader()
+    index = cache.get(storage_dir, loader)
+
+    write_file(os.path.join(storage_dir, "docstore.json"), "y" * 20)
+
+    assert cache.get(storage_dir, loader) is not index
+    assert loader.calls == 2
+
+
+def test_least_recently_used_index_is_evicted(tmp_path):
+    storage_dirs = [make_storage(tmp_path, name, 400) for name in "abc"]
+    cache = IndexCache(max_bytes=1000)
+    loader = CountingLoader()
+    for storage_dir in storage_dirs[:2]:
+        cache.get(storage_dir, loader)
+    # Using the first index makes the second one the least recently used
+    cache.get(storage_dirs[0], loader)
+
+    cache.get(storage_dirs[2], loader)
+
+    assert cache.stats()["storage_dirs"] == [
+        os.path.abspath(storage_dirs[0]),
+        os.path.abspath(storage_dirs[2]),
+    ]
+    assert cache.total_bytes <= 1000
+
+
+def test_concurrent_gets_load_once(tmp_path):
+    storage_dir = make_storage(tmp_path, "a", 10)
+    cache = IndexCache(max_bytes=1000)
+    loader = CountingLoader(latency=0.1)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        indexes = list(executor.map(lambda _: cache.get(storage_dir, loader), range(4)))
+
+    assert loader.calls == 1
+    assert all(index is indexes[0] for index in indexes)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_different_indexes_load_in_parallel(tmp_path):
+    storage_dirs = [make_storage(tmp_path, name, 10) for name in "ab"]
+    cache = IndexCache(max_bytes=1000)
+    loader = CountingLoader(latency=0.1)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda dir_: cache.get(dir_, loader), storage_dirs))
+
+    assert loader.max_active == 2
+
+
+def test_signature_size_leaves_out_memory_mapped_files(tmp_path):
+    storage_dir = make_storage(tmp_path, "a", 10)
+    for file_name, size in [
+        ("docstore.records.jsonl", 1000),
+        ("docstore.offsets.npz", 20),
+        ("default__vector_store.embeddings.npy", 1000),
+        ("default__vector_store.embeddings.int8.npy", 250),
+        ("default__vector_store.ids.npy", 30),
+    ]:
+        write_file(os.path.join(storage_dir, file_name), "x" * size)
+
+    assert get_signature_size(get_storage_signature(storage_dir)) == 60
+
+
+def test_invalidate(tmp_path):
+    storage_dir = make_storage(tmp_path, "a", 10)
+    cache = IndexCache(max_bytes=1000)
+    loader = CountingLoader()
+    cache.get(storage_dir, loader)
+
+    cache.invalidate(storage_dir)
+    cache.get(storage_dir, loader)
+
+    assert loader.calls == 2
+
+
+def test_storage_signature(tmp_path):
+    storage_dir = make_storage(tmp_path, "a", 10)
+    write_file(os.path.join(storage_dir, "shards", "vector_store.json"), "{}")
+
+    assert [entry[::2] for entry in get_storage_signature(storage_dir)] == [
+        ("docstore.json", 10),
+        (os.path.join("shards", "vector_store.json"), 2),
+    ]
+
+
+def test_load_index_reuses_the_created_index(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    index = rag_tools.create_index(docs_dir, storage_dir)
+
+    assert rag_tools.load_index(storage_dir) is index
+    rag_tools.index_cache.invalidate()
+    loaded = rag_tools.load_index(storage_dir)
+    assert loaded is not index
+    assert set(loaded.docstore.docs) == set(index.docstore.docs)
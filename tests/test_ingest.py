@@ -0,0 +1,107 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import utils.ingest as ingest
+from conftest import write_file
+
+
+@pytest.fixture
+def many_docs_dir(tmp_path):
+    docs_dir = str(tmp_path / "docs")
+    for idx in range(30):
+        write_file(
+            os.path.join(docs_dir, f"topic_{idx % 3}", f"file_{idx}.md"),
+            f"File {idx} is about topic {idx % 3}.",
+        )
+    return docs_dir
+
+
+def get_ingested_texts(index):
+    """The text of every indexed node, in insertion order."""
+    return [node.get_content() for node in index.docstore.docs.values()]
+
+
+def test_parallel_ingestion_matches_serial(rag_tools, many_docs_dir, tmp_path, monkeypatch):
+    # Small batches and tasks, so the workers and the embedder overlap several times
+    monkeypatch.setattr(rag_tools, "INGEST_FILES_PER_TASK", 4)
+    monkeypatch.setattr(rag_tools, "INGEST_INSERT_BATCH_SIZE", 5)
+
+    serial = rag_tools.create_index(
+        many_docs_dir, str(tmp_path / "serial"), num_workers=1
+    )
+    parallel = rag_tools.create_index(
+        many_docs_dir, str(tmp_path / "parallel"), num_workers=3
+    )
+
+    assert len(serial.docstore.docs) == 30
+    assert get_ingested_texts(parallel) == get_ingested_texts(serial)
+    manifest = rag_tools.load_json(
+        os.path.join(tmp_path, "parallel", rag_tools.INDEX_MANIFEST_FNAME)
+    )
+    assert sorted(manifest["files"]) == sorted(
+        os.path.relpath(path, many_docs_dir)
+        for path in rag_tools.list_doc_files(many_docs_dir)
+    )
+    assert {
+        node_id for entry in manifest["files"].values() for node_id in entry["node_ids"]
+    } == set(parallel.docstore.docs)
+
+
+def test_notebook_reader_is_only_fetched_for_notebooks(
+    rag_tools, docs_dir, tmp_path, monkeypatch
+):
+    def get_ipynb_reader_cls():
+        raise AssertionError("The notebook reader is downloaded from llama_hub")
+
+    monkeypatch.setattr(ingest, "get_ipynb_reader_cls", get_ipynb_reader_cls)
+
+    index = rag_tools.create_index(docs_dir, str(tmp_path / "storage"))
+
+    assert len(index.docstore.docs) == 3
+
+
+def test_worker_module_has_no_side_effects():
+    # The worker processes import utils.ingest, which must not set up the RAG tools.
+    # conftest is imported first for its offline tokenizer.
+    code = (
+        "import sys; import conftest, utils.ingest; "
+        "sys.exit('utils.rag_tools' in sys.modules)"
+    )
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+    subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        cwd=os.path.dirname(tests_dir),
+        env={**os.environ, "PYTHONPATH": tests_dir},
+    )
+
+
+def test_files_are_hashed_once(rag_tools, docs_dir, tmp_path, monkeypatch):
+    hashed_files = []
+    hash_file = ingest.hash_file
+    monkeypatch.setattr(
+        ingest,
+        "hash_file",
+        lambda path: hashed_files.append(os.path.basename(path)) or hash_file(path),
+    )
+    storage_dir = str(tmp_path / "storage")
+
+    rag_tools.create_index(docs_dir, storage_dir, num_workers=1)
+    assert sorted(hashed_files) == ["install.md", "retrievers.txt", "usage.md"]
+
+    hashed_files.clear()
+    write_file(os.path.join(docs_dir, "guides", "usage.md"), "Call the chat engine.")
+    write_file(os.path.join(docs_dir, "guides", "faq.md"), "Zebras answer questions.")
+    rag_tools.index_cache.invalidate()
+    rag_tools.refresh_index(docs_dir, storage_dir, num_workers=1)
+
+    assert sorted(hashed_files) == ["faq.md", "usage.md"]
+    manifest = rag_tools.load_json(
+        os.path.join(storage_dir, rag_tools.INDEX_MANIFEST_FNAME)
+    )
+    for rel, entry in manifest["files"].items():
+        assert entry["sha256"] == hash_file(os.path.join(docs_dir, rel))
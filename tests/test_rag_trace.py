@@ -0,0 +1,85 @@
+import json
+
+from utils.rag_trace import RAGTrace, record_llm_call, trace_stage, trace_stream
+
+
+def test_stages_are_recorded_in_start_order(tmp_path):
+    trace = RAGTrace("What is a node?", domain="llama_index")
+    with trace.stage("retrieve", candidates_in=10) as stage:
+        stage["candidates_out"] = 4
+        record_llm_call(stage, prompt_tokens=30, completion_tokens=5)
+    with trace.stage("synthesis") as stage:
+        record_llm_call(stage, prompt_tokens=100, completion_tokens=20)
+
+    trace_path = str(tmp_path / "traces" / "rag.jsonl")
+    record = trace.finish(trace_path)
+
+    assert record["domain"] == "llama_index"
+    assert [stage["stage"] for stage in record["stages"]] == ["retrieve", "synthesis"]
+    assert record["stages"][0]["candidates_in"] == 10
+    assert record["stages"][0]["candidates_out"] == 4
+    assert (record["llm_calls"], record["prompt_tokens"], record["completion_tokens"]) == (
+        2,
+        130,
+        25,
+    )
+    with open(trace_path) as f:
+        assert json.loads(f.read())["trace_id"] == record["trace_id"]
+
+
+def test_untraced_stages_only_run_the_block():
+    with trace_stage(None, "retrieve") as stage:
+        stage["candidates_out"] = 4
+
+    assert list(trace_stream(None, iter(["a", "b"]))) == ["a", "b"]
+
+
+def test_stream_stage_is_recorded_once_drained():
+    trace = RAGTrace("What is a node?")
+    tokens = trace_stream(trace, iter(["A", " chunk"]))
+    assert trace.record["stages"] == []
+
+    assert list(tokens) == ["A", " chunk"]
+
+    assert trace.record["stages"][0]["stage"] == "synthesis_stream"
+    assert trace.record["stages"][0]["chunks_out"] == 2
+
+
+def test_informed_answer_trace(rag_tools, answer_llm, docs_dir, tmp_path):
+    trace_path = str(tmp_path / "rag.jsonl")
+
+    response = rag_tools.get_informed_answer(
+        "How do I install the package?",
+        docs_dir,
+        str(tmp_path / "storage"),
+        use_answer_cache=False,
+        trace_path=trace_path,
+    )
+
+    trace = response.metadata["trace"]
+    stages = {stage["stage"]: stage for stage in trace["stages"]}
+    assert {"index_load", "embed_queries", "pack_context", "synthesis"} <= set(stages)
+    assert stages["synthesis"]["llm_calls"] == 1
+    assert stages["synthesis"]["prompt_tokens"] > 0
+    assert trace["llm_calls"] == 1
+    with open(trace_path) as f:
+        assert [json.loads(line)["trace_id"] for line in f] == [trace["trace_id"]]
+
+
+def test_streamed_answer_trace(rag_tools, answer_llm, docs_dir, tmp_path):
+    trace_path = str(tmp_path / "rag.jsonl")
+    response = rag_tools.get_informed_answer(
+        "How do I install the package?",
+        docs_dir,
+        str(tmp_path / "storage"),
+        stream=True,
+        use_answer_cache=False,
+        trace_path=trace_path,
+    )
+
+    "".join(response.response_gen)
+
+    stages = [stage["stage"] for stage in response.metadata["trace"]["stages"]]
+    assert stages[-1] == "synthesis_stream"
+    with open(trace_path) as f:
+        assert len(f.readlines()) == 1
@@ -0,0 +1,138 @@
+import os
+
+import pytest
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from conftest import EMBEDDING_DIM, write_file
+
+
+def get_indexed_texts(index):
+    """Maps the file name of every indexed node to the node texts."""
+    texts = {}
+    for node in index.docstore.docs.values():
+        texts.setdefault(node.metadata["file_name"], set()).add(node.get_content())
+    return texts
+
+
+def get_vector_node_ids(index):
+    query = VectorStoreQuery(query_embedding=[1.0] * EMBEDDING_DIM, similarity_top_k=100)
+    if hasattr(index, "get_shards"):
+        vector_stores = [shard.vector_store for shard in index.get_shards()]
+    else:
+        vector_stores = [index.vector_store]
+    return {
+        node_id
+        for vector_store in vector_stores
+        for node_id in vector_store.query(query).ids
+    }
+
+
+def change_docs(docs_dir):
+    write_file(os.path.join(docs_dir, "guides", "faq.md"), "Zebras answer questions.")
+    write_file(
+        os.path.join(docs_dir, "guides", "usage.md"),
+        "Call the chat engine to have a conversation.",
+    )
+    os.remove(os.path.join(docs_dir, "api", "retrievers.txt"))
+
+
+def assert_changes_indexed(rag_tools, storage_dir):
+    rag_tools.index_cache.invalidate()
+    index = rag_tools.load_index(storage_dir)
+    texts = get_indexed_texts(index)
+    assert texts == {
+        "install.md": {"Install the package with pip."},
+        "usage.md": {"Call the chat engine to have a conversation."},
+        "faq.md": {"Zebras answer questions."},
+    }
+    assert get_vector_node_ids(index) == set(index.docstore.docs)
+
+    nodes = rag_tools.get_retrieved_nodes(
+        "zebras", index, vector_top_k=3, rerank=False, fusion=False
+    )
+    assert nodes[0].node.metadata["file_name"] == "faq.md"
+
+
+@pytest.mark.parametrize("shard_max_bytes", [0, 80])
+def test_refresh_without_changes(rag_tools, docs_dir, tmp_path, shard_max_bytes):
+    storage_dir = str(tmp_path / "storage")
+    index = rag_tools.create_index(docs_dir, storage_dir, shard_max_bytes=shard_max_bytes)
+    node_ids = set(index.docstore.docs)
+
+    rag_tools.index_cache.invalidate()
+    index = rag_tools.refresh_index(docs_dir, storage_dir)
+
+    # Parsing the files again would have created new node ids
+    assert set(index.docstore.docs) == node_ids
+
+
+def test_refresh_index(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir)
+
+    change_docs(docs_dir)
+    rag_tools.refresh_index(docs_dir, storage_dir)
+
+    assert_changes_indexed(rag_tools, storage_dir)
+
+
+def test_refresh_sharded_index(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    index = rag_tools.create_index(docs_dir, storage_dir, shard_max_bytes=80)
+    assert len(index.shard_names) == 2
+
+    change_docs(docs_dir)
+    write_file(os.path.join(docs_dir, "tutorials", "intro.md"), "A first tutorial.")
+    index = rag_tools.refresh_index(docs_dir, storage_dir)
+
+    # Files of a new top-level directory are indexed into a new shard
+    assert len(index.shard_names) == 3
+    os.remove(os.path.join(docs_dir, "tutorials", "intro.md"))
+    rag_tools.index_cache.invalidate()
+    rag_tools.refresh_index(docs_dir, storage_dir)
+    assert_changes_indexed(rag_tools, storage_dir)
+
+
+def test_refresh_rebuilds_index_without_manifest(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir)
+    os.remove(os.path.join(storage_dir, rag_tools.INDEX_MANIFEST_FNAME))
+
+    change_docs(docs_dir)
+    rag_tools.refresh_index(docs_dir, storage_dir)
+
+    assert os.path.exists(os.path.join(storage_dir, rag_tools.INDEX_MANIFEST_FNAME))
+    assert_changes_indexed(rag_tools, storage_dir)
+
+
+def test_file_fingerprint_reuses_the_hash_of_unchanged_files(rag_tools, tmp_path):
+    path = str(tmp_path / "a.md")
+    write_file(path, "alpha")
+    fingerprint = rag_tools.get_file_fingerprint(path)
+
+    previous_entry = dict(fingerprint, sha256="previous")
+    assert rag_tools.get_file_fingerprint(path, previous_entry)["sha256"] == "previous"
+
+    write_file(path, "alpha beta")
+    assert rag_tools.get_file_fingerprint(path, previous_entry)["sha256"] not in (
+        "previous",
+        fingerprint["sha256"],
+    )
+
+
+def test_refresh_rebuilds_shard_without_manifest(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    index = rag_tools.create_index(docs_dir, storage_dir, shard_max_bytes=80)
+    node_count = len(index.docstore.docs)
+    os.remove(
+        os.path.join(
+            rag_tools.ShardedIndex.get_shard_dir(storage_dir, index.shard_names[0]),
+            rag_tools.INDEX_MANIFEST_FNAME,
+        )
+    )
+
+    rag_tools.index_cache.invalidate()
+    rag_tools.refresh_index(docs_dir, storage_dir)
+
+    rag_tools.index_cache.invalidate()
+    assert len(rag_tools.load_index(storage_dir).docstore.docs) == node_count
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+from llama_index import ServiceContext
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.schema import NodeWithScore, TextNode
+
+from conftest import RerankLLM
+from utils.rerank_cache import RerankCache
+
+NUM_NODES = 23
+
+
+def get_rating(idx):
+    return (idx * 7) % 10 + 1
+
+
+@pytest.fixture
+def rerank_llm():
+    return RerankLLM(
+        ratings={f"Document {idx}": get_rating(idx) for idx in range(NUM_NODES)}
+    )
+
+
+def make_nodes():
+    return [
+        NodeWithScore(node=TextNode(id_=f"node_{idx}", text=f"Document {idx}"), score=1.0)
+        for idx in range(NUM_NODES)
+    ]
+
+
+def get_reranker(rag_tools, rerank_llm, **kwargs):
+    return rag_tools.ModifiedLLMRerank(
+        choice_batch_size=5,
+        top_n=10,
+        service_context=ServiceContext.from_defaults(llm=rerank_llm),
+        **kwargs,
+    )
+
+
+def rerank(rag_tools, rerank_llm, **kwargs):
+    reranker = get_reranker(rag_tools, rerank_llm, **kwargs)
+    nodes = reranker.postprocess_nodes(make_nodes(), QueryBundle("Which document?"))
+    return [(node.node_id, node.score) for node in nodes]
+
+
+def arerank(rag_tools, rerank_llm, **kwargs):
+    reranker = get_reranker(rag_tools, rerank_llm, **kwargs)
+    nodes = asyncio.run(
+        reranker.apostprocess_nodes(make_nodes(), QueryBundle("Which document?"))
+    )
+    return [(node.node_id, node.score) for node in nodes]
+
+
+def test_ranking_by_rating(rag_tools, rerank_llm):
+    # Ties keep the retrieval order
+    expected = sorted(range(NUM_NODES), key=get_rating, reverse=True)[:10]
+
+    assert rerank(rag_tools, rerank_llm, max_concurrency=1) == [
+        (f"node_{idx}", get_rating(idx)) for idx in expected
+    ]
+    assert rerank_llm.calls == 5
+
+
+def test_concurrent_rerank_matches_serial(rag_tools, rerank_llm):
+    rerank_llm.latency = 0.05
+    serial = rerank(rag_tools, rerank_llm, max_concurrency=1)
+    assert rerank_llm.max_active == 1
+
+    assert rerank(rag_tools, rerank_llm, max_concurrency=4) == serial
+    assert rerank_llm.max_active > 1
+
+
+def test_async_rerank_matches_sync(rag_tools, rerank_llm):
+    rerank_llm.latency = 0.05
+    expected = rerank(rag_tools, rerank_llm, max_concurrency=1)
+
+    assert arerank(rag_tools, rerank_llm, max_concurrency=1) == expected
+    assert rerank_llm.max_active == 1
+    assert arerank(rag_tools, rerank_llm, max_concurrency=3) == expected
+    assert rerank_llm.max_active == 3
+
+
+def test_async_failed_batch_is_retried_on_its_own(rag_tools, rerank_llm):
+    expected = rerank(rag_tools, rerank_llm, max_concurrency=4)
+    rerank_llm.calls = 0
+    rerank_llm.failures = {"Document 7": 2}
+
+    assert arerank(rag_tools, rerank_llm, max_concurrency=4) == expected
+    assert rerank_llm.calls == 5 + 2
+
+
+def test_failed_batch_is_retried_on_its_own(rag_tools, rerank_llm):
+    expected = rerank(rag_tools, rerank_llm, max_concurrency=4)
+    rerank_llm.calls = 0
+    rerank_llm.failures = {"Document 7": 2}
+
+    assert rerank(rag_tools, rerank_llm, max_concurrency=4) == expected
+    assert rerank_llm.calls == 5 + 2
+
+
+def test_failing_batch_raises_after_max_retries(rag_tools, rerank_llm):
+    rerank_llm.failures = {"Document 7": 3}
+
+    with pytest.raises(ValueError):
+        rerank(rag_tools, rerank_llm, max_concurrency=4, max_retries=3)
+
+
+def test_cached_scores_are_not_reranked_again(rag_tools, rerank_llm, tmp_path):
+    rerank_cache = RerankCache(str(tmp_path / "rerank.sqlite"), ttl=3600)
+    expected = rerank(rag_tools, rerank_llm, rerank_cache=rerank_cache)
+    rerank_llm.calls = 0
+
+    assert rerank(rag_tools, rerank_llm, rerank_cache=rerank_cache) == expected
+    assert rerank_llm.calls == 0
+    # Another query context is another question for the LLM
+    rerank(rag_tools, rerank_llm, rerank_cache=rerank_cache, query_context="Other")
+    assert rerank_llm.calls == 5
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from utils.rerank_cache import RerankCache, normalize_query
+
+SCORER = RerankCache.make_scorer_hash("gpt-3.5-turbo", "Rate {context_str}")
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return RerankCache(str(tmp_path / "rerank.sqlite"), ttl=3600)
+
+
+def make_key(query="What is a node?", node_id="node", scorer=SCORER):
+    return RerankCache.make_key(scorer, query, "llama_index", node_id, "A node.")
+
+
+def test_normalize_query():
+    assert normalize_query("  What IS a\tnode?? ") == "what is a node"
+
+
+def test_get_many_returns_stored_scores(cache):
+    cache.set_many({make_key(node_id="a"): 8.0, make_key(node_id="b"): None})
+
+    assert cache.get_many([make_key(node_id="a"), make_key(node_id="b"), make_key()]) == {
+        make_key(node_id="a"): 8.0,
+        make_key(node_id="b"): None,
+    }
+    # Trivially different phrasings share scores
+    assert cache.get_many([make_key("what is a node", "a")]) == {
+        make_key(node_id="a"): 8.0
+    }
+
+
+def test_scores_are_keyed_by_scorer(cache):
+    cache.set_many({make_key(): 8.0})
+    other_scorer = RerankCache.make_scorer_hash("gpt-4", "Rate {context_str}")
+
+    assert cache.get_many([make_key(scorer=other_scorer)]) == {}
+
+
+def test_get_many_with_more_keys_than_a_lookup_batch(cache):
+    scores = {make_key(node_id=f"node_{idx}"): float(idx) for idx in range(400)}
+    cache.set_many(scores)
+
+    assert cache.get_many(scores) == scores
+
+
+def test_expired_scores_are_not_returned(tmp_path):
+    cache = RerankCache(str(tmp_path / "rerank.sqlite"), ttl=0.05)
+    cache.set_many({make_key(): 8.0})
+    assert cache.get_many([make_key()]) == {make_key(): 8.0}
+
+    time.sleep(0.1)
+
+    assert cache.get_many([make_key()]) == {}
+
+
+def test_clear(cache):
+    cache.set_many({make_key(): 8.0})
+    cache.clear()
+    assert cache.get_many([make_key()]) == {}
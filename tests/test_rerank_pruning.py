@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+from llama_index.schema import NodeWithScore, TextNode
+
+from utils.rag_tools import prune_rerank_candidates
+from utils.vector_stores import NumpyVectorStore
+
+EMBEDDINGS = {
+    "install": [1.0, 0.0, 0.0],
+    "install_copy": [1.0, 0.01, 0.0],
+    "install_upgrade": [0.8, 0.6, 0.0],
+    "query": [0.0, 0.0, 1.0],
+}
+
+
+def make_index():
+    store = NumpyVectorStore()
+    store.add(
+        [
+            TextNode(id_=node_id, text=node_id, embedding=embedding)
+            for node_id, embedding in EMBEDDINGS.items()
+        ]
+    )
+    return SimpleNamespace(vector_store=store)
+
+
+def candidates(*node_ids):
+    return [
+        NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=1.0 - 0.1 * rank)
+        for rank, node_id in enumerate(node_ids)
+    ]
+
+
+def test_near_duplicates_are_collapsed():
+    nodes = candidates("install", "install_copy", "install_upgrade", "query")
+
+    kept = prune_rerank_candidates(make_index(), nodes, candidate_budget=10)
+
+    assert kept[0].node.node_id == "install"
+    assert {node.node.node_id for node in kept} == {"install", "install_upgrade", "query"}
+
+
+def test_budget_prefers_diverse_candidates():
+    nodes = candidates("install", "install_upgrade", "query")
+
+    kept = prune_rerank_candidates(make_index(), nodes, candidate_budget=2)
+
+    assert [node.node.node_id for node in kept] == ["install", "query"]
+    # Without a diversity weight the candidates are kept by relevance
+    kept = prune_rerank_candidates(make_index(), nodes, candidate_budget=2, mmr_lambda=1)
+    assert [node.node.node_id for node in kept] == ["install", "install_upgrade"]
+
+
+def test_nodes_without_embeddings_are_kept():
+    nodes = candidates("install", "missing", "other_missing")
+
+    kept = prune_rerank_candidates(make_index(), nodes, candidate_budget=10)
+
+    assert len(kept) == 3
+    assert prune_rerank_candidates(make_index(), [], candidate_budget=10) == []
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from conftest import HashEmbedding
+
+VARIATIONS = ["install with pip", "ask the query engine", "top nodes of a retriever"]
+
+
+@pytest.fixture(params=["numpy", "simple"])
+def vector_store_backend(request):
+    return request.param
+
+
+@pytest.fixture
+def index(rag_tools, docs_dir, tmp_path, monkeypatch, vector_store_backend):
+    monkeypatch.setattr(
+        rag_tools, "rag_fusion", lambda query, *args, **kwargs: list(VARIATIONS)
+    )
+    return rag_tools.create_index(
+        docs_dir, str(tmp_path / "storage"), vector_store_backend=vector_store_backend
+    )
+
+
+def get_node_ids(rag_tools, index, **kwargs):
+    nodes = rag_tools.get_retrieved_nodes(
+        "How do I install it?", index, vector_top_k=12, rerank=False, **kwargs
+    )
+    return [node.node_id for node in nodes]
+
+
+def get_node_scores(rag_tools, index):
+    nodes = rag_tools.get_retrieved_nodes(
+        "How do I install it?", index, vector_top_k=12, rerank=False, fusion=True
+    )
+    return [(node.node_id, round(node.score, 6)) for node in nodes]
+
+
+def test_concurrent_fusion_matches_serial(rag_tools, index):
+    serial = get_node_ids(rag_tools, index, fusion=True, fusion_concurrency=1)
+
+    assert get_node_ids(rag_tools, index, fusion=True, fusion_concurrency=4) == serial
+    assert set(serial) == set(index.docstore.docs)
+
+
+@pytest.mark.parametrize("vector_store_backend", ["simple"])
+def test_variations_are_retrieved_in_parallel(rag_tools, index, monkeypatch):
+    # Every variation waits for all the others, which only returns if they run at once
+    barrier = threading.Barrier(len(VARIATIONS) + 1, timeout=10)
+    retrieve_variation_nodes = rag_tools.retrieve_variation_nodes
+
+    def retrieve(*args, **kwargs):
+        barrier.wait()
+        return retrieve_variation_nodes(*args, **kwargs)
+
+    monkeypatch.setattr(rag_tools, "retrieve_variation_nodes", retrieve)
+
+    assert get_node_ids(rag_tools, index, fusion=True, fusion_concurrency=4)
+
+
+@pytest.mark.parametrize("vector_store_backend", ["numpy"])
+def test_variations_are_searched_together(rag_tools, index, monkeypatch):
+    # The same index, searched one variation at a time
+    can_search_variations = rag_tools.can_search_variations
+    monkeypatch.setattr(rag_tools, "can_search_variations", lambda index: False)
+    expected = get_node_scores(rag_tools, index)
+    monkeypatch.setattr(rag_tools, "can_search_variations", can_search_variations)
+
+    def retrieve_variation_nodes(*args, **kwargs):
+        raise AssertionError("The variations should be searched in one pass")
+
+    monkeypatch.setattr(rag_tools, "retrieve_variation_nodes", retrieve_variation_nodes)
+    assert get_node_scores(rag_tools, index) == expected
+
+
+def test_variations_are_embedded_in_one_batch(rag_tools, index, monkeypatch):
+    batches = []
+    embed_queries = rag_tools.embed_queries
+
+    def embed(index, queries, *args, **kwargs):
+        batches.append(list(queries))
+        return embed_queries(index, queries, *args, **kwargs)
+
+    def embed_query(self, query):
+        raise AssertionError("The retrievers should reuse the batched embeddings")
+
+    monkeypatch.setattr(rag_tools, "embed_queries", embed)
+    monkeypatch.setattr(HashEmbedding, "_get_query_embedding", embed_query)
+
+    assert get_node_ids(rag_tools, index, fusion=True)
+    assert batches == [VARIATIONS + ["How do I install it?"]]
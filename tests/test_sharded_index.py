@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+from conftest import write_file
+from utils.sharded_index import ShardedIndex, plan_shards
+
+
+def write_sized_file(docs_dir, path, size):
+    path = os.path.join(docs_dir, path)
+    write_file(path, "x" * size)
+    return path
+
+
+def test_plan_packs_whole_top_level_dirs(tmp_path):
+    docs_dir = str(tmp_path)
+    files = [
+        write_sized_file(docs_dir, "a/1.md", 40),
+        write_sized_file(docs_dir, "a/2.md", 40),
+        write_sized_file(docs_dir, "b/1.md", 20),
+        write_sized_file(docs_dir, "c/1.md", 50),
+        write_sized_file(docs_dir, "d/1.md", 60),
+        write_sized_file(docs_dir, "d/2.md", 60),
+        write_sized_file(docs_dir, "d/3.md", 20),
+    ]
+
+    shards = plan_shards(docs_dir, files, max_shard_bytes=100)
+
+    assert [shard["dirs"] for shard in shards] == [["a", "b"], ["c"], ["d"], ["d"]]
+    # An oversized directory is split in file order
+    assert [shard["files"] for shard in shards[2:]] == [files[4:5], files[5:]]
+
+
+def get_results(rag_tools, index, query):
+    nodes = rag_tools.get_retrieved_nodes(
+        query, index, vector_top_k=3, rerank=False, fusion=False
+    )
+    return [(node.node.metadata["file_name"], round(node.score, 6)) for node in nodes]
+
+
+def test_sharded_index_matches_single_index(rag_tools, docs_dir, tmp_path):
+    index = rag_tools.create_index(docs_dir, str(tmp_path / "single"), shard_max_bytes=0)
+    sharded_dir = str(tmp_path / "sharded")
+    rag_tools.create_index(docs_dir, sharded_dir, shard_max_bytes=80)
+    rag_tools.index_cache.invalidate()
+
+    sharded_index = rag_tools.load_index(sharded_dir)
+
+    assert isinstance(sharded_index, ShardedIndex)
+    # Opening a sharded index only reads its manifest
+    assert sharded_index.get_loaded_shards() == {}
+    for query in ["install with pip", "retrievers fetch nodes", "query engine"]:
+        assert get_results(rag_tools, sharded_index, query) == get_results(
+            rag_tools, index, query
+        )
+    assert len(sharded_index.get_loaded_shards()) == 2
+    # Node lookups are routed to the shard holding the node
+    node_id = next(iter(sharded_index.get_shards()[1].docstore.docs))
+    assert sharded_index.docstore.get_node(node_id).node_id == node_id
+
+
+def test_node_lookups_load_only_the_shard_of_the_node(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir, shard_max_bytes=80)
+    write_file(os.path.join(docs_dir, "tutorials", "intro.md"), "A first tutorial.")
+    rag_tools.index_cache.invalidate()
+    index = rag_tools.refresh_index(docs_dir, storage_dir)
+    node_ids = {
+        shard_name: list(index.get_shard(shard_name).docstore.docs)
+        for shard_name in index.shard_names
+    }
+    rag_tools.index_cache.invalidate()
+
+    for shard_name in index.shard_names:
+        sharded_index = rag_tools.load_index(storage_dir)
+        node_id = node_ids[shard_name][0]
+
+        assert sharded_index.docstore.get_node(node_id).node_id == node_id
+        assert sharded_index.vector_store.get(node_id)
+        assert list(sharded_index.get_loaded_shards()) == [shard_name]
+        rag_tools.index_cache.invalidate()
+
+    sharded_index = rag_tools.load_index(storage_dir)
+    assert sharded_index.docstore.get_node("missing", raise_error=False) is None
+    assert sharded_index.get_loaded_shards() == {}
+
+
+@pytest.mark.parametrize("backend", ["numpy", "simple"])
+def test_variation_search_check_loads_no_shard(rag_tools, docs_dir, tmp_path, backend):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(
+        docs_dir, storage_dir, shard_max_bytes=80, vector_store_backend=backend
+    )
+    rag_tools.index_cache.invalidate()
+    index = rag_tools.load_index(storage_dir)
+
+    assert rag_tools.can_search_variations(index) == (backend == "numpy")
+    assert index.get_loaded_shards() == {}
+
+
+def test_variation_search_loads_shards_when_searching(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir, shard_max_bytes=80)
+    rag_tools.index_cache.invalidate()
+    index = rag_tools.load_index(storage_dir)
+    queries = ["install with pip", "query engine"]
+
+    results = rag_tools.search_variation_nodes(
+        index, queries, rag_tools.embed_queries(index, queries), similarity_top_k=2
+    )
+
+    assert len(index.get_loaded_shards()) == 2
+    assert results[0][0].node.metadata["file_name"] == "install.md"
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from utils.answer_cache import AnswerCache
+
+
+@pytest.fixture
+def storage_dir(rag_tools, docs_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        rag_tools,
+        "answer_cache",
+        AnswerCache(str(tmp_path / "answers.sqlite"), ttl=3600, max_entries=10),
+    )
+    return str(tmp_path / "storage")
+
+
+def test_stream_yields_the_answer_token_by_token(
+    rag_tools, answer_llm, docs_dir, storage_dir
+):
+    response = rag_tools.get_informed_answer(
+        "How do I install the package?", docs_dir, storage_dir, stream=True
+    )
+
+    tokens = list(response.response_gen)
+    assert tokens == ["Install", " the", " package", " with", " pip."]
+    assert response.source_nodes
+
+
+def test_streamed_answer_is_cached_once_drained(
+    rag_tools, answer_llm, docs_dir, storage_dir
+):
+    def ask():
+        return rag_tools.get_informed_answer(
+            "How do I install the package?",
+            docs_dir,
+            storage_dir,
+            stream=True,
+            use_answer_cache=True,
+        )
+
+    response = ask()
+    assert next(response.response_gen) == "Install"
+    # Until the answer is complete it is not cached, the next question is synthesized
+    assert "".join(ask().response_gen) == answer_llm.answer
+    assert len(answer_llm.prompts) == 2
+    "".join(response.response_gen)
+
+    # A cache hit streams the whole answer at once
+    assert list(ask().response_gen) == [answer_llm.answer]
+    assert len(answer_llm.prompts) == 2
+
+
+def test_stream_without_nodes(
+    rag_tools, answer_llm, docs_dir, storage_dir, monkeypatch
+):
+    monkeypatch.setattr(rag_tools, "get_retrieved_nodes", lambda *args, **kwargs: [])
+
+    response = rag_tools.get_informed_answer(
+        "How do I install the package?", docs_dir, storage_dir, stream=True
+    )
+
+    assert list(response.response_gen) == ["Empty Response"]
+    assert response.metadata["trace"]["stages"][-1]["stage"] == "synthesis_stream"
+    assert answer_llm.prompts == []
+
+
+def test_iter_informed_answer(rag_tools, answer_llm, docs_dir, storage_dir):
+    tokens = rag_tools.iter_informed_answer(
+        "How do I install the package?", docs_dir, storage_dir
+    )
+
+    assert "".join(tokens) == answer_llm.answer
+
+
+def test_async_iter_informed_answer(rag_tools, answer_llm, docs_dir, storage_dir):
+    async def collect():
+        return [
+            token
+            async for token in rag_tools.a_iter_informed_answer(
+                "How do I install the package?", docs_dir, storage_dir
+            )
+        ]
+
+    assert asyncio.run(collect()) == ["Install", " the", " package", " with", " pip."]
+
+
+def test_async_iter_informed_answer_raises_errors(rag_tools, docs_dir, storage_dir):
+    async def collect():
+        return [
+            token
+            async for token in rag_tools.a_iter_informed_answer(
+                "How do I install the package?", docs_dir, storage_dir, domain="missing"
+            )
+        ]
+
+    with pytest.raises(Exception):
+        asyncio.run(collect())
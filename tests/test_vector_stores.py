@@ -0,0 +1,203 @@
+import os
+
+import numpy as np
+import pytest
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.vector_stores import SimpleVectorStore
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from conftest import write_file
+from utils.vector_stores import NumpyVectorStore, measure_recall
+
+
+def make_nodes(embeddings, ref_doc_id="doc", prefix="node"):
+    return [
+        TextNode(
+            id_=f"{prefix}_{i}",
+            text=f"text {i}",
+            embedding=list(embedding),
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=ref_doc_id)},
+        )
+        for i, embedding in enumerate(embeddings)
+    ]
+
+
+def random_embeddings(num, dim=32, seed=0):
+    return np.random.default_rng(seed).normal(size=(num, dim)).astype(np.float32)
+
+
+def persist(store, persist_dir):
+    store.persist(os.path.join(persist_dir, "default__vector_store.json"))
+
+
+def query_ids(store, query_embedding, top_k=10):
+    query = VectorStoreQuery(query_embedding=list(query_embedding), similarity_top_k=top_k)
+    return store.query(query).ids
+
+
+def test_add_and_query():
+    store = NumpyVectorStore()
+    store.add(make_nodes([[1, 0, 0], [0, 1, 0], [0.9, 0.1, 0]]))
+
+    result = store.query(
+        VectorStoreQuery(query_embedding=[1, 0, 0], similarity_top_k=2)
+    )
+
+    assert result.ids == ["node_0", "node_2"]
+    assert result.similarities[0] == pytest.approx(1.0)
+    assert store.get("node_1") == [0.0, 1.0, 0.0]
+
+
+def test_similarities_match_simple_vector_store():
+    nodes = make_nodes(random_embeddings(100))
+    store = NumpyVectorStore()
+    store.add(nodes)
+    simple_store = SimpleVectorStore()
+    simple_store.add(nodes)
+    query = VectorStoreQuery(
+        query_embedding=random_embeddings(1, seed=1)[0].tolist(), similarity_top_k=10
+    )
+
+    result = store.query(query)
+    expected = simple_store.query(query)
+
+    assert result.ids == expected.ids
+    np.testing.assert_allclose(result.similarities, expected.similarities, rtol=1e-5)
+
+
+def test_delete_removes_the_rows_of_a_document():
+    store = NumpyVectorStore()
+    store.add(make_nodes([[1, 0], [0, 1]], ref_doc_id="a", prefix="a"))
+    store.add(make_nodes([[1, 1]], ref_doc_id="b", prefix="b"))
+
+    store.delete("a")
+
+    assert query_ids(store, [1, 0]) == ["b_0"]
+
+
+@pytest.mark.parametrize("quantization", [None, "float16", "int8"])
+def test_persist_and_reopen(tmp_path, quantization):
+    embeddings = random_embeddings(50)
+    store = NumpyVectorStore(quantization=quantization)
+    store.add(make_nodes(embeddings))
+    persist(store, str(tmp_path))
+
+    assert NumpyVectorStore.exists(str(tmp_path))
+    assert NumpyVectorStore.get_persisted_quantization(str(tmp_path)) == quantization
+    reopened = NumpyVectorStore.from_persist_dir(str(tmp_path))
+    assert reopened.quantization == quantization
+    assert reopened.get_node_ids() == store.get_node_ids()
+    np.testing.assert_allclose(reopened.get("node_7"), embeddings[7], rtol=1e-6)
+    assert query_ids(reopened, embeddings[3]) == query_ids(store, embeddings[3])
+
+
+def test_delete_after_reopen_is_persisted(tmp_path):
+    store = NumpyVectorStore()
+    store.add(make_nodes(random_embeddings(3), ref_doc_id="a", prefix="a"))
+    store.add(make_nodes(random_embeddings(2, seed=1), ref_doc_id="b", prefix="b"))
+    persist(store, str(tmp_path))
+
+    store = NumpyVectorStore.from_persist_dir(str(tmp_path))
+    store.delete("a")
+    persist(store, str(tmp_path))
+
+    reopened = NumpyVectorStore.from_persist_dir(str(tmp_path))
+    assert sorted(query_ids(reopened, random_embeddings(1, seed=2)[0])) == [
+        "b_0",
+        "b_1",
+    ]
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8"])
+def test_quantized_recall(quantization):
+    store = NumpyVectorStore(quantization=quantization)
+    store.add(make_nodes(random_embeddings(2000)))
+    queries = random_embeddings(20, seed=1)
+
+    assert measure_recall([store], queries.tolist(), top_k=10) >= 0.95
+    # Rescoring returns the exact float32 similarities
+    rows, similarities = store.search(queries[0], top_k=10)
+    exact_rows, exact_similarities = store.search(queries[0], top_k=10, exact=True)
+    matching = np.isin(rows, exact_rows)
+    np.testing.assert_allclose(
+        similarities[matching],
+        exact_similarities[np.isin(exact_rows, rows)],
+        rtol=1e-5,
+    )
+
+
+def test_quantized_scan_reads_less_memory_from_more_disk():
+    embeddings = random_embeddings(100, dim=64)
+    usage = {}
+    for quantization in [None, "float16", "int8"]:
+        store = NumpyVectorStore(quantization=quantization)
+        store.add(make_nodes(embeddings))
+        usage[quantization] = store.get_memory_usage()
+
+    float32_bytes = 100 * 64 * 4
+    assert usage[None]["scan_bytes"] == usage[None]["float32_bytes"] == float32_bytes
+    assert usage["float16"]["scan_bytes"] == 100 * 64 * 2
+    # int8 rows plus a float32 scale per row
+    assert usage["int8"]["scan_bytes"] == 100 * 64 + 100 * 4
+    # The float32 embeddings are kept on disk for rescoring
+    assert usage[None]["disk_bytes"] == float32_bytes
+    for quantization in ["float16", "int8"]:
+        assert usage[quantization]["disk_bytes"] == (
+            float32_bytes + usage[quantization]["scan_bytes"]
+        )
+
+
+@pytest.mark.parametrize("backend", ["numpy", "simple"])
+def test_index_backends(rag_tools, docs_dir, tmp_path, backend):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir, vector_store_backend=backend)
+    rag_tools.index_cache.invalidate()
+
+    index = rag_tools.load_index(storage_dir)
+
+    assert isinstance(index.vector_store, NumpyVectorStore) == (backend == "numpy")
+    nodes = rag_tools.get_retrieved_nodes(
+        "install pip", index, vector_top_k=1, rerank=False, fusion=False
+    )
+    assert nodes[0].node.metadata["file_name"] == "install.md"
+
+
+def test_index_keeps_its_quantization(rag_tools, docs_dir, tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    rag_tools.create_index(docs_dir, storage_dir, embedding_quantization="int8")
+    write_file(os.path.join(docs_dir, "guides", "faq.md"), "Zebras answer questions.")
+    rag_tools.index_cache.invalidate()
+
+    index = rag_tools.refresh_index(docs_dir, storage_dir)
+
+    assert index.vector_store.quantization == "int8"
+    assert len(index.vector_store.get_node_ids()) == 4
+    nodes = rag_tools.get_retrieved_nodes(
+        "zebras", index, vector_top_k=1, rerank=False, fusion=False
+    )
+    assert nodes[0].node.metadata["file_name"] == "faq.md"
+
+
+@pytest.mark.parametrize("quantization", [None, "int8"])
+def test_search_many_matches_search(quantization):
+    store = NumpyVectorStore(quantization=quantization)
+    store.add(make_nodes(random_embeddings(300)))
+    queries = random_embeddings(4, seed=2)
+
+    results = store.search_many(queries.tolist(), top_k=8)
+
+    assert len(results) == len(queries)
+    for query, (rows, similarities) in zip(queries, results):
+        expected_rows, expected_similarities = store.search(query, top_k=8)
+        np.testing.assert_array_equal(rows, expected_rows)
+        np.testing.assert_allclose(similarities, expected_similarities, rtol=1e-6)
+
+
+def test_search_many_restricted_rows():
+    store = NumpyVectorStore()
+    store.add(make_nodes(random_embeddings(20)))
+    rows = np.array([3, 5, 8])
+
+    (top_rows, _), = store.search_many(random_embeddings(1, seed=3).tolist(), 10, rows)
+
+    assert store.get_row_ids(sorted(top_rows)) == ["node_3", "node_5", "node_8"]
@@ -0,0 +1,176 @@
+"""
+This file contains a persistent (SQLite) semantic cache of synthesized answers.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerCache:
+    """
+    A disk-backed cache of synthesized answers matched by question embedding similarity.
+
+    Entries are grouped by scope (e.g. a domain index and the retrieval settings) and
+    by index version, so an answer is only reused while the index it was synthesized
+    from is unchanged. Entries expire after ttl seconds, and the least recently used
+    entries are evicted once there are more than max_entries.
+    """
+
+    def __init__(self, db_path: str, ttl: float, max_entries: int):
+        """
+        Initialize the AnswerCache. The database is opened on first use.
+
+        Args:
+            db_path (str): The path of the SQLite database file.
+            ttl (float): The number of seconds an answer stays valid.
+            max_entries (int): The maximum number of cached answers across all scopes.
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "scope TEXT NOT NULL, "
+                "index_version TEXT NOT NULL, "
+                "question TEXT NOT NULL, "
+                "embedding BLOB NOT NULL, "
+                "answer TEXT NOT NULL, "
+                "source_nodes TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "last_used_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS answers_scope ON answers (scope, index_version)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def lookup(
+        self,
+        scope: str,
+        index_version: str,
+        embedding: List[float],
+        similarity_threshold: float,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Finds the cached answer to the most similar question.
+
+        Args:
+            scope (str): The scope of the question.
+            index_version (str): The version of the index the answer must come from.
+            embedding (List[float]): The embedding of the question.
+            similarity_threshold (float): The minimum cosine similarity to the cached question.
+
+        Returns:
+            Optional[Dict[str, Any]]: The "question", "answer", "source_nodes" (list of (node_id, score)) and "similarity" of the best match, or None.
+        """
+        with self._lock:
+            conn = self._connect()
+            self._expire(conn)
+            rows = conn.execute(
+                "SELECT id, question, embedding, answer, source_nodes FROM answers "
+                "WHERE scope = ? AND index_version = ?",
+                (scope, index_version),
+            ).fetchall()
+            if not rows:
+                return None
+
+            embeddings = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+            query = np.asarray(embedding, dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1) * (np.linalg.norm(query) or 1.0)
+            similarities = (embeddings @ query) / np.where(norms == 0, 1.0, norms)
+            best = int(np.argmax(similarities))
+            if similarities[best] < similarity_threshold:
+                return None
+
+            entry_id, question, _, answer, source_nodes = rows[best]
+            conn.execute(
+                "UPDATE answers SET last_used_at = ? WHERE id = ?", (time.time(), entry_id)
+            )
+            conn.commit()
+            return {
+                "question": question,
+                "answer": answer,
+                "source_nodes": [tuple(item) for item in json.loads(source_nodes)],
+                "similarity": float(similarities[best]),
+            }
+
+    def put(
+        self,
+        scope: str,
+        index_version: str,
+        question: str,
+        embedding: List[float],
+        answer: str,
+        source_nodes: List[Tuple[str, Optional[float]]],
+    ) -> None:
+        """
+        Stores an answer, dropping answers of older index versions in the same scope.
+
+        Args:
+            scope (str): The scope of the question.
+            index_version (str): The version of the index the answer was synthesized from.
+            question (str): The question.
+            embedding (List[float]): The embedding of the question.
+            answer (str): The synthesized answer.
+            source_nodes (List[Tuple[str, Optional[float]]]): The (node_id, score) of each source node.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM answers WHERE scope = ? AND index_version != ?",
+                (scope, index_version),
+            )
+            conn.execute(
+                "INSERT INTO answers (scope, index_version, question, embedding, answer, "
+                "source_nodes, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    scope,
+                    index_version,
+                    question,
+                    np.asarray(embedding, dtype=np.float32).tobytes(),
+                    answer,
+                    json.dumps(source_nodes),
+                    now,
+                    now,
+                ),
+            )
+            self._expire(conn)
+            conn.execute(
+                "DELETE FROM answers WHERE id NOT IN "
+                "(SELECT id FROM answers ORDER BY last_used_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            conn.commit()
+
+    def _expire(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl,))
+
+    def clear(self) -> None:
+        """
+        Removes every cached answer.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM answers")
+            conn.commit()
@@ -0,0 +1,315 @@
+"""
+This file contains a compact on-disk BM25 inverted index for lexical retrieval over index nodes.
+"""
+
+import os
+import re
+import math
+import logging
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BM25_INDEX_FNAME = "bm25.npz"
+
+# Longer tokens are almost always encoded blobs (base64, hashes), not identifiers
+MAX_TOKEN_LENGTH = 64
+
+WORD_PATTERN = re.compile(r"[A-Za-z0-9_]+")
+SUBWORD_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase lexical terms, keeping code identifiers searchable.
+
+    Each identifier is kept whole and is also split on underscores and camelCase, so
+    "load_index_from_storage" and "VectorStoreIndex" match both the exact identifier
+    and its parts.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        List[str]: The terms, in order of appearance.
+    """
+    terms = []
+    for word in WORD_PATTERN.findall(text):
+        if len(word) > MAX_TOKEN_LENGTH:
+            continue
+        lower_word = word.lower()
+        if len(lower_word) > 1:
+            terms.append(lower_word)
+        subwords = [
+            subword.lower()
+            for part in word.split("_")
+            for subword in SUBWORD_PATTERN.findall(part)
+        ]
+        if len(subwords) > 1:
+            terms.extend(subword for subword in subwords if len(subword) > 1)
+    return terms
+
+
+class BM25Index:
+    """
+    A BM25 inverted index stored as flat numpy arrays.
+
+    The vocabulary is a sorted array of (ASCII) terms stored as bytes, and postings are
+    kept in CSR layout: the postings of the term at vocabulary position i are
+    doc_ids[indptr[i]:indptr[i + 1]] with term frequencies in tfs. Queries only touch
+    the postings of their own terms.
+    """
+
+    def __init__(
+        self,
+        node_ids: np.ndarray,
+        doc_lengths: np.ndarray,
+        vocab: np.ndarray,
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        """
+        Initialize the BM25Index.
+
+        Args:
+            node_ids (np.ndarray): The node id of each indexed document.
+            doc_lengths (np.ndarray): The number of terms in each document.
+            vocab (np.ndarray): The sorted vocabulary.
+            indptr (np.ndarray): The start of each term's postings, plus the total number of postings.
+            doc_ids (np.ndarray): The document of each posting.
+            tfs (np.ndarray): The term frequency of each posting.
+            k1 (float): The BM25 term frequency saturation.
+            b (float): The BM25 document length normalization.
+        """
+        self.node_ids = node_ids
+        self.doc_lengths = doc_lengths
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[Tuple[str, str]], **kwargs) -> "BM25Index":
+        """
+        Builds an index over (node_id, text) pairs.
+
+        Args:
+            texts (Iterable[Tuple[str, str]]): The node id and text of each document.
+            **kwargs: Additional BM25 parameters (k1, b).
+
+        Returns:
+            BM25Index: The built index.
+        """
+        node_ids = []
+        doc_lengths = []
+        term_ids = {}
+        posting_terms = []
+        posting_docs = []
+        posting_tfs = []
+        for doc, (node_id, text) in enumerate(texts):
+            counts = Counter(tokenize(text))
+            node_ids.append(node_id)
+            doc_lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+                posting_docs.append(doc)
+                posting_tfs.append(tf)
+
+        vocab = sorted(term_ids)
+        # Renumber terms in vocabulary order, then group postings by term
+        term_rank = np.empty(len(vocab), dtype=np.int64)
+        for rank, term in enumerate(vocab):
+            term_rank[term_ids[term]] = rank
+        terms = term_rank[np.asarray(posting_terms, dtype=np.int64)]
+        docs = np.asarray(posting_docs, dtype=np.int32)
+        order = np.lexsort((docs, terms))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocab)), out=indptr[1:])
+
+        return cls(
+            node_ids=np.array(node_ids, dtype=str),
+            doc_lengths=np.asarray(doc_lengths, dtype=np.int32),
+            vocab=np.array(vocab, dtype=bytes),
+            indptr=indptr,
+            doc_ids=docs[order],
+            tfs=np.minimum(np.asarray(posting_tfs, dtype=np.int64)[order], 65535).astype(
+                np.uint16
+            ),
+            **kwargs,
+        )
+
+    def update(
+        self, deleted_node_ids: Iterable[str], texts: Iterable[Tuple[str, str]]
+    ) -> "BM25Index":
+        """
+        Builds a copy of the index without some documents and with new ones added.
+
+        Only the new texts are tokenized. The postings of the kept documents are
+        renumbered and merged with the postings of the new documents, so updating the
+        index after a few files changed does not re-read every node.
+
+        Args:
+            deleted_node_ids (Iterable[str]): The node ids of the documents to remove.
+            texts (Iterable[Tuple[str, str]]): The node id and text of each document to add.
+
+        Returns:
+            BM25Index: The updated index. This index is left unchanged.
+        """
+        added = BM25Index.from_texts(texts, k1=self.k1, b=self.b)
+        keep = ~np.isin(self.node_ids, np.array(list(deleted_node_ids), dtype=str))
+        num_kept = int(keep.sum())
+        # New position of every kept document
+        kept_docs = np.cumsum(keep) - 1
+
+        vocab = np.union1d(self.vocab, added.vocab)
+        postings_kept = keep[self.doc_ids]
+        terms = np.concatenate(
+            [
+                self._get_posting_terms(vocab)[postings_kept],
+                added._get_posting_terms(vocab),
+            ]
+        )
+        docs = np.concatenate(
+            [kept_docs[self.doc_ids[postings_kept]], added.doc_ids + num_kept]
+        ).astype(np.int32)
+        tfs = np.concatenate([self.tfs[postings_kept], added.tfs])
+
+        # Terms of removed documents only are dropped from the vocabulary
+        counts = np.bincount(terms, minlength=len(vocab))
+        used_terms = counts > 0
+        term_rank = np.cumsum(used_terms) - 1
+        terms = term_rank[terms]
+        order = np.lexsort((docs, terms))
+        indptr = np.zeros(int(used_terms.sum()) + 1, dtype=np.int64)
+        np.cumsum(counts[used_terms], out=indptr[1:])
+
+        return BM25Index(
+            node_ids=np.concatenate([self.node_ids[keep], added.node_ids]).astype(str),
+            doc_lengths=np.concatenate(
+                [self.doc_lengths[keep], added.doc_lengths]
+            ).astype(np.int32),
+            vocab=vocab[used_terms],
+            indptr=indptr,
+            doc_ids=docs[order],
+            tfs=tfs[order],
+            k1=self.k1,
+            b=self.b,
+        )
+
+    def _get_posting_terms(self, vocab: np.ndarray) -> np.ndarray:
+        # The position in vocab of the term of every posting
+        return np.repeat(
+            np.searchsorted(vocab, self.vocab), np.diff(self.indptr)
+        ).astype(np.int64)
+
+    @staticmethod
+    def get_path(storage_dir: str) -> str:
+        """
+        Returns the path of the persisted index in a storage directory.
+
+        Args:
+            storage_dir (str): The directory the vector index is persisted in.
+
+        Returns:
+            str: The index file path.
+        """
+        return os.path.join(storage_dir, BM25_INDEX_FNAME)
+
+    @classmethod
+    def exists(cls, storage_dir: str) -> bool:
+        """
+        Checks whether a BM25 index is persisted in a storage directory.
+
+        Args:
+            storage_dir (str): The directory to check.
+
+        Returns:
+            bool: True if the index file exists.
+        """
+        return os.path.exists(cls.get_path(storage_dir))
+
+    @classmethod
+    def load(cls, storage_dir: str) -> "BM25Index":
+        """
+        Loads a persisted index.
+
+        Args:
+            storage_dir (str): The directory the index is persisted in.
+
+        Returns:
+            BM25Index: The loaded index.
+        """
+        with np.load(cls.get_path(storage_dir)) as data:
+            arrays = {name: data[name] for name in data.files}
+        k1, b = arrays.pop("params").tolist()
+        return cls(k1=k1, b=b, **arrays)
+
+    def persist(self, storage_dir: str) -> None:
+        """
+        Saves the index to a storage directory.
+
+        Args:
+            storage_dir (str): The directory to save the index in.
+        """
+        os.makedirs(storage_dir, exist_ok=True)
+        path = self.get_path(storage_dir)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                node_ids=self.node_ids,
+                doc_lengths=self.doc_lengths,
+                vocab=self.vocab,
+                indptr=self.indptr,
+                doc_ids=self.doc_ids,
+                tfs=self.tfs,
+                params=np.array([self.k1, self.b]),
+            )
+        os.replace(tmp_path, path)
+
+    def query(self, query_str: str, top_k: int) -> List[Tuple[str, float]]:
+        """
+        Finds the documents with the highest BM25 score for a query.
+
+        Args:
+            query_str (str): The query text.
+            top_k (int): The maximum number of documents to return.
+
+        Returns:
+            List[Tuple[str, float]]: The (node_id, score) of the top documents with a positive score, best first.
+        """
+        num_docs = len(self.node_ids)
+        terms = np.array(sorted(set(tokenize(query_str))), dtype=bytes)
+        if top_k <= 0 or num_docs == 0 or len(terms) == 0 or len(self.vocab) == 0:
+            return []
+
+        positions = np.searchsorted(self.vocab, terms)
+        positions = positions[positions < len(self.vocab)]
+        positions = positions[np.isin(self.vocab[positions], terms)]
+
+        scores = np.zeros(num_docs, dtype=np.float32)
+        length_norm = self.k1 * (
+            1 - self.b + self.b * self.doc_lengths / (self.avg_doc_length or 1.0)
+        )
+        for position in positions:
+            start, end = self.indptr[position], self.indptr[position + 1]
+            docs = self.doc_ids[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            doc_freq = end - start
+            idf = math.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + length_norm[docs])
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(str(self.node_ids[doc]), float(scores[doc])) for doc in candidates]
@@ -0,0 +1,26 @@
+"""
+This file contains the location of the persistent caches shared across domains and processes.
+"""
+
+import os
+
+# Relative cache directories are resolved against the repository root, next to the
+# docs and storage directories, so the caches do not depend on the working directory
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def resolve_cache_dir(path):
+    """
+    Resolves a cache directory against the repository root.
+
+    Args:
+        path (str): An absolute path, or a path relative to the repository root.
+
+    Returns:
+        str: The absolute path of the directory.
+    """
+    return os.path.abspath(os.path.join(REPO_DIR, path))
+
+
+# Directory for the persistent caches shared across domains and processes
+RAG_CACHE_DIR = resolve_cache_dir(os.getenv("RAG_CACHE_DIR", ".cache"))
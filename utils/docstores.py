@@ -0,0 +1,291 @@
+"""
+This file contains custom document store backends for llama_index indexes.
+"""
+
+import os
+import json
+import mmap
+import logging
+import threading
+from typing import Dict, Optional, Set
+
+import fsspec
+import numpy as np
+from llama_index.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.storage.docstore.types import DEFAULT_PERSIST_FNAME
+from llama_index.storage.kvstore.types import DEFAULT_COLLECTION, BaseKVStore
+
+logger = logging.getLogger(__name__)
+
+LAZY_DOCSTORE_FNAME = "docstore"
+RECORDS_SUFFIX = ".records.jsonl"
+OFFSETS_SUFFIX = ".offsets.npz"
+
+
+def _get_persist_base(persist_path: str) -> str:
+    # StorageContext.persist passes the path of the default docstore.json
+    return os.path.join(os.path.dirname(persist_path), LAZY_DOCSTORE_FNAME)
+
+
+class OffsetKVStore(BaseKVStore):
+    """
+    A key-value store that keeps its values on disk and only their offsets in memory.
+
+    Values are persisted as one JSON record per line in a .jsonl file, which is
+    memory-mapped. An offset table (.npz) holds the collection, key, offset and length
+    of every record, so opening the store reads no values, and a get parses a single
+    record. Values put or deleted since the store was opened are kept in memory until
+    the next persist, which rewrites the records file, copying the unchanged records
+    as raw bytes.
+    """
+
+    def __init__(self, persist_base: Optional[str] = None) -> None:
+        """
+        Initialize the OffsetKVStore.
+
+        Args:
+            persist_base (Optional[str]): The path prefix of the persisted records and offsets. None creates an empty store.
+        """
+        self._lock = threading.Lock()
+        self._added: Dict[str, Dict[str, dict]] = {}
+        self._deleted: Dict[str, Set[str]] = {}
+        self._open(persist_base)
+
+    def _open(self, persist_base: Optional[str]) -> None:
+        self._records = None
+        # collection -> key -> row of the offset table
+        self._rows: Dict[str, Dict[str, int]] = {}
+        self._offsets = np.zeros(0, dtype=np.int64)
+        self._lengths = np.zeros(0, dtype=np.int64)
+        if persist_base is None:
+            return
+
+        with np.load(persist_base + OFFSETS_SUFFIX) as offsets:
+            collections = offsets["collections"].tolist()
+            keys = [key.decode("utf-8") for key in offsets["keys"].tolist()]
+            collection_ids = offsets["collection_ids"].tolist()
+            self._offsets = offsets["offsets"]
+            self._lengths = offsets["lengths"]
+        for collection in collections:
+            self._rows[collection] = {}
+        for row, (key, collection_id) in enumerate(zip(keys, collection_ids)):
+            self._rows[collections[collection_id]][key] = row
+
+        with open(persist_base + RECORDS_SUFFIX, "rb") as f:
+            # An empty file cannot be memory-mapped
+            if os.fstat(f.fileno()).st_size:
+                self._records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read_record(self, row: int) -> bytes:
+        offset = int(self._offsets[row])
+        return self._records[offset : offset + int(self._lengths[row])]
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        """Put a key-value pair into the store."""
+        with self._lock:
+            self._added.setdefault(collection, {})[key] = val.copy()
+            self._deleted.get(collection, set()).discard(key)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        """Get a value from the store."""
+        with self._lock:
+            val = self._added.get(collection, {}).get(key)
+            if val is not None:
+                return val.copy()
+            if key in self._deleted.get(collection, ()):
+                return None
+            row = self._rows.get(collection, {}).get(key)
+            if row is None:
+                return None
+            record = self._read_record(row)
+        return json.loads(record)
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        """Get all values from the store, reading every persisted value of the collection."""
+        with self._lock:
+            deleted = self._deleted.get(collection, set())
+            # Read in file order, so the records file is read front to back
+            rows = sorted(
+                (row, key)
+                for key, row in self._rows.get(collection, {}).items()
+                if key not in deleted
+            )
+            records = [(key, self._read_record(row)) for row, key in rows]
+            added = {
+                key: val.copy() for key, val in self._added.get(collection, {}).items()
+            }
+        values = {key: json.loads(record) for key, record in records}
+        values.update(added)
+        return values
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        """Delete a value from the store."""
+        with self._lock:
+            existed = self._added.get(collection, {}).pop(key, None) is not None
+            if key in self._rows.get(collection, {}) and key not in self._deleted.get(
+                collection, ()
+            ):
+                self._deleted.setdefault(collection, set()).add(key)
+                existed = True
+            return existed
+
+    def count(self, collection: str = DEFAULT_COLLECTION) -> int:
+        """
+        Counts the values of a collection without reading them.
+
+        Args:
+            collection (str): The collection.
+
+        Returns:
+            int: The number of values.
+        """
+        with self._lock:
+            deleted = self._deleted.get(collection, set())
+            persisted = self._rows.get(collection, {}).keys() - deleted
+            return len(persisted | self._added.get(collection, {}).keys())
+
+    def persist(self, persist_base: str) -> None:
+        """
+        Persists the store and reopens it from the persisted files, releasing the values held in memory.
+
+        Args:
+            persist_base (str): The path prefix of the persisted records and offsets.
+        """
+        directory = os.path.dirname(persist_base)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with self._lock:
+            collections = sorted(set(self._rows) | set(self._added))
+            keys, collection_ids, offsets, lengths = [], [], [], []
+            tmp_records_path = f"{persist_base}{RECORDS_SUFFIX}.tmp"
+            with open(tmp_records_path, "wb") as f:
+
+                def write(collection_id, key, record):
+                    keys.append(key)
+                    collection_ids.append(collection_id)
+                    offsets.append(f.tell())
+                    lengths.append(len(record))
+                    f.write(record)
+                    f.write(b"\n")
+
+                for collection_id, collection in enumerate(collections):
+                    added = self._added.get(collection, {})
+                    deleted = self._deleted.get(collection, set())
+                    for key, row in sorted(
+                        self._rows.get(collection, {}).items(), key=lambda item: item[1]
+                    ):
+                        if key not in added and key not in deleted:
+                            write(collection_id, key, self._read_record(row))
+                    for key, val in added.items():
+                        write(collection_id, key, json.dumps(val).encode("utf-8"))
+
+            tmp_offsets_path = f"{persist_base}.offsets.tmp.npz"
+            np.savez(
+                tmp_offsets_path,
+                collections=np.array(collections, dtype=str),
+                # UTF-8 bytes take a quarter of the space of a numpy unicode array
+                keys=np.array([key.encode("utf-8") for key in keys], dtype=bytes),
+                collection_ids=np.array(collection_ids, dtype=np.int32),
+                offsets=np.array(offsets, dtype=np.int64),
+                lengths=np.array(lengths, dtype=np.int64),
+            )
+
+            if self._records is not None:
+                self._records.close()
+            os.replace(tmp_records_path, persist_base + RECORDS_SUFFIX)
+            os.replace(tmp_offsets_path, persist_base + OFFSETS_SUFFIX)
+            self._added = {}
+            self._deleted = {}
+            self._open(persist_base)
+
+
+class LazyDocumentStore(KVDocumentStore):
+    """
+    A document store that reads nodes from disk on demand.
+
+    Opening the store only loads the node ids and the offsets of their records (see
+    OffsetKVStore), instead of parsing every node's text and metadata as the default
+    docstore.json does, so index open time and resident memory do not grow with the
+    text size of the corpus. Retrieval only reads the nodes it returns.
+
+    NOTE: docs still reads every node, it is meant for index builds, not queries.
+    """
+
+    def __init__(
+        self,
+        kvstore: Optional[OffsetKVStore] = None,
+        namespace: Optional[str] = None,
+    ) -> None:
+        """
+        Initialize the LazyDocumentStore.
+
+        Args:
+            kvstore (Optional[OffsetKVStore]): The store of the nodes. Defaults to an empty store.
+            namespace (Optional[str]): The docstore namespace.
+        """
+        super().__init__(kvstore or OffsetKVStore(), namespace)
+
+    @staticmethod
+    def exists(persist_dir: str) -> bool:
+        """
+        Checks whether a LazyDocumentStore is persisted in a directory.
+
+        Args:
+            persist_dir (str): The directory to check.
+
+        Returns:
+            bool: True if the store's offset table exists.
+        """
+        return os.path.exists(
+            os.path.join(persist_dir, LAZY_DOCSTORE_FNAME) + OFFSETS_SUFFIX
+        )
+
+    @classmethod
+    def from_persist_dir(
+        cls,
+        persist_dir: str,
+        namespace: Optional[str] = None,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> "LazyDocumentStore":
+        """
+        Opens a persisted store, reading only its offset table.
+
+        Args:
+            persist_dir (str): The directory the store is persisted in.
+            namespace (Optional[str]): The docstore namespace.
+            fs (Optional[fsspec.AbstractFileSystem]): Unused, only local files are supported.
+
+        Returns:
+            LazyDocumentStore: The opened store.
+        """
+        persist_base = os.path.join(persist_dir, LAZY_DOCSTORE_FNAME)
+        logger.debug(f"Loading {__name__} from {persist_base}.")
+        return cls(OffsetKVStore(persist_base), namespace)
+
+    def persist(
+        self,
+        persist_path: str = DEFAULT_PERSIST_FNAME,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> None:
+        """
+        Persists the store next to persist_path, and removes a stale docstore.json from an earlier build.
+
+        Args:
+            persist_path (str): The path of the default docstore file, the store is persisted in its directory.
+            fs (Optional[fsspec.AbstractFileSystem]): Unused, only local files are supported.
+        """
+        self._kvstore.persist(_get_persist_base(persist_path))
+        if os.path.basename(persist_path) == DEFAULT_PERSIST_FNAME and os.path.exists(
+            persist_path
+        ):
+            os.remove(persist_path)
+
+    def get_document_count(self) -> int:
+        """
+        Counts the nodes of the store without reading them.
+
+        Returns:
+            int: The number of nodes.
+        """
+        return self._kvstore.count(collection=self._node_collection)
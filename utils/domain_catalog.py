@@ -0,0 +1,229 @@
+"""
+This file contains a cached catalog of the knowledge domains (docs/<domain>/domain_description.txt) with filesystem change detection.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from .cache_dir import RAG_CACHE_DIR, resolve_cache_dir
+from .rerank_cache import hash_text
+
+logger = logging.getLogger(__name__)
+
+DOMAIN_DESCRIPTION_FNAME = "domain_description.txt"
+
+# Directory of the persisted catalog manifests, one per docs directory
+DOMAIN_CATALOG_DIR = resolve_cache_dir(os.getenv("DOMAIN_CATALOG_DIR", RAG_CACHE_DIR))
+# Minimum seconds between two checks of the docs directory for changes
+DOMAIN_CATALOG_REFRESH_INTERVAL = float(
+    os.getenv("DOMAIN_CATALOG_REFRESH_INTERVAL", 5.0)
+)
+
+
+class DomainCatalog:
+    """
+    The domains of a docs directory and their descriptions, persisted as a small JSON manifest.
+
+    A domain is a subdirectory of the docs directory with a domain_description.txt.
+    Refreshing the catalog lists the subdirectories again only when the docs
+    directory's mtime changed, and reads a description only when the mtime or size
+    of its file changed, so a refresh is one stat per domain. Refreshes are throttled
+    to one per refresh_interval seconds; domains written by this process should be
+    registered with update_domain.
+    """
+
+    def __init__(
+        self,
+        docs_dir: str,
+        manifest_path: Optional[str] = None,
+        refresh_interval: float = DOMAIN_CATALOG_REFRESH_INTERVAL,
+    ):
+        """
+        Initialize the DomainCatalog from its manifest, if one was persisted.
+
+        Args:
+            docs_dir (str): The directory containing a subdirectory per domain.
+            manifest_path (Optional[str]): The path of the JSON manifest. Defaults to a file in DOMAIN_CATALOG_DIR named after the docs directory.
+            refresh_interval (float): The minimum seconds between two checks for changes.
+        """
+        self.docs_dir = docs_dir
+        self.manifest_path = manifest_path or os.path.join(
+            DOMAIN_CATALOG_DIR,
+            f"domain_catalog_{hash_text(os.path.abspath(docs_dir))[:16]}.json",
+        )
+        self.refresh_interval = refresh_interval
+        self._manifest = self._load_manifest()
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        empty_manifest = {"docs_mtime_ns": None, "dirs": [], "domains": {}}
+        if not os.path.exists(self.manifest_path):
+            return empty_manifest
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable domain catalog manifest: {e}")
+            return empty_manifest
+        if manifest.get("docs_dir") != os.path.abspath(self.docs_dir):
+            return empty_manifest
+        return manifest
+
+    def _save_manifest(self) -> None:
+        directory = os.path.dirname(self.manifest_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._manifest["docs_dir"] = os.path.abspath(self.docs_dir)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _refresh_domain(self, domain_name: str) -> bool:
+        """
+        Updates the catalog entry of a domain from its description file.
+
+        Args:
+            domain_name (str): The domain directory name.
+
+        Returns:
+            bool: True if the entry was added, changed, or removed.
+        """
+        domains = self._manifest["domains"]
+        path = os.path.join(self.docs_dir, domain_name, DOMAIN_DESCRIPTION_FNAME)
+        try:
+            stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return domains.pop(domain_name, None) is not None
+
+        entry = domains.get(domain_name)
+        if (
+            entry is not None
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            return False
+        with open(path, "r") as f:
+            domain_description = f.read()
+        domains[domain_name] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "domain_description": domain_description,
+            "description_hash": hash_text(domain_description),
+        }
+        logger.info(f"Domain catalog: {'updated' if entry else 'added'} {domain_name}")
+        return True
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Brings the catalog up to date with the docs directory, and persists the manifest if it changed.
+
+        Args:
+            force (bool): Flag to check for changes even if the last check was less than refresh_interval seconds ago.
+
+        Returns:
+            bool: True if any domain was added, changed, or removed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_refresh < self.refresh_interval:
+                return False
+            self._last_refresh = now
+
+            changed = False
+            try:
+                docs_mtime_ns = os.stat(self.docs_dir).st_mtime_ns
+            except FileNotFoundError:
+                docs_mtime_ns = None
+            dirs_changed = docs_mtime_ns != self._manifest["docs_mtime_ns"]
+            if dirs_changed:
+                # A domain directory was added, removed, or renamed
+                dirs = []
+                if docs_mtime_ns is not None:
+                    with os.scandir(self.docs_dir) as entries:
+                        dirs = sorted(entry.name for entry in entries if entry.is_dir())
+                for domain_name in set(self._manifest["domains"]) - set(dirs):
+                    del self._manifest["domains"][domain_name]
+                    logger.info(f"Domain catalog: removed {domain_name}")
+                    changed = True
+                self._manifest["docs_mtime_ns"] = docs_mtime_ns
+                self._manifest["dirs"] = dirs
+
+            for domain_name in self._manifest["dirs"]:
+                changed = self._refresh_domain(domain_name) or changed
+
+            if changed or dirs_changed:
+                self._save_manifest()
+            return changed
+
+    def update_domain(self, domain_name: str) -> None:
+        """
+        Registers a domain that was just added or changed, without waiting for the next refresh.
+
+        Args:
+            domain_name (str): The domain directory name.
+        """
+        with self._lock:
+            if domain_name not in self._manifest["dirs"]:
+                self._manifest["dirs"] = sorted(self._manifest["dirs"] + [domain_name])
+            self._refresh_domain(domain_name)
+            self._save_manifest()
+
+    def get_domains(self) -> List[Dict[str, str]]:
+        """
+        Returns the domains of the docs directory, refreshing the catalog if it is due.
+
+        Returns:
+            List[Dict[str, str]]: The "domain_name", "domain_description" and "description_hash" of each domain, sorted by name.
+        """
+        self.refresh()
+        with self._lock:
+            return [
+                {
+                    "domain_name": domain_name,
+                    "domain_description": entry["domain_description"],
+                    "description_hash": entry["description_hash"],
+                }
+                for domain_name, entry in sorted(self._manifest["domains"].items())
+            ]
+
+    def get_domain(self, domain_name: str) -> Optional[Dict[str, str]]:
+        """
+        Looks up a domain, refreshing the catalog if it is due.
+
+        Args:
+            domain_name (str): The domain directory name.
+
+        Returns:
+            Optional[Dict[str, str]]: The domain, or None if the docs directory has no such domain.
+        """
+        for domain in self.get_domains():
+            if domain["domain_name"] == domain_name:
+                return domain
+        return None
+
+
+_catalogs: Dict[str, DomainCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_domain_catalog(docs_dir: str) -> DomainCatalog:
+    """
+    Returns the process-wide catalog of a docs directory, loading it on first use.
+
+    Args:
+        docs_dir (str): The directory containing a subdirectory per domain.
+
+    Returns:
+        DomainCatalog: The catalog.
+    """
+    key = os.path.abspath(docs_dir)
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = DomainCatalog(docs_dir)
+        return _catalogs[key]
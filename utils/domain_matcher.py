@@ -0,0 +1,161 @@
+"""
+This file contains an embedding-based matcher of domain descriptions to the available knowledge domains.
+"""
+
+import os
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .rerank_cache import hash_text
+
+logger = logging.getLogger(__name__)
+
+# A match is accepted without the LLM judge when the top domain is at least this
+# similar to the requested description, and ahead of the runner-up by the margin
+DOMAIN_MATCH_ACCEPT_SIMILARITY = float(
+    os.getenv("DOMAIN_MATCH_ACCEPT_SIMILARITY", 0.85)
+)
+DOMAIN_MATCH_MARGIN = float(os.getenv("DOMAIN_MATCH_MARGIN", 0.03))
+
+
+class DomainMatcher:
+    """
+    Ranks domains by the cosine similarity of their descriptions to a requested domain description.
+
+    Each domain description is embedded once and kept in memory until its text
+    changes. A ranking is decided when its top domain is similar enough and clearly
+    ahead of the runner-up, or when there are no domains at all; any other ranking,
+    including one where no domain is similar, should be settled by the LLM judge.
+    Similarity alone never rejects every domain, since a paraphrased description of
+    an archived domain can score low, and a false rejection researches the domain
+    online and indexes a duplicate.
+    """
+
+    def __init__(
+        self,
+        embed_model,
+        accept_similarity: float = DOMAIN_MATCH_ACCEPT_SIMILARITY,
+        margin: float = DOMAIN_MATCH_MARGIN,
+    ):
+        """
+        Initialize the DomainMatcher.
+
+        Args:
+            embed_model (BaseEmbedding): The embedding model of the descriptions.
+            accept_similarity (float): The minimum similarity of an unambiguous match.
+            margin (float): The minimum similarity lead of an unambiguous match over the runner-up.
+        """
+        self.embed_model = embed_model
+        self.accept_similarity = accept_similarity
+        self.margin = margin
+        # domain name -> (description hash, normalized embedding)
+        self._embeddings: Dict[str, Tuple[str, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def _get_domain_embeddings(self, domains: List[Dict[str, str]]) -> np.ndarray:
+        """
+        Returns the normalized description embeddings of the domains, embedding new or changed descriptions in one batch.
+
+        Args:
+            domains (List[Dict[str, str]]): The "domain_name" and "domain_description" (and optionally "description_hash") of each domain.
+
+        Returns:
+            np.ndarray: The (num_domains, dim) embedding matrix.
+        """
+        with self._lock:
+            stale = [
+                domain
+                for domain in domains
+                if self._embeddings.get(domain["domain_name"], (None,))[0]
+                != get_description_hash(domain)
+            ]
+            if stale:
+                logger.info(f"Embedding {len(stale)} domain descriptions")
+                embeddings = self.embed_model.get_text_embedding_batch(
+                    [domain["domain_description"] for domain in stale]
+                )
+                for domain, embedding in zip(stale, embeddings):
+                    self._embeddings[domain["domain_name"]] = (
+                        get_description_hash(domain),
+                        normalize(embedding),
+                    )
+            return np.stack(
+                [self._embeddings[domain["domain_name"]][1] for domain in domains]
+            )
+
+    def rank(
+        self, domain_description: str, domains: List[Dict[str, str]]
+    ) -> List[Tuple[Dict[str, str], float]]:
+        """
+        Ranks domains by the similarity of their descriptions to a domain description.
+
+        Args:
+            domain_description (str): The requested domain description.
+            domains (List[Dict[str, str]]): The "domain_name" and "domain_description" of each domain.
+
+        Returns:
+            List[Tuple[Dict[str, str], float]]: The domains with their cosine similarity, most similar first.
+        """
+        if not domains:
+            return []
+        domain_embeddings = self._get_domain_embeddings(domains)
+        query_embedding = normalize(self.embed_model.get_query_embedding(domain_description))
+        similarities = domain_embeddings @ query_embedding
+        order = np.argsort(-similarities, kind="stable")
+        return [(domains[i], float(similarities[i])) for i in order]
+
+    def match(
+        self, domain_description: str, domains: List[Dict[str, str]]
+    ) -> Tuple[bool, Optional[Dict[str, str]], List[Tuple[Dict[str, str], float]]]:
+        """
+        Finds the domain matching a domain description, if the ranking decides it.
+
+        Args:
+            domain_description (str): The requested domain description.
+            domains (List[Dict[str, str]]): The "domain_name" and "domain_description" of each domain.
+
+        Returns:
+            Tuple[bool, Optional[Dict[str, str]], List[Tuple[Dict[str, str], float]]]: Whether the ranking is decided, the matching domain (None when there are no domains or the ranking is ambiguous), and the ranking.
+        """
+        ranking = self.rank(domain_description, domains)
+        if not ranking:
+            return True, None, ranking
+        top_domain, top_similarity = ranking[0]
+        runner_up_similarity = ranking[1][1] if len(ranking) > 1 else -1.0
+        if (
+            top_similarity >= self.accept_similarity
+            and top_similarity - runner_up_similarity >= self.margin
+        ):
+            return True, top_domain, ranking
+        return False, None, ranking
+
+
+def get_description_hash(domain) -> str:
+    """
+    Returns the hash of a domain's description, computing it unless the domain catalog already did.
+
+    Args:
+        domain (Dict[str, str]): The domain.
+
+    Returns:
+        str: The description hash.
+    """
+    return domain.get("description_hash") or hash_text(domain["domain_description"])
+
+
+def normalize(embedding) -> np.ndarray:
+    """
+    Converts an embedding to a unit length float32 vector.
+
+    Args:
+        embedding (List[float]): The embedding.
+
+    Returns:
+        np.ndarray: The normalized embedding.
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
@@ -0,0 +1,231 @@
+"""
+This file contains a content-addressed cache of embeddings shared across domains and index rebuilds.
+"""
+
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+
+logger = logging.getLogger(__name__)
+
+# Embeddings are stored as little-endian float32 bytes, keyed by embedding_cache_key
+EMBEDDING_CACHE_FNAME = "embeddings.sqlite"
+# Keys looked up per query, SQLite allows at most 999 bound variables per statement
+LOOKUP_BATCH_SIZE = 500
+# Seconds a writer waits for another process to release the database
+LOCK_TIMEOUT = 30.0
+
+
+def embedding_cache_key(model_name, text):
+    """
+    Builds the content address of a chunk of text for an embedding model.
+
+    Args:
+        model_name (str): The name of the embedding model.
+        text (str): The text that is embedded.
+
+    Returns:
+        bytes: The sha256 digest of the model name and text.
+    """
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    A local, content-addressed embedding cache keyed by a hash of (embedding model, text).
+
+    Embeddings are stored as float32 blobs in a SQLite table indexed by key, so a
+    lookup only reads the requested rows instead of loading the cache into memory,
+    and concurrent builds in several processes serialize their writes through
+    SQLite's file locks. The cache is shared by every domain and every rebuild that
+    uses the same model.
+    """
+
+    def __init__(self, cache_dir: str):
+        """
+        Initialize the EmbeddingCache. The database is opened on first use.
+
+        Args:
+            cache_dir (str): The directory of the cache database.
+        """
+        self.cache_dir = cache_dir
+        self.db_path = os.path.join(cache_dir, EMBEDDING_CACHE_FNAME)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir, exist_ok=True)
+            # Embedding runs in worker threads, all access goes through _lock
+            self._conn = sqlite3.connect(
+                self.db_path, timeout=LOCK_TIMEOUT, check_same_thread=False
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key BLOB PRIMARY KEY, "
+                "vector BLOB NOT NULL) WITHOUT ROWID"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[Embedding]]:
+        """
+        Looks up cached embeddings.
+
+        Args:
+            model_name (str): The name of the embedding model.
+            texts (List[str]): The embedded texts.
+
+        Returns:
+            List[Optional[Embedding]]: The cached embedding of each text, or None on a miss.
+        """
+        keys = [embedding_cache_key(model_name, text) for text in texts]
+        vectors = {}
+        with self._lock:
+            conn = self._connect()
+            for idx in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                batch = keys[idx : idx + LOOKUP_BATCH_SIZE]
+                rows = conn.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN "
+                    f"({', '.join(['?'] * len(batch))})",
+                    batch,
+                ).fetchall()
+                vectors.update(rows)
+        return [
+            np.frombuffer(vectors[key], dtype="<f4").tolist() if key in vectors else None
+            for key in keys
+        ]
+
+    def set_many(
+        self, model_name: str, texts: List[str], embeddings: List[Embedding]
+    ) -> None:
+        """
+        Stores embeddings.
+
+        Args:
+            model_name (str): The name of the embedding model.
+            texts (List[str]): The embedded texts.
+            embeddings (List[Embedding]): The embedding of each text.
+        """
+        if not texts:
+            return
+        records = [
+            (
+                embedding_cache_key(model_name, text),
+                np.asarray(embedding, dtype="<f4").tobytes(),
+            )
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector) VALUES (?, ?)", records
+            )
+            conn.commit()
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    An embedding model that serves repeated texts from an EmbeddingCache and only
+    calls the wrapped model for texts it has not embedded before.
+
+    Query embeddings are never cached. Queries are rarely repeated verbatim, so
+    caching them would grow the cache with every question; code that embeds queries
+    through the text embedding path should use uncached_model.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+
+    def __init__(self, embed_model: BaseEmbedding, cache: EmbeddingCache, **kwargs):
+        """
+        Initialize the CachedEmbedding.
+
+        Args:
+            embed_model (BaseEmbedding): The embedding model to call on cache misses.
+            cache (EmbeddingCache): The cache to read from and write to.
+        """
+        self._embed_model = embed_model
+        self._cache = cache
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+            **kwargs,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def uncached_model(self) -> BaseEmbedding:
+        """The wrapped embedding model, which bypasses the cache."""
+        return self._embed_model
+
+    @property
+    def cache_model_name(self) -> str:
+        """The model identity used in cache keys."""
+        return f"{self._embed_model.class_name()}:{self._embed_model.model_name}"
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed_model._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self._embed_model._aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        embeddings = self._cache.get_many(self.cache_model_name, texts)
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        self._log_hits(len(texts), len(missing))
+        if missing:
+            missing_texts = [texts[idx] for idx in missing]
+            new_embeddings = self._embed_model._get_text_embeddings(missing_texts)
+            self._cache.set_many(self.cache_model_name, missing_texts, new_embeddings)
+            for idx, embedding in zip(missing, new_embeddings):
+                embeddings[idx] = embedding
+        return embeddings
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        embeddings = self._cache.get_many(self.cache_model_name, texts)
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        self._log_hits(len(texts), len(missing))
+        if missing:
+            missing_texts = [texts[idx] for idx in missing]
+            new_embeddings = await self._embed_model._aget_text_embeddings(
+                missing_texts
+            )
+            self._cache.set_many(self.cache_model_name, missing_texts, new_embeddings)
+            for idx, embedding in zip(missing, new_embeddings):
+                embeddings[idx] = embedding
+        return embeddings
+
+    def _log_hits(self, num_texts: int, num_missing: int) -> None:
+        self._hits += num_texts - num_missing
+        self._misses += num_missing
+        logger.debug(f"Embedding cache hits: {num_texts - num_missing}/{num_texts}")
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Returns the number of cached and newly embedded texts since the model was created.
+
+        Returns:
+            Dict[str, int]: The "hits" and "misses" counts.
+        """
+        return {"hits": self._hits, "misses": self._misses}
@@ -0,0 +1,121 @@
+"""
+This file contains a persistent (SQLite) cache of RAG fusion query variations.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import List, Optional
+
+from .rerank_cache import hash_text, normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class FusionCache:
+    """
+    A disk-backed cache of query variations keyed by normalized query text, query
+    context hash, and number of variations.
+
+    Entries expire after ttl seconds, so variations are eventually regenerated with
+    newer prompts or models.
+    """
+
+    def __init__(self, db_path: str, ttl: float):
+        """
+        Initialize the FusionCache. The database is opened on first use.
+
+        Args:
+            db_path (str): The path of the SQLite database file.
+            ttl (float): The number of seconds cached variations stay valid.
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_variations ("
+                "query_hash TEXT NOT NULL, "
+                "context_hash TEXT NOT NULL, "
+                "number_of_variations INTEGER NOT NULL, "
+                "variations TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "PRIMARY KEY (query_hash, context_hash, number_of_variations))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _key(query, query_context, number_of_variations):
+        return (hash_text(normalize_query(query)), hash_text(query_context), number_of_variations)
+
+    def get(
+        self, query: str, query_context: Optional[str], number_of_variations: int
+    ) -> Optional[List[str]]:
+        """
+        Looks up cached query variations.
+
+        Args:
+            query (str): The original query.
+            query_context (Optional[str]): The context the variations were generated with.
+            number_of_variations (int): The number of requested variations.
+
+        Returns:
+            Optional[List[str]]: The cached variations, or None on a miss.
+        """
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT variations FROM query_variations WHERE query_hash = ? "
+                "AND context_hash = ? AND number_of_variations = ? AND created_at >= ?",
+                (*self._key(query, query_context, number_of_variations), time.time() - self.ttl),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(
+        self,
+        query: str,
+        query_context: Optional[str],
+        number_of_variations: int,
+        variations: List[str],
+    ) -> None:
+        """
+        Stores query variations.
+
+        Args:
+            query (str): The original query.
+            query_context (Optional[str]): The context the variations were generated with.
+            number_of_variations (int): The number of requested variations.
+            variations (List[str]): The generated variations.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO query_variations "
+                "(query_hash, context_hash, number_of_variations, variations, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    *self._key(query, query_context, number_of_variations),
+                    json.dumps(variations),
+                    time.time(),
+                ),
+            )
+            conn.commit()
+
+    def clear(self) -> None:
+        """
+        Removes every cached variation.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM query_variations")
+            conn.commit()
@@ -0,0 +1,199 @@
+"""
+This file contains a process-wide cache of loaded llama_index indexes.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .docstores import RECORDS_SUFFIX
+from .vector_stores import EMBEDDINGS_SUFFIX, QUANTIZED_EMBEDDINGS_SUFFIXES
+
+logger = logging.getLogger(__name__)
+
+# Persisted files that are memory-mapped rather than read into memory: the embeddings
+# of NumPy vector stores (float32 and quantized) and the records of lazy docstores
+MEMORY_MAPPED_SUFFIXES = (
+    EMBEDDINGS_SUFFIX,
+    *QUANTIZED_EMBEDDINGS_SUFFIXES.values(),
+    RECORDS_SUFFIX,
+)
+
+
+def get_storage_signature(storage_dir):
+    """
+    Builds a signature of the persisted files in a storage directory.
+
+    The signature changes whenever a persisted file is added, removed, or rewritten,
+    which is what we use to detect that a cached index is stale.
+
+    Args:
+        storage_dir (str): The directory the index is persisted in.
+
+    Returns:
+        Tuple: A sorted tuple of (relative_path, mtime_ns, size) entries.
+    """
+    signature = []
+    for root, _, files in os.walk(storage_dir):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature.append(
+                (os.path.relpath(path, storage_dir), stat.st_mtime_ns, stat.st_size)
+            )
+    return tuple(sorted(signature))
+
+
+def get_signature_size(signature):
+    """
+    Estimates the resident memory footprint of an index from its storage signature.
+
+    NOTE: The persisted size of the files that are read into memory is used as a proxy
+    for the in-memory size. It is not exact, but it scales with the number of nodes and
+    embeddings, which is what matters for eviction. Memory-mapped files are left out:
+    their pages belong to the OS page cache, which reclaims them under memory pressure,
+    so evicting the index would not free them. A quantized store memory-maps both its
+    float32 and its quantized embeddings, so neither is counted.
+
+    Args:
+        signature (Tuple): A signature returned by get_storage_signature.
+
+    Returns:
+        int: The estimated footprint in bytes.
+    """
+    return sum(
+        size
+        for path, _, size in signature
+        if not path.endswith(MEMORY_MAPPED_SUFFIXES)
+    )
+
+
+class IndexCache:
+    """
+    A thread-safe LRU registry of loaded indexes keyed by storage directory.
+
+    Entries are evicted least-recently-used first once the estimated footprint of
+    all cached indexes exceeds max_bytes, and are reloaded when the persisted files
+    change on disk. Indexes of different storage directories are loaded in parallel,
+    while concurrent requests for the same one wait for a single load.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Initialize the IndexCache.
+
+        Args:
+            max_bytes (int): The total estimated footprint allowed before eviction.
+        """
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Any, Tuple, int]]" = OrderedDict()
+        self._lock = threading.RLock()
+        # Serializes the loads of each storage directory, by key
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(storage_dir: str) -> str:
+        return os.path.abspath(storage_dir)
+
+    @property
+    def total_bytes(self) -> int:
+        """The estimated footprint of all cached indexes."""
+        return sum(size for _, _, size in self._entries.values())
+
+    def get(self, storage_dir: str, loader: Callable[[str], Any]) -> Any:
+        """
+        Returns the cached index for a storage directory, loading it if needed.
+
+        Args:
+            storage_dir (str): The directory the index is persisted in.
+            loader (Callable[[str], Any]): Loads the index from the storage directory.
+
+        Returns:
+            Any: The loaded index.
+        """
+        key = self._key(storage_dir)
+        # The cache lock is only held to read and update the entries, not during loads
+        with self._get_key_lock(key):
+            signature = get_storage_signature(key)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    index, cached_signature, _ = entry
+                    if cached_signature == signature:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        logger.info(f"Using cached index for: {storage_dir}")
+                        return index
+                    logger.info(f"Persisted index changed, reloading: {storage_dir}")
+                    del self._entries[key]
+                self.misses += 1
+
+            index = loader(storage_dir)
+            with self._lock:
+                self._put(key, index, signature)
+            return index
+
+    def put(self, storage_dir: str, index: Any) -> None:
+        """
+        Registers an index that was just built and persisted to a storage directory.
+
+        Args:
+            storage_dir (str): The directory the index is persisted in.
+            index (Any): The index to cache.
+        """
+        key = self._key(storage_dir)
+        with self._get_key_lock(key):
+            signature = get_storage_signature(key)
+            with self._lock:
+                self._put(key, index, signature)
+
+    def invalidate(self, storage_dir: Optional[str] = None) -> None:
+        """
+        Drops a cached index, or every cached index if no directory is given.
+
+        Args:
+            storage_dir (Optional[str]): The directory of the index to drop.
+        """
+        with self._lock:
+            if storage_dir is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self._key(storage_dir), None)
+
+    def _get_key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _put(self, key: str, index: Any, signature: Tuple) -> None:
+        self._entries[key] = (index, signature, get_signature_size(signature))
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self) -> None:
+        # Always keep the most recently used entry, even if it alone exceeds the limit
+        while len(self._entries) > 1 and self.total_bytes > self.max_bytes:
+            key, _ = self._entries.popitem(last=False)
+            logger.info(f"Evicting cached index: {key}")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns a summary of the cache contents.
+
+        Returns:
+            Dict[str, Any]: The cached storage dirs, total estimated footprint, and hit and miss counts.
+        """
+        with self._lock:
+            return {
+                "storage_dirs": list(self._entries.keys()),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,154 @@
+"""
+This file contains the loading, chunking and fingerprinting of document files for index builds.
+
+It runs in the ingestion worker processes, so importing it must stay free of side
+effects: no LLM clients, caches or environment loading, which live in rag_tools.
+"""
+
+import os
+import hashlib
+import logging
+from functools import lru_cache
+
+from autogen.token_count_utils import count_token
+from langchain.text_splitter import RecursiveCharacterTextSplitter, Language
+from llama_index import SimpleDirectoryReader, download_loader
+from llama_index.node_parser import LangchainNodeParser
+from llama_index.schema import MetadataMode
+
+logger = logging.getLogger(__name__)
+
+# Node metadata key of the token count of a node's LLM content, set at index time
+NODE_TOKEN_COUNT_KEY = "token_count"
+
+
+def hash_file(path):
+    """
+    Computes the SHA-256 hash of a file's content.
+
+    Args:
+        path (str): The file path.
+
+    Returns:
+        str: The hex digest of the content.
+    """
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_file_fingerprint(path, previous_entry=None):
+    """
+    Gets the content hash, mtime and size of a file.
+
+    The file is only re-hashed when its mtime or size differ from the previous manifest entry.
+
+    Args:
+        path (str): The file path.
+        previous_entry (dict, optional): The manifest entry of the file from the last build.
+
+    Returns:
+        dict: The "sha256", "mtime_ns" and "size" of the file.
+    """
+    stat = os.stat(path)
+    if (
+        previous_entry is not None
+        and previous_entry["mtime_ns"] == stat.st_mtime_ns
+        and previous_entry["size"] == stat.st_size
+    ):
+        sha256 = previous_entry["sha256"]
+    else:
+        sha256 = hash_file(path)
+    return {"sha256": sha256, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+@lru_cache(maxsize=None)
+def get_ipynb_reader_cls():
+    """
+    Gets the llama_hub notebook reader, downloading it on first use.
+
+    Returns:
+        type: The IPYNBReader class.
+    """
+    return download_loader("IPYNBReader")
+
+
+def load_documents(input_files):
+    """
+    Loads documents from a list of files.
+
+    Args:
+        input_files (List[str]): The file paths to load.
+
+    Returns:
+        List[Document]: The loaded documents.
+    """
+    # The notebook reader is downloaded from llama_hub, only get it when it is needed
+    file_extractor = {}
+    if any(str(path).endswith(".ipynb") for path in input_files):
+        file_extractor[".ipynb"] = get_ipynb_reader_cls()(concatenate=True)
+
+    try:
+        return SimpleDirectoryReader(
+            input_files=input_files, file_extractor=file_extractor
+        ).load_data()
+    except Exception as e:
+        logger.error(f"Error reading documents: {e}")
+        raise
+
+
+def parse_nodes(documents):
+    """
+    Splits documents into the nodes stored in the index.
+
+    Each node's token count is stored in its metadata (excluded from the embedded
+    and LLM content), so retrieval never has to re-tokenize node text.
+
+    Args:
+        documents (List[Document]): The documents to split.
+
+    Returns:
+        List[BaseNode]: The parsed nodes.
+    """
+    parser = LangchainNodeParser(
+        RecursiveCharacterTextSplitter.from_language(
+            language=Language.PYTHON, chunk_size=8000, chunk_overlap=1000
+        )
+    )
+    nodes = parser.get_nodes_from_documents(documents)
+    for node in nodes:
+        for excluded_keys in (
+            node.excluded_embed_metadata_keys,
+            node.excluded_llm_metadata_keys,
+        ):
+            if NODE_TOKEN_COUNT_KEY not in excluded_keys:
+                excluded_keys.append(NODE_TOKEN_COUNT_KEY)
+        node.metadata[NODE_TOKEN_COUNT_KEY] = count_token(
+            node.get_content(metadata_mode=MetadataMode.LLM)
+        )
+    return nodes
+
+
+def load_and_parse_file(path, fingerprint=None):
+    """
+    Fingerprints, loads and chunks a single file. Runs in the ingestion worker processes.
+
+    The fingerprint is taken before the file is read, so a file that changes while it
+    is parsed is seen as changed by the next refresh.
+
+    Args:
+        path (str): The file path.
+        fingerprint (dict, optional): The fingerprint of the file, if it was already computed.
+
+    Returns:
+        Tuple[dict, List[str], List[BaseNode]]: The fingerprint of the file, the ids of the documents loaded from it, and their nodes.
+    """
+    fingerprint = fingerprint or get_file_fingerprint(path)
+    documents = load_documents([path])
+    return (
+        fingerprint,
+        [document.doc_id for document in documents],
+        parse_nodes(documents),
+    )
@@ -4,12 +4,13 @@ DESCRIPTION: This file contains miscellaneous functions that are used in multipl
 
 import os
 import json
+import asyncio
 import openai
 import autogen
 from autogen import OpenAIWrapper
 from time import sleep
 
-from llama_index.llms import OpenAI
+from llama_index.llms import ChatMessage, OpenAI
 
 import logging
 
@@ -104,11 +105,11 @@ def light_llm4_wrapper(query, kwargs={}):
     return light_llm_wrapper(llm4, query)
 
 
+LIGHT_GPT_SYSTEM_MESSAGE = "You are a helpful assistant. A user will ask a question, and you should provide an answer. ONLY return the answer, and nothing more."
+
+
 def light_gpt_wrapper_autogen(client: OpenAIWrapper, query, return_json=False, system_message=None):
-    system_message = (
-        system_message
-        or "You are a helpful assistant. A user will ask a question, and you should provide an answer. ONLY return the answer, and nothing more."
-    )
+    system_message = system_message or LIGHT_GPT_SYSTEM_MESSAGE
 
     messages = [
         {"role": "system", "content": system_message},
@@ -141,6 +142,45 @@ def light_gpt4_wrapper_autogen(query, return_json=False, system_message=None):
     return light_gpt_wrapper_autogen(client, query, return_json, system_message)
 
 
+async def a_light_gpt4_wrapper(query, return_json=False, system_message=None):
+    """
+    Async counterpart of light_gpt4_wrapper_autogen, built on the llama_index OpenAI LLM.
+
+    Args:
+        query (str): The user message.
+        return_json (bool): Flag to request and parse a JSON object response.
+        system_message (str, optional): The system message. Defaults to LIGHT_GPT_SYSTEM_MESSAGE.
+
+    Returns:
+        Union[str, dict]: The response text, or the parsed JSON response.
+    """
+    additional_kwargs = {"response_format": {"type": "json_object"}} if return_json else {}
+    llm4 = OpenAI(
+        model=config_list4[0]["model"],
+        api_key=config_list4[0]["api_key"],
+        additional_kwargs=additional_kwargs,
+    )
+    messages = [
+        ChatMessage(role="system", content=system_message or LIGHT_GPT_SYSTEM_MESSAGE),
+        ChatMessage(role="user", content=query),
+    ]
+
+    while True:
+        try:
+            response = await llm4.achat(messages)
+            break
+        except openai.RateLimitError as e:
+            print("RATE LIMIT ERROR: ", e)
+            await asyncio.sleep(5)
+
+    response = response.message.content
+    if return_json:
+        response = autogen.ConversableAgent._format_json_str(response)
+        response = json.loads(response)
+
+    return response
+
+
 def map_directory_to_json(dir_path):
     def dir_to_dict(path):
         dir_dict = {"name": os.path.basename(path)}
@@ -3,11 +3,17 @@ This file contains functions for Retriever-Augmented Generation (RAG).
 """
 # Standard Library Imports
 import os
+import asyncio
+import json
+import hashlib
 import logging
-from typing import List, Optional, Tuple, Any
-from time import sleep
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Tuple, Any, Union
+from time import sleep, perf_counter
 
 # Third-Party Imports
+import numpy as np
 import openai
 from dotenv import load_dotenv
 
@@ -19,30 +25,52 @@ from llama_index import (
     StorageContext,
     load_index_from_storage,
     ServiceContext,
-    download_loader,
 )
-from llama_index.bridge.pydantic import BaseModel
+from llama_index.bridge.pydantic import BaseModel, Field
+from llama_index.core import BaseRetriever
 from llama_index.indices.postprocessor import LLMRerank
 from llama_index.indices.query.schema import QueryBundle
 from llama_index.llm_predictor import LLMPredictor
 from llama_index.llms import OpenAI
-from llama_index.node_parser import LangchainNodeParser
 from llama_index.prompts.base import BasePromptTemplate
 from llama_index.prompts import PromptTemplate
 from llama_index.prompts.prompt_type import PromptType
+from llama_index.response.schema import Response, StreamingResponse
 from llama_index.retrievers import VectorIndexRetriever, AutoMergingRetriever
 from llama_index.retrievers.auto_merging_retriever import AutoMergingRetriever
 from llama_index.response_synthesizers import ResponseMode, get_response_synthesizer
 from llama_index.schema import BaseNode, NodeWithScore, MetadataMode
 from llama_index.storage import StorageContext
-from langchain.text_splitter import RecursiveCharacterTextSplitter, Language
 
 
 # Relative Imports
+from .answer_cache import AnswerCache
+from .bm25 import BM25Index
+from .cache_dir import RAG_CACHE_DIR
+from .embedding_cache import CachedEmbedding, EmbeddingCache
+from .index_cache import IndexCache, get_storage_signature
+from .ingest import NODE_TOKEN_COUNT_KEY, get_file_fingerprint, load_and_parse_file
+from .rag_trace import RAGTrace, record_llm_call, trace_stage, trace_stream
+from .fusion_cache import FusionCache
+from .rerank_cache import RerankCache, normalize_query
+from .sharded_index import (
+    SHARD_QUERY_CONCURRENCY,
+    ShardedIndex,
+    ShardedLexicalIndex,
+    ShardedRetriever,
+    get_top_level_dir,
+    merge_shard_results,
+    plan_shards,
+)
+from .vector_stores import NumpyVectorStore
+from .docstores import LazyDocumentStore
 from .misc import (
+    a_light_gpt4_wrapper,
     extract_json_response,
     light_gpt4_wrapper_autogen,
     format_incrementally,
+    load_json,
+    save_json,
 )
 from prompts.misc_prompts import (
     CHOICE_SELECT_PROMPT_TMPL,
@@ -81,6 +109,101 @@ llm3_synthesizer = OpenAI(
 )
 llm4 = OpenAI(model=LLM_CONFIGS["gpt-4"]["model"], temperature=0.5)
 
+# Vector store backend for new indexes: "numpy" (memory-mapped .npy) or "simple" (JSON)
+VECTOR_STORE_BACKEND = os.getenv("RAG_VECTOR_STORE", "numpy")
+
+# Docstore backend for new indexes: "lazy" (nodes read from disk on demand) or "simple" (JSON)
+DOCSTORE_BACKEND = os.getenv("RAG_DOCSTORE", "lazy")
+
+# Reduced-precision embeddings scanned by numpy vector stores: "float16", "int8", or
+# unset for float32 only. Loading an index defaults to the quantization it was built with.
+EMBEDDING_QUANTIZATION = os.getenv("RAG_EMBEDDING_QUANTIZATION") or None
+
+# File in each storage dir mapping indexed files to their content hash and nodes
+INDEX_MANIFEST_FNAME = "index_manifest.json"
+
+# Index build parallelism: worker processes that load and chunk files, files per
+# worker task, and nodes per batch handed to the embedder
+INGEST_NUM_WORKERS = int(os.getenv("RAG_INGEST_WORKERS", os.cpu_count() or 1))
+INGEST_FILES_PER_TASK = 8
+INGEST_INSERT_BATCH_SIZE = 256
+
+# Domains whose files add up to more than this many bytes are indexed as shards of
+# at most this size, which load lazily and are searched in parallel. 0 disables sharding.
+SHARD_MAX_BYTES = int(os.getenv("RAG_SHARD_MAX_BYTES", 128 * 1024**2))
+
+# Rank offset of reciprocal rank fusion, the usual value from the RRF paper
+RRF_K = 60
+
+# Pre-rerank pruning: candidates at least this similar to a better candidate are
+# dropped as near-duplicates, and the rest are picked by maximal marginal relevance
+# with this weight on relevance (vs. diversity)
+RERANK_DUPLICATE_THRESHOLD = 0.95
+RERANK_MMR_LAMBDA = 0.7
+
+# Maximum number of context tokens sent to the answer synthesizer
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", 12000))
+
+# Maximum number of attempts to retrieve the nodes of a question
+RETRIEVAL_MAX_RETRIES = 3
+
+# Process-wide cache of loaded indexes, evicted by estimated footprint (bytes)
+INDEX_CACHE_MAX_BYTES = int(os.getenv("INDEX_CACHE_MAX_BYTES", 2 * 1024**3))
+index_cache = IndexCache(max_bytes=INDEX_CACHE_MAX_BYTES)
+
+# Process-wide cache of loaded BM25 lexical indexes, keyed by the same storage dirs
+lexical_index_cache = IndexCache(max_bytes=INDEX_CACHE_MAX_BYTES)
+
+# Locks of prepare_index, by absolute storage dir
+index_build_locks = {}
+index_build_locks_lock = threading.Lock()
+
+# Persistent cache of LLM rerank scores, valid for a time to live (seconds)
+RERANK_CACHE_TTL = float(os.getenv("RAG_RERANK_CACHE_TTL", 30 * 24 * 60 * 60))
+rerank_cache = RerankCache(
+    os.path.join(RAG_CACHE_DIR, "rerank_cache.sqlite"), ttl=RERANK_CACHE_TTL
+)
+
+# Persistent cache of RAG fusion query variations, valid for a time to live (seconds)
+FUSION_CACHE_TTL = float(os.getenv("RAG_FUSION_CACHE_TTL", 30 * 24 * 60 * 60))
+fusion_cache = FusionCache(
+    os.path.join(RAG_CACHE_DIR, "fusion_cache.sqlite"), ttl=FUSION_CACHE_TTL
+)
+
+# Expected seconds per fusion LLM call, smoothed over observed calls and starting
+# from a typical GPT-4 round trip. Compared against fusion latency budgets.
+FUSION_LATENCY_PRIOR = float(os.getenv("RAG_FUSION_LATENCY_PRIOR", 6.0))
+FUSION_LATENCY_SMOOTHING = 0.3
+fusion_latency_estimate = FUSION_LATENCY_PRIOR
+fusion_latency_lock = threading.Lock()
+
+# Background generation of variations for queries whose fusion was skipped, the
+# executor is created on first use, see get_fusion_cache_executor
+fusion_cache_executor = None
+fusion_cache_warming = set()
+
+# Content-addressed cache of embeddings, keyed by (embedding model, text)
+embedding_cache = EmbeddingCache(os.path.join(RAG_CACHE_DIR, "embeddings"))
+
+# Semantic cache of synthesized answers: minimum question similarity for a hit,
+# time to live (seconds), and maximum number of cached answers. Questions that differ
+# in a single detail (a version, a parameter name, a negation) can embed above 0.95,
+# and a hit then returns the other question's answer, so the cache is opt-in
+# (use_answer_cache) and the threshold only admits near-identical rephrasings.
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(
+    os.getenv("RAG_ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.98)
+)
+ANSWER_CACHE_TTL = float(os.getenv("RAG_ANSWER_CACHE_TTL", 24 * 60 * 60))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("RAG_ANSWER_CACHE_MAX_ENTRIES", 1000))
+answer_cache = AnswerCache(
+    os.path.join(RAG_CACHE_DIR, "answer_cache.sqlite"),
+    ttl=ANSWER_CACHE_TTL,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+)
+
+# JSON lines file every question's stage trace is appended to, unset to not write traces
+RAG_TRACE_PATH = os.getenv("RAG_TRACE_PATH")
+
 
 class JSONLLMPredictor(LLMPredictor):
     """
@@ -129,62 +252,381 @@ class JSONLLMPredictor(LLMPredictor):
         logger.debug(output)
         return output
 
+    async def apredict(
+        self,
+        prompt: BasePromptTemplate,
+        output_cls: Optional[BaseModel] = None,
+        **prompt_args: Any,
+    ) -> str:
+        """
+        Async counterpart of predict.
+
+        Args:
+            prompt (BasePromptTemplate): The prompt template to use.
+            output_cls (Optional[BaseModel]): The output class for structured responses.
+            **prompt_args (Any): Additional arguments for prompt formatting.
+
+        Returns:
+            str: The prediction result.
+        """
+        self._log_template_data(prompt, **prompt_args)
+
+        if output_cls is not None:
+            output = await self._arun_program(output_cls, prompt, **prompt_args)
+        elif self._llm.metadata.is_chat_model:
+            messages = prompt.format_messages(llm=self._llm, **prompt_args)
+            messages = self._extend_messages(messages)
+            chat_response = await self._llm.achat(messages)
+            output = chat_response.message.content or ""
+        else:
+            formatted_prompt = prompt.format(llm=self._llm, **prompt_args)
+            formatted_prompt = self._extend_prompt(formatted_prompt)
+            response = await self._llm.acomplete(formatted_prompt, return_json=True)
+            output = response.text
+
+        logger.debug(output)
+        return output
+
 
 class ModifiedLLMRerank(LLMRerank):
     """
     A class extending LLMRerank to provide customized reranking functionality.
     """
 
-    def __init__(self, **kwargs):
+    max_concurrency: int = Field(
+        default=1, description="Maximum number of batches to rerank in parallel."
+    )
+    max_retries: int = Field(
+        default=3, description="Maximum number of attempts per rerank batch."
+    )
+    query_context: Optional[str] = Field(
+        default=None, description="Context added to the question in the prompt."
+    )
+    rerank_cache: Optional[RerankCache] = Field(
+        default=None, description="Cache of previous rerank scores.", exclude=True
+    )
+    trace: Optional[RAGTrace] = Field(
+        default=None, description="Trace to record rerank stages on.", exclude=True
+    )
+
+    def __init__(
+        self,
+        max_concurrency: int = 1,
+        max_retries: int = 3,
+        query_context: Optional[str] = None,
+        rerank_cache: Optional[RerankCache] = None,
+        trace: Optional[RAGTrace] = None,
+        **kwargs,
+    ):
         """
         Initialize the ModifiedLLMRerank.
+
+        Args:
+            max_concurrency (int): Maximum number of batches to rerank in parallel.
+            max_retries (int): Maximum number of attempts per rerank batch.
+            query_context (Optional[str]): Context added to the question in the prompt.
+            rerank_cache (Optional[RerankCache]): Cache of previous rerank scores. Only uncached nodes are sent to the LLM.
+            trace (Optional[RAGTrace]): Trace to record the cache lookup and every LLM batch on.
+            **kwargs: Arguments passed through to LLMRerank.
         """
         super().__init__(**kwargs)
         CHOICE_SELECT_PROMPT = PromptTemplate(
             CHOICE_SELECT_PROMPT_TMPL, prompt_type=PromptType.CHOICE_SELECT
         )
         self.choice_select_prompt = CHOICE_SELECT_PROMPT
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.query_context = query_context
+        self.rerank_cache = rerank_cache
+        self.trace = trace
 
     def _postprocess_nodes(
         self,
         nodes: List[NodeWithScore],
         query_bundle: Optional[QueryBundle] = None,
     ) -> List[NodeWithScore]:
+        (
+            query_str,
+            candidate_nodes,
+            cache_keys,
+            scores,
+            nodes_batches,
+        ) = self._prepare_rerank(nodes, query_bundle)
+
+        def rerank_batch(nodes_batch):
+            with self._batch_stage(nodes_batch) as stage:
+                batch_result = self._rerank_batch_with_retry(nodes_batch, query_str)
+                stage["nodes_out"] = len(batch_result)
+            self._cache_batch_scores(nodes_batch, batch_result, cache_keys)
+            return batch_result
+
+        max_workers = max(1, min(self.max_concurrency, len(nodes_batches)))
+        if max_workers == 1:
+            batch_results = [rerank_batch(nodes_batch) for nodes_batch in nodes_batches]
+        else:
+            logger.info(
+                f"Reranking {len(nodes_batches)} batches with concurrency: {max_workers}"
+            )
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                batch_results = list(executor.map(rerank_batch, nodes_batches))
+
+        return self._get_top_results(candidate_nodes, scores, batch_results)
+
+    async def apostprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        """
+        Async counterpart of postprocess_nodes. Up to max_concurrency batches are reranked concurrently on the event loop.
+
+        Args:
+            nodes (List[NodeWithScore]): The nodes to rerank.
+            query_bundle (Optional[QueryBundle]): The query.
+
+        Returns:
+            List[NodeWithScore]: The top_n reranked nodes.
+        """
+        (
+            query_str,
+            candidate_nodes,
+            cache_keys,
+            scores,
+            nodes_batches,
+        ) = self._prepare_rerank(nodes, query_bundle)
+
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+
+        async def rerank_batch(nodes_batch):
+            async with semaphore:
+                with self._batch_stage(nodes_batch) as stage:
+                    batch_result = await self._arerank_batch_with_retry(
+                        nodes_batch, query_str
+                    )
+                    stage["nodes_out"] = len(batch_result)
+            self._cache_batch_scores(nodes_batch, batch_result, cache_keys)
+            return batch_result
+
+        # gather keeps the results in the same order as the batches
+        batch_results = await asyncio.gather(
+            *(rerank_batch(nodes_batch) for nodes_batch in nodes_batches)
+        )
+
+        return self._get_top_results(candidate_nodes, scores, batch_results)
+
+    def _prepare_rerank(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle]
+    ) -> Tuple[str, List[BaseNode], dict, dict, List[List[BaseNode]]]:
+        """Look up the cached scores and split the uncached nodes into rerank batches."""
         if query_bundle is None:
             raise ValueError("Query bundle must be provided.")
-        initial_results: List[NodeWithScore] = []
-        for idx in range(0, len(nodes), self.choice_batch_size):
-            nodes_batch = [
-                node.node for node in nodes[idx : idx + self.choice_batch_size]
-            ]
-
-            query_str = query_bundle.query_str
-            fmt_batch_str = self._format_node_batch_fn(nodes_batch)
-            logger.info(f"Reranking batch of {len(nodes_batch)} nodes...")
-            raw_response = self.service_context.llm_predictor.predict(
-                self.choice_select_prompt,
-                context_str=fmt_batch_str,
-                query_str=query_str,
-            )
-            json_response = extract_json_response(raw_response)
+        query_str = self._format_query_str(query_bundle.query_str)
+
+        candidate_nodes = [node.node for node in nodes]
+        cache_keys, scores = self._get_cached_scores(candidate_nodes, query_bundle)
+        nodes_batches = self._get_uncached_batches(candidate_nodes, scores)
+        return query_str, candidate_nodes, cache_keys, scores, nodes_batches
+
+    def _batch_stage(self, nodes_batch: List[BaseNode]):
+        """Trace stage of a single rerank batch."""
+        # Batches overlap, their LLM usage is counted on the enclosing rerank stage
+        return trace_stage(
+            self.trace,
+            "rerank_batch",
+            count_llm_usage=False,
+            nodes_in=len(nodes_batch),
+        )
 
-            raw_choices, relevances = self._parse_choice_select_answer_fn(
-                json_response, len(nodes_batch)
+    def _get_cached_scores(
+        self, candidate_nodes: List[BaseNode], query_bundle: QueryBundle
+    ) -> Tuple[dict, dict]:
+        """Look up the cache key and cached score, if any, of each candidate node."""
+        cache_keys = {}
+        scores = {}
+        if self.rerank_cache is None:
+            return cache_keys, scores
+
+        with trace_stage(
+            self.trace, "rerank_cache", nodes_in=len(candidate_nodes)
+        ) as stage:
+            # Scores are only reused for the same rerank model and prompt
+            scorer_hash = self.rerank_cache.make_scorer_hash(
+                self.service_context.llm.metadata.model_name,
+                self.choice_select_prompt.template,
             )
-            choice_idxs = [int(choice) - 1 for choice in raw_choices]
-            choice_nodes = [nodes_batch[idx] for idx in choice_idxs]
-            relevances = relevances or [1.0 for _ in choice_nodes]
-            initial_results.extend(
-                [
-                    NodeWithScore(node=node, score=relevance)
-                    for node, relevance in zip(choice_nodes, relevances)
-                ]
+            cache_keys = {
+                node.node_id: self.rerank_cache.make_key(
+                    scorer_hash,
+                    query_bundle.query_str,
+                    self.query_context,
+                    node.node_id,
+                    node.get_content(metadata_mode=MetadataMode.LLM),
+                )
+                for node in candidate_nodes
+            }
+            cached_scores = self.rerank_cache.get_many(cache_keys.values())
+            for node in candidate_nodes:
+                if cache_keys[node.node_id] in cached_scores:
+                    scores[node.node_id] = cached_scores[cache_keys[node.node_id]]
+            stage["cache_hits"] = len(scores)
+        logger.info(f"Rerank cache hits: {len(scores)}/{len(candidate_nodes)} nodes")
+        return cache_keys, scores
+
+    def _get_uncached_batches(
+        self, candidate_nodes: List[BaseNode], scores: dict
+    ) -> List[List[BaseNode]]:
+        """Split the candidate nodes without a cached score into LLM batches."""
+        uncached_nodes = [node for node in candidate_nodes if node.node_id not in scores]
+        nodes_batches = [
+            uncached_nodes[idx : idx + self.choice_batch_size]
+            for idx in range(0, len(uncached_nodes), self.choice_batch_size)
+        ]
+        if self.rerank_cache is not None:
+            total_batches = -(-len(candidate_nodes) // self.choice_batch_size)
+            logger.info(
+                f"Rerank cache saved {total_batches - len(nodes_batches)}/{total_batches} LLM calls"
             )
+        return nodes_batches
+
+    def _cache_batch_scores(
+        self,
+        nodes_batch: List[BaseNode],
+        batch_result: List[NodeWithScore],
+        cache_keys: dict,
+    ) -> None:
+        """Store the scores of a reranked batch in the rerank cache."""
+        if self.rerank_cache is None:
+            return
+        # Nodes the LLM did not choose are cached as None (not relevant)
+        batch_scores = {node.node_id: None for node in nodes_batch}
+        batch_scores.update(
+            {result.node.node_id: result.score for result in batch_result}
+        )
+        self.rerank_cache.set_many(
+            {cache_keys[node_id]: score for node_id, score in batch_scores.items()}
+        )
+
+    def _get_top_results(
+        self,
+        candidate_nodes: List[BaseNode],
+        scores: dict,
+        batch_results: List[List[NodeWithScore]],
+    ) -> List[NodeWithScore]:
+        """Combine cached and reranked scores and keep the top_n nodes."""
+        for batch_result in batch_results:
+            for result in batch_result:
+                scores[result.node.node_id] = result.score
+
+        # Keep the candidate order so the stable sort below breaks score ties the
+        # same way regardless of concurrency or which scores came from the cache
+        initial_results: List[NodeWithScore] = [
+            NodeWithScore(node=node, score=scores[node.node_id])
+            for node in candidate_nodes
+            if scores.get(node.node_id) is not None
+        ]
 
         return sorted(initial_results, key=lambda x: x.score or 0.0, reverse=True)[
             : self.top_n
         ]
 
+    def _format_query_str(self, query_str: str) -> str:
+        """Add the query context, if any, to the question sent to the LLM."""
+        if not self.query_context:
+            return query_str
+        return (
+            "\nQUESTION_CONTEXT:\n---------------------\n"
+            f"{self.query_context}\n"
+            "---------------------\n"
+            f"QUESTION:\n---------------------\n"
+            f"{query_str}\n"
+            "---------------------\n"
+        )
+
+    def _rerank_batch_with_retry(
+        self, nodes_batch: List[BaseNode], query_str: str
+    ) -> List[NodeWithScore]:
+        """Rerank a single batch, retrying only that batch on failure."""
+        attempt = 0
+        while True:
+            try:
+                return self._rerank_batch(nodes_batch, query_str)
+            except Exception as e:
+                attempt += 1
+                delay = self._get_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                if delay:
+                    sleep(delay)
+
+    async def _arerank_batch_with_retry(
+        self, nodes_batch: List[BaseNode], query_str: str
+    ) -> List[NodeWithScore]:
+        """Async counterpart of _rerank_batch_with_retry."""
+        attempt = 0
+        while True:
+            try:
+                return await self._arerank_batch(nodes_batch, query_str)
+            except Exception as e:
+                attempt += 1
+                delay = self._get_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                if delay:
+                    await asyncio.sleep(delay)
+
+    def _get_retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Log a failed rerank attempt, and get the seconds to wait before retrying, or None to give up."""
+        if attempt >= self.max_retries:
+            logger.error(
+                f"Failed to rerank batch after {self.max_retries} attempts: {error}"
+            )
+            return None
+        logger.warning(f"Error reranking batch on attempt {attempt}: {error}")
+        return 5 if isinstance(error, openai.RateLimitError) else 0
+
+    def _rerank_batch(
+        self, nodes_batch: List[BaseNode], query_str: str
+    ) -> List[NodeWithScore]:
+        """Rerank a single batch of nodes with one LLM call."""
+        fmt_batch_str = self._format_node_batch_fn(nodes_batch)
+        logger.info(f"Reranking batch of {len(nodes_batch)} nodes...")
+        raw_response = self.service_context.llm_predictor.predict(
+            self.choice_select_prompt,
+            context_str=fmt_batch_str,
+            query_str=query_str,
+        )
+        return self._parse_batch_response(nodes_batch, raw_response)
+
+    async def _arerank_batch(
+        self, nodes_batch: List[BaseNode], query_str: str
+    ) -> List[NodeWithScore]:
+        """Async counterpart of _rerank_batch."""
+        fmt_batch_str = self._format_node_batch_fn(nodes_batch)
+        logger.info(f"Reranking batch of {len(nodes_batch)} nodes...")
+        raw_response = await self.service_context.llm_predictor.apredict(
+            self.choice_select_prompt,
+            context_str=fmt_batch_str,
+            query_str=query_str,
+        )
+        return self._parse_batch_response(nodes_batch, raw_response)
+
+    def _parse_batch_response(
+        self, nodes_batch: List[BaseNode], raw_response: str
+    ) -> List[NodeWithScore]:
+        """Turn the LLM's JSON choices for a batch into scored nodes."""
+        json_response = extract_json_response(raw_response)
+
+        raw_choices, relevances = self._parse_choice_select_answer_fn(
+            json_response, len(nodes_batch)
+        )
+        choice_idxs = [int(choice) - 1 for choice in raw_choices]
+        choice_nodes = [nodes_batch[idx] for idx in choice_idxs]
+        relevances = relevances or [1.0 for _ in choice_nodes]
+        return [
+            NodeWithScore(node=node, score=relevance)
+            for node, relevance in zip(choice_nodes, relevances)
+        ]
+
     def _parse_choice_select_answer_fn(
         self, answer: dict, num_choices: int, raise_error: bool = False
     ) -> Tuple[List[int], List[float]]:
@@ -219,10 +661,43 @@ class ModifiedLLMRerank(LLMRerank):
         return "\n\n".join(fmt_node_txts)
 
 
-def create_index(docs_dir, storage_dir):
+class PrecomputedRetriever(BaseRetriever):
+    """
+    A retriever that returns nodes that were retrieved ahead of time.
+
+    Lets retrievers that post-process a vector retriever's results, such as the
+    AutoMergingRetriever, run on the results of a multi-query search.
+    """
+
+    def __init__(self, nodes: List[NodeWithScore]):
+        """
+        Initialize the PrecomputedRetriever.
+
+        Args:
+            nodes (List[NodeWithScore]): The nodes to return.
+        """
+        super().__init__()
+        self.nodes = nodes
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return list(self.nodes)
+
+
+def create_index(
+    docs_dir,
+    storage_dir,
+    vector_store_backend=None,
+    num_workers=None,
+    shard_max_bytes=None,
+    embedding_quantization=None,
+):
     """
     Creates an index from documents located in the specified directory.
 
+    Files are loaded and chunked across a process pool, and nodes are embedded in
+    batches as they are produced. Domains larger than shard_max_bytes are split into
+    shards by subdirectory, see create_sharded_index.
+
     NOTE: This function will continue to be customized to support more file/data types.
 
     TODO: Take advantage of the "HierarchicalNodeParser" for generic text.
@@ -230,31 +705,77 @@ def create_index(docs_dir, storage_dir):
     Args:
         docs_dir (str): The directory containing the documents.
         storage_dir (str): The directory to store the created index.
+        vector_store_backend (str, optional): "numpy" or "simple". Defaults to VECTOR_STORE_BACKEND.
+        num_workers (int, optional): The number of loader processes. Defaults to INGEST_NUM_WORKERS.
+        shard_max_bytes (int, optional): The maximum total file size of a single index or shard. Defaults to SHARD_MAX_BYTES, 0 never shards.
+        embedding_quantization (str, optional): "float32", "float16" or "int8" embeddings for the similarity scan. Defaults to EMBEDDING_QUANTIZATION.
 
     Returns:
-        VectorStoreIndex: The created index.
+        Union[VectorStoreIndex, ShardedIndex]: The created index.
     """
-    IPYNBReader = download_loader("IPYNBReader")
-    ipynb_loader = IPYNBReader(concatenate=True)
-
-    try:
-        documents = SimpleDirectoryReader(
-            docs_dir, recursive=True, file_extractor={".ipynb": ipynb_loader}
-        ).load_data()
-    except Exception as e:
-        logger.error(f"Error reading documents: {e}")
-        raise
-
-    parser = LangchainNodeParser(
-        RecursiveCharacterTextSplitter.from_language(
-            language=Language.PYTHON, chunk_size=8000, chunk_overlap=1000
+    input_files = list_doc_files(docs_dir)
+
+    shard_max_bytes = SHARD_MAX_BYTES if shard_max_bytes is None else shard_max_bytes
+    if shard_max_bytes and sum(os.path.getsize(path) for path in input_files) > (
+        shard_max_bytes
+    ):
+        return create_sharded_index(
+            docs_dir,
+            storage_dir,
+            input_files,
+            shard_max_bytes,
+            vector_store_backend=vector_store_backend,
+            num_workers=num_workers,
+            embedding_quantization=embedding_quantization,
         )
+
+    index = build_index(
+        docs_dir,
+        storage_dir,
+        input_files,
+        vector_store_backend=vector_store_backend,
+        num_workers=num_workers,
+        embedding_quantization=embedding_quantization,
     )
-    nodes = parser.get_nodes_from_documents(documents)
+    index_cache.put(storage_dir, index)
+
+    return index
+
+
+def build_index(
+    docs_dir,
+    storage_dir,
+    input_files,
+    vector_store_backend=None,
+    num_workers=None,
+    embedding_quantization=None,
+):
+    """
+    Builds and persists an index, with its lexical index and manifest, over a list of files.
+
+    Args:
+        docs_dir (str): The directory containing the documents.
+        storage_dir (str): The directory to store the created index.
+        input_files (List[str]): The file paths to index.
+        vector_store_backend (str, optional): "numpy" or "simple". Defaults to VECTOR_STORE_BACKEND.
+        num_workers (int, optional): The number of loader processes. Defaults to INGEST_NUM_WORKERS.
+        embedding_quantization (str, optional): "float32", "float16" or "int8" embeddings for the similarity scan. Defaults to EMBEDDING_QUANTIZATION.
 
+    Returns:
+        VectorStoreIndex: The created index.
+    """
     print("Creating index at:", storage_dir)
 
-    index = VectorStoreIndex(nodes)
+    index_service_context = get_index_service_context()
+    index = VectorStoreIndex(
+        [],
+        service_context=index_service_context,
+        storage_context=get_new_storage_context(
+            vector_store_backend, embedding_quantization
+        ),
+    )
+    ingested_files = ingest_files(index, input_files, num_workers=num_workers)
+    log_embedding_cache_stats(index_service_context)
 
     try:
         index.storage_context.persist(persist_dir=storage_dir)
@@ -262,231 +783,2481 @@ def create_index(docs_dir, storage_dir):
         logger.error(f"Error saving index: {e}")
         raise
 
+    create_lexical_index(index, storage_dir)
+
+    manifest = {"files": {}}
+    update_index_manifest(manifest, docs_dir, ingested_files)
+    save_json(manifest, os.path.join(storage_dir, INDEX_MANIFEST_FNAME))
+
     return index
 
 
-def rag_fusion(query, query_context=None, number_of_variations=4):
+def create_sharded_index(
+    docs_dir,
+    storage_dir,
+    input_files,
+    shard_max_bytes,
+    vector_store_backend=None,
+    num_workers=None,
+    embedding_quantization=None,
+):
     """
-    Generates query variations for Retriever-Augmented Generation (RAG) fusion.
+    Creates a sharded index: the files are split into shards by top-level subdirectory, and each shard is persisted as its own index.
 
     Args:
-        query (str): The original query.
-        query_context (str): Context to enrich the query variations.
-        number_of_variations (int): The number of query variations to generate.
+        docs_dir (str): The directory containing the documents.
+        storage_dir (str): The directory to store the created index.
+        input_files (List[str]): The file paths to index.
+        shard_max_bytes (int): The maximum total file size of a shard.
+        vector_store_backend (str, optional): "numpy" or "simple". Defaults to VECTOR_STORE_BACKEND.
+        num_workers (int, optional): The number of loader processes. Defaults to INGEST_NUM_WORKERS.
+        embedding_quantization (str, optional): "float32", "float16" or "int8" embeddings for the similarity scan. Defaults to EMBEDDING_QUANTIZATION.
 
     Returns:
-        List[str]: A list of query variations.
+        ShardedIndex: The created index, with every shard loaded.
     """
-    logger.info("Getting query variations for RAG fusion...")
-    rag_fusion_prompt = RAG_FUSION_PROMPT.format(
-        query=query,
-        query_context=query_context,
-        number_of_variations=number_of_variations,
-    )
-
-    try:
-        rag_fusion_response = light_gpt4_wrapper_autogen(
-            query=rag_fusion_prompt, return_json=True
+    shard_plan = plan_shards(docs_dir, input_files, shard_max_bytes)
+    print(f"Creating sharded index with {len(shard_plan)} shards at:", storage_dir)
+
+    # Shards added by later refreshes are built with the same quantization
+    manifest = {
+        "shard_max_bytes": shard_max_bytes,
+        "embedding_quantization": embedding_quantization or EMBEDDING_QUANTIZATION,
+        "shards": [],
+    }
+    shards = {}
+    for shard in shard_plan:
+        shard_name = f"shard_{len(manifest['shards']):04d}"
+        shards[shard_name] = build_index(
+            docs_dir,
+            ShardedIndex.get_shard_dir(storage_dir, shard_name),
+            shard["files"],
+            vector_store_backend=vector_store_backend,
+            num_workers=num_workers,
+            embedding_quantization=embedding_quantization,
         )
-    except Exception as e:
-        logger.error(f"Error in RAG fusion: {e}")
-        raise
+        manifest["shards"].append({"name": shard_name, "dirs": shard["dirs"]})
+    save_node_shards(storage_dir, list(shards))
+    # The manifest is written last, so an interrupted build is not mistaken for a complete one
+    ShardedIndex.save_manifest(storage_dir, manifest)
+
+    index = ShardedIndex(
+        storage_dir,
+        list(shards),
+        _load_vector_index,
+        get_index_service_context(),
+        shards=shards,
+    )
+    index_cache.put(storage_dir, index)
 
-    query_variations = [
-        variation["query"] for variation in rag_fusion_response["query_variations"]
-    ]
-    return query_variations
+    return index
 
 
-def get_retrieved_nodes(
-    query_str,
-    index,
-    vector_top_k=40,
-    reranker_top_n=20,
-    rerank=True,
-    score_threshold=5,
-    fusion=True,
-    query_context=None,
-):
+def refresh_index(docs_dir, storage_dir, num_workers=None):
     """
-    Retrieves nodes based on the provided query string and other parameters.
+    Incrementally updates a persisted index to match the documents on disk.
+
+    Only new or changed files are re-parsed and re-embedded. Nodes of changed and deleted files are removed from the docstore and vector store. Indexes persisted without a manifest are rebuilt from scratch.
 
     Args:
-        query_str (str): The query string.
-        index: The index to search in.
-        vector_top_k (int): The number of top vectors to retrieve.
-        reranker_top_n (int): The number of top nodes to keep after reranking.
-        rerank (bool): Flag to perform reranking.
-        score_threshold (int): The threshold for score filtering.
-        fusion (bool): Flag to perform fusion.
-        query_context: Additional context for the query.
+        docs_dir (str): The directory containing the documents.
+        storage_dir (str): The directory the index is persisted in.
+        num_workers (int, optional): The number of loader processes. Defaults to INGEST_NUM_WORKERS.
 
     Returns:
-        List: A list of retrieved nodes.
+        Union[VectorStoreIndex, ShardedIndex]: The updated index.
     """
-    json_llm_predictor = JSONLLMPredictor(llm=llm3_general)
-
-    service_context3_general = ServiceContext.from_defaults(
-        llm_predictor=json_llm_predictor
-    )
+    if ShardedIndex.exists(storage_dir):
+        return refresh_sharded_index(docs_dir, storage_dir, num_workers=num_workers)
+
+    manifest_path = os.path.join(storage_dir, INDEX_MANIFEST_FNAME)
+    manifest = load_json(manifest_path)
+    if not manifest:
+        logger.warning(f"No index manifest found at {storage_dir}, rebuilding index")
+        return create_index(
+            docs_dir=docs_dir, storage_dir=storage_dir, num_workers=num_workers
+        )
 
-    reranker_context = service_context3_general
+    index = load_index(storage_dir)
 
-    logger.info(f"Getting top {vector_top_k} nodes")
-    # configure retriever
+    if update_index_files(
+        index, docs_dir, storage_dir, manifest, list_doc_files(docs_dir), num_workers
+    ):
+        index_cache.put(storage_dir, index)
 
-    if fusion:
-        query_variations = rag_fusion(query_str, query_context)
-        query_variations.append(query_str)
-        logger.info(f"Query variations for RAG fusion: {query_variations}")
-    else:
-        query_variations = [query_str]
+    return index
 
-    retrieved_nodes = []
-    num_of_variations = len(query_variations)
-    logger.info(f"Number of variations: {num_of_variations}")
-    results_per_variation = int(vector_top_k / num_of_variations)
-    logger.info(f"Results per variation: {results_per_variation}")
-    for variation in query_variations:
-        base_retriever = VectorIndexRetriever(
-            index=index,
-            similarity_top_k=results_per_variation,
-        )
 
-        retriever = AutoMergingRetriever(
-            base_retriever, index.storage_context, verbose=False
-        )
-        query_bundle = QueryBundle(variation)
+def update_index_files(
+    index, docs_dir, storage_dir, manifest, input_files, num_workers=None
+):
+    """
+    Updates a persisted (non-sharded) index and its manifest to match a list of files.
 
-        variation_nodes = retrieve_nodes_with_retry(retriever, query_bundle)
+    Args:
+        index (VectorStoreIndex): The loaded index, updated in place.
+        docs_dir (str): The directory containing the documents.
+        storage_dir (str): The directory the index is persisted in.
+        manifest (dict): The index manifest, updated in place and persisted.
+        input_files (List[str]): The file paths the index should contain.
+        num_workers (int, optional): The number of loader processes. Defaults to INGEST_NUM_WORKERS.
 
-        logger.debug(f"ORIGINAL NODES for query: {variation}\n\n")
-        for node in variation_nodes:
-            file_info = node.metadata.get("file_name") or node.metadata.get("file_path")
-            node_info = (
-                f"FILE INFO: {file_info}\n"
-                f"NODE ID: {node.id_}\n"
-                f"NODE Score: {node.score}\n"
-                f"NODE Length: {len(node.text)}\n"
-                f"NODE Text: {node.text}\n-----------\n"
-            )
-            logger.debug(node_info)
+    Returns:
+        bool: True if the index was updated and persisted.
+    """
+    current_files = {os.path.relpath(path, docs_dir): path for path in input_files}
+    previous_files = manifest["files"]
+
+    deleted_files = [rel for rel in previous_files if rel not in current_files]
+    changed_files = []
+    new_files = []
+    # Fingerprints of the changed files, reused for their new manifest entries
+    fingerprints = {}
+    for rel, path in current_files.items():
+        if rel not in previous_files:
+            new_files.append(rel)
+            continue
+        fingerprint = get_file_fingerprint(path, previous_files[rel])
+        if fingerprint["sha256"] != previous_files[rel]["sha256"]:
+            changed_files.append(rel)
+            fingerprints[path] = fingerprint
 
-        # add variation nodes to retrieved nodes
-        retrieved_nodes.extend(variation_nodes)
+    logger.info(
+        f"Index refresh: {len(new_files)} new, {len(changed_files)} changed, "
+        f"{len(deleted_files)} deleted files"
+    )
+    # Indexes built before lexical indexing get their lexical index on the next refresh
+    if not (new_files or changed_files or deleted_files) and BM25Index.exists(
+        storage_dir
+    ):
+        return False
+
+    print("Refreshing index at:", storage_dir)
+
+    deleted_node_ids = []
+    for rel in deleted_files + changed_files:
+        for doc_id in previous_files[rel]["doc_ids"]:
+            index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        deleted_node_ids.extend(previous_files[rel]["node_ids"])
+        del previous_files[rel]
+
+    updated_input_files = [current_files[rel] for rel in new_files + changed_files]
+    ingested_files = ingest_files(
+        index, updated_input_files, num_workers=num_workers, fingerprints=fingerprints
+    )
+    log_embedding_cache_stats(index.service_context)
 
-    retrieved_nodes = remove_duplicate_nodes(retrieved_nodes)
+    try:
+        index.storage_context.persist(persist_dir=storage_dir)
+    except Exception as e:
+        logger.error(f"Error saving index: {e}")
+        raise
 
-    if rerank:
-        retrieved_nodes = rerank_nodes(
-            nodes=retrieved_nodes,
-            query_str=query_str,
-            query_context=query_context,
-            context=reranker_context,
-            top_n=reranker_top_n,
-            score_threshold=score_threshold,
-        )
+    update_lexical_index(
+        index,
+        storage_dir,
+        deleted_node_ids,
+        [node_id for ids in ingested_files.values() for node_id in ids["node_ids"]],
+    )
 
-    total_tokens = sum(count_token(node.text) for node in retrieved_nodes)
-    logger.info(f"Total node tokens: {total_tokens}")
+    update_index_manifest(manifest, docs_dir, ingested_files)
+    save_json(manifest, os.path.join(storage_dir, INDEX_MANIFEST_FNAME))
 
-    return retrieved_nodes
+    return True
 
 
-def retrieve_nodes_with_retry(retriever, query_bundle, max_retries=3):
+def refresh_sharded_index(docs_dir, storage_dir, num_workers=None):
     """
-    Attempts to retrieve nodes with a retry mechanism.
+    Incrementally updates a persisted sharded index to match the documents on disk.
+
+    Files stay in the shard they were indexed in. New files go to the last shard of
+    their top-level subdirectory, and files of new top-level subdirectories are indexed
+    into new shards. Only shards with new, changed or deleted files are loaded. Shards
+    persisted without a manifest are rebuilt from scratch.
 
     Args:
-        retriever: The retriever to use for node retrieval.
-        query_bundle: The query bundle for the retriever.
-        max_retries (int): Maximum number of retries.
+        docs_dir (str): The directory containing the documents.
+        storage_dir (str): The directory the sharded index is persisted in.
+        num_workers (int, optional): The number of loader processes. Defaults to INGEST_NUM_WORKERS.
 
     Returns:
-        List: A list of retrieved nodes.
+        ShardedIndex: The updated index.
     """
-    attempt = 0
-    while attempt < max_retries:
+    index = load_index(storage_dir)
+    sharded_manifest = ShardedIndex.load_manifest(storage_dir)
+
+    shard_manifests = {}
+    file_shards = {}
+    dir_shards = {}
+    # Top-level subdirectories of shards persisted without a manifest
+    rebuilt_dir_shards = {}
+    for shard in sharded_manifest["shards"]:
+        shard_dir = ShardedIndex.get_shard_dir(storage_dir, shard["name"])
+        shard_manifests[shard["name"]] = load_json(
+            os.path.join(shard_dir, INDEX_MANIFEST_FNAME)
+        )
+        if not shard_manifests[shard["name"]]:
+            logger.warning(f"No index manifest found at {shard_dir}, rebuilding shard")
+            shard_manifests[shard["name"]] = None
+            for top_level_dir in shard["dirs"]:
+                rebuilt_dir_shards[top_level_dir] = shard["name"]
+        else:
+            for rel in shard_manifests[shard["name"]]["files"]:
+                file_shards[rel] = shard["name"]
+        for top_level_dir in shard["dirs"]:
+            dir_shards[top_level_dir] = shard["name"]
+
+    shard_files = {shard_name: [] for shard_name in shard_manifests}
+    unassigned_files = []
+    for path in list_doc_files(docs_dir):
+        # Files of a shard without a manifest are the files no other shard lists
+        top_level_dir = get_top_level_dir(docs_dir, path)
+        shard_name = (
+            file_shards.get(os.path.relpath(path, docs_dir))
+            or rebuilt_dir_shards.get(top_level_dir)
+            or dir_shards.get(top_level_dir)
+        )
+        if shard_name is None:
+            unassigned_files.append(path)
+        else:
+            shard_files[shard_name].append(path)
+
+    shards = index.get_loaded_shards()
+    updated = False
+    for shard_name, input_files in shard_files.items():
+        shard_dir = ShardedIndex.get_shard_dir(storage_dir, shard_name)
+        shard_manifest = shard_manifests[shard_name]
+        if shard_manifest is None:
+            shards[shard_name] = build_index(
+                docs_dir,
+                shard_dir,
+                input_files,
+                num_workers=num_workers,
+                embedding_quantization=sharded_manifest.get("embedding_quantization"),
+            )
+            updated = True
+            continue
+        if not has_index_changes(docs_dir, shard_manifest, input_files):
+            continue
+        shards[shard_name] = index.get_shard(shard_name)
+        updated = update_index_files(
+            shards[shard_name],
+            docs_dir,
+            shard_dir,
+            shard_manifest,
+            input_files,
+            num_workers,
+        ) or updated
+
+    if unassigned_files:
+        shard_max_bytes = sharded_manifest.get("shard_max_bytes") or SHARD_MAX_BYTES
+        for shard in plan_shards(docs_dir, unassigned_files, shard_max_bytes):
+            shard_name = f"shard_{len(sharded_manifest['shards']):04d}"
+            shards[shard_name] = build_index(
+                docs_dir,
+                ShardedIndex.get_shard_dir(storage_dir, shard_name),
+                shard["files"],
+                num_workers=num_workers,
+                embedding_quantization=sharded_manifest.get("embedding_quantization"),
+            )
+            sharded_manifest["shards"].append({"name": shard_name, "dirs": shard["dirs"]})
+        ShardedIndex.save_manifest(storage_dir, sharded_manifest)
+        updated = True
+
+    if not updated:
+        return index
+
+    save_node_shards(storage_dir, [shard["name"] for shard in sharded_manifest["shards"]])
+    index = ShardedIndex(
+        storage_dir,
+        [shard["name"] for shard in sharded_manifest["shards"]],
+        _load_vector_index,
+        index.service_context,
+        shards=shards,
+    )
+    index_cache.put(storage_dir, index)
+
+    return index
+
+
+def save_node_shards(storage_dir, shard_names):
+    """
+    Saves the node id to shard table of a sharded index, from the node ids in the shard manifests.
+
+    Args:
+        storage_dir (str): The directory the sharded index is persisted in.
+        shard_names (List[str]): The names of the shards.
+    """
+    node_shards = {}
+    for shard_name in shard_names:
+        shard_manifest = load_json(
+            os.path.join(
+                ShardedIndex.get_shard_dir(storage_dir, shard_name), INDEX_MANIFEST_FNAME
+            )
+        )
+        node_shards[shard_name] = [
+            node_id
+            for entry in (shard_manifest or {}).get("files", {}).values()
+            for node_id in entry["node_ids"]
+        ]
+    ShardedIndex.save_node_shards(storage_dir, node_shards)
+
+
+def has_index_changes(docs_dir, manifest, input_files):
+    """
+    Checks whether any file of an index was added, changed, or deleted since it was built.
+
+    Args:
+        docs_dir (str): The directory containing the documents.
+        manifest (dict): The index manifest.
+        input_files (List[str]): The file paths the index should contain.
+
+    Returns:
+        bool: True if the index needs an update.
+    """
+    previous_files = manifest["files"]
+    current_files = {os.path.relpath(path, docs_dir): path for path in input_files}
+    if current_files.keys() != previous_files.keys():
+        return True
+    return any(
+        get_file_fingerprint(path, previous_files[rel])["sha256"]
+        != previous_files[rel]["sha256"]
+        for rel, path in current_files.items()
+    )
+
+
+def list_doc_files(docs_dir):
+    """
+    Lists the files that would be indexed from a document directory.
+
+    Args:
+        docs_dir (str): The directory containing the documents.
+
+    Returns:
+        List[str]: The file paths, in the order SimpleDirectoryReader reads them.
+    """
+    return [str(path) for path in SimpleDirectoryReader(docs_dir, recursive=True).input_files]
+
+
+def ingest_files(index, input_files, num_workers=None, fingerprints=None):
+    """
+    Loads, chunks and inserts files into an index.
+
+    Files are fingerprinted, read and split across a pool of worker processes, see
+    utils.ingest. Nodes are handed to the embedder in batches of
+    INGEST_INSERT_BATCH_SIZE while the workers keep parsing, so parsing and embedding
+    overlap.
+
+    Args:
+        index (VectorStoreIndex): The index to insert nodes into.
+        input_files (List[str]): The file paths to ingest.
+        num_workers (int, optional): The number of loader processes. Defaults to INGEST_NUM_WORKERS.
+        fingerprints (Dict[str, dict], optional): Fingerprints already computed for some file paths, which are not recomputed.
+
+    Returns:
+        Dict[str, dict]: The manifest entry of each file path: its "sha256", "mtime_ns" and "size" fingerprint, and the "doc_ids" and "node_ids" produced from it.
+    """
+    num_workers = num_workers or INGEST_NUM_WORKERS
+    num_workers = max(1, min(num_workers, len(input_files)))
+    ingested_files = {}
+    pending_nodes = []
+    num_nodes = 0
+    start_time = perf_counter()
+
+    def insert_pending_nodes():
+        index.insert_nodes(pending_nodes)
+        pending_nodes.clear()
+
+    input_fingerprints = [(fingerprints or {}).get(path) for path in input_files]
+
+    if num_workers == 1:
+        executor = None
+        results = map(load_and_parse_file, input_files, input_fingerprints)
+    else:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        # map keeps the file order, so builds are reproducible
+        results = executor.map(
+            load_and_parse_file,
+            input_files,
+            input_fingerprints,
+            chunksize=INGEST_FILES_PER_TASK,
+        )
+
+    try:
+        for num_files, (path, (fingerprint, doc_ids, nodes)) in enumerate(
+            zip(input_files, results), start=1
+        ):
+            ingested_files[path] = {
+                **fingerprint,
+                "doc_ids": doc_ids,
+                "node_ids": [node.node_id for node in nodes],
+            }
+            pending_nodes.extend(nodes)
+            num_nodes += len(nodes)
+            if len(pending_nodes) >= INGEST_INSERT_BATCH_SIZE:
+                insert_pending_nodes()
+            if num_files % 100 == 0 or num_files == len(input_files):
+                print(f"Ingested {num_files}/{len(input_files)} files ({num_nodes} nodes)")
+        if pending_nodes:
+            insert_pending_nodes()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    elapsed = max(perf_counter() - start_time, 1e-9)
+    print(
+        f"Ingested {len(input_files)} files into {num_nodes} nodes in {elapsed:.1f}s "
+        f"({len(input_files) / elapsed:.1f} files/s, {num_nodes / elapsed:.1f} nodes/s, "
+        f"{num_workers} workers)"
+    )
+
+    return ingested_files
+
+
+def update_index_manifest(manifest, docs_dir, ingested_files):
+    """
+    Records the content hash, document ids and node ids of indexed files in the manifest.
+
+    The content hash is the fingerprint taken before the file was parsed, so files are
+    not hashed again after ingestion.
+
+    Args:
+        manifest (dict): The manifest to update in place.
+        docs_dir (str): The directory containing the documents.
+        ingested_files (Dict[str, dict]): The manifest entry of each indexed file path, as returned by ingest_files.
+    """
+    for path, entry in ingested_files.items():
+        manifest["files"][os.path.relpath(path, docs_dir)] = entry
+
+
+def load_index(storage_dir):
+    """
+    Loads a persisted index, reusing the process-wide cached copy when the persisted
+    files have not changed since it was loaded.
+
+    Args:
+        storage_dir (str): The directory the index is persisted in.
+
+    Returns:
+        VectorStoreIndex: The loaded index.
+    """
+    return index_cache.get(storage_dir, _load_index_from_storage_dir)
+
+
+def create_lexical_index(index, storage_dir):
+    """
+    Builds and persists a BM25 lexical index over every node in an index's docstore.
+
+    Args:
+        index (VectorStoreIndex): The vector index.
+        storage_dir (str): The directory the vector index is persisted in.
+
+    Returns:
+        BM25Index: The lexical index.
+    """
+    lexical_index = BM25Index.from_texts(
+        (node_id, get_lexical_text(node)) for node_id, node in index.docstore.docs.items()
+    )
+    lexical_index.persist(storage_dir)
+    logger.info(
+        f"Lexical index: {len(lexical_index.node_ids)} nodes, "
+        f"{len(lexical_index.vocab)} terms"
+    )
+    return lexical_index
+
+
+def update_lexical_index(index, storage_dir, deleted_node_ids, added_node_ids):
+    """
+    Updates the persisted BM25 lexical index of an index after some of its nodes changed.
+
+    Only the added nodes are read from the docstore and tokenized. Indexes persisted
+    without a lexical index get one built over every node.
+
+    Args:
+        index (VectorStoreIndex): The updated vector index.
+        storage_dir (str): The directory the vector index is persisted in.
+        deleted_node_ids (List[str]): The ids of the nodes removed from the index.
+        added_node_ids (List[str]): The ids of the nodes inserted into the index.
+
+    Returns:
+        BM25Index: The lexical index.
+    """
+    if not BM25Index.exists(storage_dir):
+        return create_lexical_index(index, storage_dir)
+
+    lexical_index = lexical_index_cache.get(storage_dir, BM25Index.load).update(
+        deleted_node_ids,
+        (
+            (node_id, get_lexical_text(index.docstore.get_node(node_id)))
+            for node_id in added_node_ids
+        ),
+    )
+    lexical_index.persist(storage_dir)
+    logger.info(
+        f"Lexical index: {len(deleted_node_ids)} nodes removed, "
+        f"{len(added_node_ids)} nodes added, {len(lexical_index.vocab)} terms"
+    )
+    return lexical_index
+
+
+def get_lexical_text(node):
+    """
+    Gets the text of a node that is indexed for lexical retrieval.
+
+    Args:
+        node (BaseNode): The node.
+
+    Returns:
+        str: The file name of the node followed by its content.
+    """
+    file_name = node.metadata.get("file_name", "")
+    return f"{file_name}\n{node.get_content(metadata_mode=MetadataMode.NONE)}"
+
+
+def load_lexical_index(storage_dir):
+    """
+    Loads the persisted BM25 lexical index of an index, reusing the process-wide cached copy when unchanged.
+
+    Args:
+        storage_dir (str): The directory the index is persisted in.
+
+    Returns:
+        Optional[Union[BM25Index, ShardedLexicalIndex]]: The lexical index, or None for indexes built without one.
+    """
+    if ShardedIndex.exists(storage_dir):
+        shard_names = [
+            shard["name"] for shard in ShardedIndex.load_manifest(storage_dir)["shards"]
+        ]
+        return ShardedLexicalIndex(
+            [ShardedIndex.get_shard_dir(storage_dir, name) for name in shard_names],
+            load_lexical_index,
+        )
+    if not BM25Index.exists(storage_dir):
+        return None
+    return lexical_index_cache.get(storage_dir, BM25Index.load)
+
+
+def get_new_storage_context(
+    vector_store_backend=None, embedding_quantization=None, docstore_backend=None
+):
+    """
+    Creates the storage context for a new index.
+
+    Args:
+        vector_store_backend (str, optional): "numpy" or "simple". Defaults to VECTOR_STORE_BACKEND.
+        embedding_quantization (str, optional): "float32", "float16" or "int8" embeddings for the similarity scan of the numpy backend. Defaults to EMBEDDING_QUANTIZATION.
+        docstore_backend (str, optional): "lazy" or "simple". Defaults to DOCSTORE_BACKEND.
+
+    Returns:
+        StorageContext: The storage context.
+    """
+    vector_store_backend = vector_store_backend or VECTOR_STORE_BACKEND
+    embedding_quantization = embedding_quantization or EMBEDDING_QUANTIZATION
+    docstore_backend = docstore_backend or DOCSTORE_BACKEND
+    if docstore_backend == "lazy":
+        docstore = LazyDocumentStore()
+    elif docstore_backend == "simple":
+        docstore = None
+    else:
+        raise ValueError(f"Unknown docstore backend: {docstore_backend}")
+
+    if vector_store_backend == "numpy":
+        return StorageContext.from_defaults(
+            docstore=docstore,
+            vector_store=NumpyVectorStore(quantization=embedding_quantization),
+        )
+    elif vector_store_backend == "simple":
+        if embedding_quantization not in (None, "float32"):
+            logger.warning(
+                f"Ignoring {embedding_quantization} embedding quantization, the simple vector store only stores float32 embeddings"
+            )
+        return StorageContext.from_defaults(docstore=docstore)
+    raise ValueError(f"Unknown vector store backend: {vector_store_backend}")
+
+
+def _load_index_from_storage_dir(storage_dir):
+    if ShardedIndex.exists(storage_dir):
+        return ShardedIndex.load(
+            storage_dir, _load_vector_index, get_index_service_context()
+        )
+    return _load_vector_index(storage_dir)
+
+
+def _load_vector_index(storage_dir):
+    logger.info(f"Loading index at: {storage_dir}")
+    # Indexes built with the simple backends are loaded from their JSON files
+    storage_kwargs = {}
+    if NumpyVectorStore.exists(storage_dir):
+        storage_kwargs["vector_store"] = NumpyVectorStore.from_persist_dir(
+            storage_dir, quantization=EMBEDDING_QUANTIZATION
+        )
+    if LazyDocumentStore.exists(storage_dir):
+        storage_kwargs["docstore"] = LazyDocumentStore.from_persist_dir(storage_dir)
+    storage_context = StorageContext.from_defaults(
+        persist_dir=storage_dir, **storage_kwargs
+    )
+    return load_index_from_storage(
+        storage_context, service_context=get_index_service_context()
+    )
+
+
+def get_index_service_context():
+    """
+    Creates the service context used to build and query indexes, with node embeddings going through the shared embedding cache.
+
+    Query embeddings bypass the cache, see get_query_embed_model.
+
+    Returns:
+        ServiceContext: The service context.
+    """
+    embed_model = ServiceContext.from_defaults().embed_model
+    return ServiceContext.from_defaults(
+        embed_model=CachedEmbedding(embed_model, embedding_cache)
+    )
+
+
+def log_embedding_cache_stats(service_context):
+    """
+    Logs how many embeddings were served from the embedding cache.
+
+    Args:
+        service_context (ServiceContext): The service context used to embed nodes.
+    """
+    embed_model = service_context.embed_model
+    if isinstance(embed_model, CachedEmbedding):
+        stats = embed_model.get_stats()
+        logger.info(
+            f"Embedding cache: {stats['hits']} cached, {stats['misses']} newly embedded"
+        )
+
+
+def get_query_embed_model(index):
+    """
+    Gets the embedding model of an index's queries, which bypasses the embedding cache.
+
+    Only node embeddings are cached. Every question and query variation is new text,
+    so caching them would grow the cache by one vector per query forever.
+
+    Args:
+        index: The index whose embedding model should be used.
+
+    Returns:
+        BaseEmbedding: The embedding model, without the cache.
+    """
+    embed_model = index.service_context.embed_model
+    if isinstance(embed_model, CachedEmbedding):
+        return embed_model.uncached_model
+    return embed_model
+
+
+def rag_fusion(
+    query,
+    query_context=None,
+    number_of_variations=4,
+    trace=None,
+    latency_budget=None,
+    use_cache=True,
+):
+    """
+    Generates query variations for Retriever-Augmented Generation (RAG) fusion.
+
+    Variations are reused from the persistent fusion cache. On a cache miss with a
+    latency budget that the expected fusion latency exceeds, fusion is skipped (no
+    variations are returned) and the variations are generated in the background, so
+    the next time the query is asked they are cached.
+
+    Args:
+        query (str): The original query.
+        query_context (str): Context to enrich the query variations.
+        number_of_variations (int): The number of query variations to generate.
+        trace (Optional[RAGTrace]): Trace to record the fusion stage on.
+        latency_budget (Optional[float]): The seconds fusion may add on a cache miss. None always waits for the variations.
+        use_cache (bool): Flag to reuse and store variations in the persistent fusion cache.
+
+    Returns:
+        List[str]: A list of query variations.
+    """
+    logger.info("Getting query variations for RAG fusion...")
+    with trace_stage(trace, "rag_fusion") as stage:
+        query_variations = get_cached_query_variations(
+            query, query_context, number_of_variations, stage, latency_budget, use_cache
+        )
+        if query_variations is not None:
+            return query_variations
+
+        query_variations = generate_query_variations(
+            query, query_context, number_of_variations, stage=stage
+        )
+        store_query_variations(
+            query,
+            query_context,
+            number_of_variations,
+            query_variations,
+            stage,
+            use_cache,
+        )
+    return query_variations
+
+
+async def a_rag_fusion(
+    query,
+    query_context=None,
+    number_of_variations=4,
+    trace=None,
+    latency_budget=None,
+    use_cache=True,
+):
+    """
+    Async counterpart of rag_fusion.
+
+    Args:
+        query (str): The original query.
+        query_context (str): Context to enrich the query variations.
+        number_of_variations (int): The number of query variations to generate.
+        trace (Optional[RAGTrace]): Trace to record the fusion stage on.
+        latency_budget (Optional[float]): The seconds fusion may add on a cache miss. None always waits for the variations.
+        use_cache (bool): Flag to reuse and store variations in the persistent fusion cache.
+
+    Returns:
+        List[str]: A list of query variations.
+    """
+    logger.info("Getting query variations for RAG fusion...")
+    with trace_stage(trace, "rag_fusion") as stage:
+        query_variations = get_cached_query_variations(
+            query, query_context, number_of_variations, stage, latency_budget, use_cache
+        )
+        if query_variations is not None:
+            return query_variations
+
+        query_variations = await a_generate_query_variations(
+            query, query_context, number_of_variations, stage=stage
+        )
+        store_query_variations(
+            query,
+            query_context,
+            number_of_variations,
+            query_variations,
+            stage,
+            use_cache,
+        )
+    return query_variations
+
+
+def get_cached_query_variations(
+    query, query_context, number_of_variations, stage, latency_budget, use_cache
+):
+    """
+    Gets the query variations rag_fusion can return without calling the fusion LLM.
+
+    Args:
+        query (str): The original query.
+        query_context (str): Context to enrich the query variations.
+        number_of_variations (int): The number of query variations to generate.
+        stage (dict): The rag_fusion trace stage.
+        latency_budget (Optional[float]): The seconds fusion may add on a cache miss. None always waits for the variations.
+        use_cache (bool): Flag to reuse variations from the persistent fusion cache.
+
+    Returns:
+        Optional[List[str]]: The cached variations, an empty list if fusion is skipped, or None if the variations must be generated.
+    """
+    if use_cache:
+        query_variations = fusion_cache.get(query, query_context, number_of_variations)
+        stage["cache_hit"] = query_variations is not None
+        if query_variations is not None:
+            logger.info("Using cached query variations")
+            stage["variations_out"] = len(query_variations)
+            return query_variations
+
+    if should_skip_fusion(latency_budget):
+        logger.info(
+            f"Skipping RAG fusion, expected latency {fusion_latency_estimate:.1f}s "
+            f"exceeds the budget of {latency_budget}s"
+        )
+        stage["skipped"] = True
+        if use_cache:
+            warm_fusion_cache(query, query_context, number_of_variations)
+        return []
+    return None
+
+
+def store_query_variations(
+    query, query_context, number_of_variations, query_variations, stage, use_cache
+):
+    """
+    Records generated query variations on the trace stage and in the fusion cache.
+
+    Args:
+        query (str): The original query.
+        query_context (str): Context to enrich the query variations.
+        number_of_variations (int): The number of query variations requested.
+        query_variations (List[str]): The generated variations.
+        stage (dict): The rag_fusion trace stage.
+        use_cache (bool): Flag to store the variations in the persistent fusion cache.
+    """
+    if use_cache:
+        fusion_cache.set(query, query_context, number_of_variations, query_variations)
+    stage["variations_out"] = len(query_variations)
+
+
+def get_rag_fusion_prompt(query, query_context, number_of_variations):
+    """
+    Builds the prompt asking the fusion LLM for query variations.
+
+    Args:
+        query (str): The original query.
+        query_context (str): Context to enrich the query variations.
+        number_of_variations (int): The number of query variations to generate.
+
+    Returns:
+        str: The prompt.
+    """
+    return RAG_FUSION_PROMPT.format(
+        query=query,
+        query_context=query_context,
+        number_of_variations=number_of_variations,
+    )
+
+
+def generate_query_variations(query, query_context, number_of_variations, stage=None):
+    """
+    Generates query variations with the fusion LLM.
+
+    Args:
+        query (str): The original query.
+        query_context (str): Context to enrich the query variations.
+        number_of_variations (int): The number of query variations to generate.
+        stage (Optional[dict]): The trace stage to record the LLM call on.
+
+    Returns:
+        List[str]: A list of query variations.
+    """
+    rag_fusion_prompt = get_rag_fusion_prompt(
+        query, query_context, number_of_variations
+    )
+
+    start = perf_counter()
+    try:
+        rag_fusion_response = light_gpt4_wrapper_autogen(
+            query=rag_fusion_prompt, return_json=True
+        )
+    except Exception as e:
+        logger.error(f"Error in RAG fusion: {e}")
+        raise
+    record_fusion_latency(perf_counter() - start)
+
+    return parse_query_variations(rag_fusion_prompt, rag_fusion_response, stage)
+
+
+async def a_generate_query_variations(
+    query, query_context, number_of_variations, stage=None
+):
+    """
+    Async counterpart of generate_query_variations.
+
+    Args:
+        query (str): The original query.
+        query_context (str): Context to enrich the query variations.
+        number_of_variations (int): The number of query variations to generate.
+        stage (Optional[dict]): The trace stage to record the LLM call on.
+
+    Returns:
+        List[str]: A list of query variations.
+    """
+    rag_fusion_prompt = get_rag_fusion_prompt(
+        query, query_context, number_of_variations
+    )
+
+    start = perf_counter()
+    try:
+        rag_fusion_response = await a_light_gpt4_wrapper(
+            query=rag_fusion_prompt, return_json=True
+        )
+    except Exception as e:
+        logger.error(f"Error in RAG fusion: {e}")
+        raise
+    record_fusion_latency(perf_counter() - start)
+
+    return parse_query_variations(rag_fusion_prompt, rag_fusion_response, stage)
+
+
+def parse_query_variations(rag_fusion_prompt, rag_fusion_response, stage=None):
+    """
+    Extracts the query variations from a fusion LLM response.
+
+    Args:
+        rag_fusion_prompt (str): The prompt sent to the fusion LLM.
+        rag_fusion_response (dict): The JSON response of the fusion LLM.
+        stage (Optional[dict]): The trace stage to record the LLM call on.
+
+    Returns:
+        List[str]: A list of query variations.
+    """
+    if stage is not None:
+        # The fusion LLM is not a llama_index LLM, so its usage is counted here
+        record_llm_call(
+            stage,
+            count_token(rag_fusion_prompt),
+            count_token(json.dumps(rag_fusion_response)),
+        )
+    return [variation["query"] for variation in rag_fusion_response["query_variations"]]
+
+
+def record_fusion_latency(latency):
+    """
+    Updates the smoothed latency estimate of fusion LLM calls.
+
+    Args:
+        latency (float): The seconds a fusion LLM call took.
+    """
+    global fusion_latency_estimate
+    with fusion_latency_lock:
+        fusion_latency_estimate += FUSION_LATENCY_SMOOTHING * (
+            latency - fusion_latency_estimate
+        )
+
+
+def should_skip_fusion(latency_budget):
+    """
+    Checks whether generating query variations is expected to take longer than a latency budget.
+
+    Args:
+        latency_budget (Optional[float]): The seconds fusion may take, None for no limit.
+
+    Returns:
+        bool: True if fusion should be skipped.
+    """
+    return latency_budget is not None and fusion_latency_estimate > latency_budget
+
+
+def warm_fusion_cache(query, query_context, number_of_variations):
+    """
+    Generates and caches query variations in the background, once per distinct query.
+
+    Args:
+        query (str): The original query.
+        query_context (str): Context to enrich the query variations.
+        number_of_variations (int): The number of query variations to generate.
+    """
+    key = (normalize_query(query), query_context, number_of_variations)
+    with fusion_latency_lock:
+        if key in fusion_cache_warming:
+            return
+        fusion_cache_warming.add(key)
+
+    def warm():
+        try:
+            query_variations = generate_query_variations(
+                query, query_context, number_of_variations
+            )
+            fusion_cache.set(query, query_context, number_of_variations, query_variations)
+        except Exception as e:
+            logger.warning(f"Failed to warm the fusion cache: {e}")
+        finally:
+            with fusion_latency_lock:
+                fusion_cache_warming.discard(key)
+
+    get_fusion_cache_executor().submit(warm)
+
+
+def get_fusion_cache_executor():
+    """
+    Gets the executor that warms the fusion cache in the background, creating it on first use.
+
+    Returns:
+        ThreadPoolExecutor: The single-worker executor.
+    """
+    global fusion_cache_executor
+    with fusion_latency_lock:
+        if fusion_cache_executor is None:
+            fusion_cache_executor = ThreadPoolExecutor(max_workers=1)
+        return fusion_cache_executor
+
+
+def get_retrieved_nodes(
+    query_str,
+    index,
+    vector_top_k=40,
+    reranker_top_n=20,
+    rerank=True,
+    score_threshold=5,
+    fusion=True,
+    query_context=None,
+    fusion_concurrency=4,
+    rerank_concurrency=4,
+    lexical_index=None,
+    lexical_top_k=None,
+    candidate_top_n=None,
+    rerank_candidate_budget=None,
+    fusion_latency_budget=None,
+    trace=None,
+    query_variations=None,
+    query_embeddings=None,
+    query_embedding=None,
+):
+    """
+    Retrieves nodes based on the provided query string and other parameters.
+
+    The ranked results of every query variation are merged with reciprocal rank
+    fusion. Indexes with numpy vector stores search every variation with a single
+    multi-query search, see search_variation_nodes. With a lexical index, retrieval is hybrid: the BM25 results of every
+    variation are fused together with the vector results. Before reranking,
+    near-duplicate candidates are collapsed and a diverse subset is picked with
+    maximal marginal relevance.
+
+    Args:
+        query_str (str): The query string.
+        index: The index to search in.
+        vector_top_k (int): The number of top vectors to retrieve.
+        reranker_top_n (int): The number of top nodes to keep after reranking.
+        rerank (bool): Flag to perform reranking.
+        score_threshold (int): The threshold for score filtering.
+        fusion (bool): Flag to perform fusion.
+        query_context: Additional context for the query.
+        fusion_concurrency (int): The maximum number of query variations to retrieve in parallel. Set to 1 to retrieve them serially.
+        rerank_concurrency (int): The maximum number of rerank batches to run in parallel. Set to 1 to rerank them serially.
+        lexical_index (Optional[BM25Index]): The BM25 index of the index's nodes, for hybrid retrieval.
+        lexical_top_k (Optional[int]): The number of lexical results per variation. Defaults to the number of vector results per variation.
+        candidate_top_n (Optional[int]): The number of top fused candidates kept for reranking. Defaults to vector_top_k.
+        rerank_candidate_budget (Optional[int]): The number of candidates sent to the reranker. Defaults to twice reranker_top_n.
+        fusion_latency_budget (Optional[float]): The seconds fusion may add when the query variations are not cached. Fusion is skipped when it is expected to take longer. None always waits for the variations.
+        trace (Optional[RAGTrace]): Trace to record the retrieval stages on.
+        query_variations (Optional[List[str]]): Precomputed query variations, including the query itself. Replaces the fusion step.
+        query_embeddings (Optional[List[List[float]]]): Precomputed embeddings of the query variations.
+        query_embedding (Optional[List[float]]): Precomputed embedding of query_str, reused for the query among the variations.
+
+    Returns:
+        List: A list of retrieved nodes.
+    """
+    reranker_context = get_reranker_service_context(
+        callback_manager=trace.callback_manager if trace is not None else None
+    )
+
+    logger.info(f"Getting top {vector_top_k} nodes")
+    # configure retriever
+
+    if query_variations is not None:
+        query_variations = list(query_variations)
+    elif fusion:
+        query_variations = rag_fusion(
+            query_str,
+            query_context,
+            trace=trace,
+            latency_budget=fusion_latency_budget,
+        )
+        query_variations.append(query_str)
+        logger.info(f"Query variations for RAG fusion: {query_variations}")
+    else:
+        query_variations = [query_str]
+
+    num_of_variations = len(query_variations)
+    results_per_variation = get_results_per_variation(query_variations, vector_top_k)
+
+    # Embed every variation in a single request instead of one per retriever
+    if query_embeddings is not None:
+        query_embeddings = list(query_embeddings)
+    elif index.vector_store.is_embedding_query:
+        known_embeddings = {} if query_embedding is None else {query_str: query_embedding}
+        missing_variations = get_missing_embeddings(query_variations, known_embeddings)
+        missing_embeddings = []
+        if missing_variations:
+            missing_embeddings = embed_queries(index, missing_variations, trace=trace)
+        query_embeddings = get_variation_embeddings(
+            query_variations, known_embeddings, missing_variations, missing_embeddings
+        )
+    else:
+        query_embeddings = [None] * num_of_variations
+
+    def retrieve_variation(variation, query_embedding):
+        return retrieve_variation_nodes(
+            index,
+            variation,
+            results_per_variation,
+            query_embedding=query_embedding,
+            trace=trace,
+        )
+
+    max_workers = max(1, min(fusion_concurrency, num_of_variations))
+    if None not in query_embeddings and can_search_variations(index):
+        variation_results = search_variation_nodes(
+            index, query_variations, query_embeddings, results_per_variation, trace=trace
+        )
+    elif max_workers == 1:
+        variation_results = [
+            retrieve_variation(variation, query_embedding)
+            for variation, query_embedding in zip(query_variations, query_embeddings)
+        ]
+    else:
+        logger.info(f"Retrieving variations with concurrency: {max_workers}")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map keeps the results in the same order as the variations
+            variation_results = list(
+                executor.map(retrieve_variation, query_variations, query_embeddings)
+            )
+
+    retrieved_nodes = get_rerank_candidates(
+        index,
+        query_variations,
+        variation_results,
+        results_per_variation,
+        vector_top_k,
+        reranker_top_n,
+        rerank=rerank,
+        lexical_index=lexical_index,
+        lexical_top_k=lexical_top_k,
+        candidate_top_n=candidate_top_n,
+        rerank_candidate_budget=rerank_candidate_budget,
+        trace=trace,
+    )
+
+    if rerank:
+        retrieved_nodes = rerank_nodes(
+            nodes=retrieved_nodes,
+            query_str=query_str,
+            query_context=query_context,
+            context=reranker_context,
+            top_n=reranker_top_n,
+            score_threshold=score_threshold,
+            max_concurrency=rerank_concurrency,
+            trace=trace,
+        )
+
+    log_node_tokens(retrieved_nodes)
+    return retrieved_nodes
+
+
+async def a_get_retrieved_nodes(
+    query_str,
+    index,
+    vector_top_k=40,
+    reranker_top_n=20,
+    rerank=True,
+    score_threshold=5,
+    fusion=True,
+    query_context=None,
+    fusion_concurrency=4,
+    rerank_concurrency=4,
+    lexical_index=None,
+    lexical_top_k=None,
+    candidate_top_n=None,
+    rerank_candidate_budget=None,
+    fusion_latency_budget=None,
+    trace=None,
+    query_embedding=None,
+):
+    """
+    Async counterpart of get_retrieved_nodes. Query variations are retrieved and
+    rerank batches are scored concurrently on the event loop.
+
+    Args:
+        query_str (str): The query string.
+        index: The index to search in.
+        vector_top_k (int): The number of top vectors to retrieve.
+        reranker_top_n (int): The number of top nodes to keep after reranking.
+        rerank (bool): Flag to perform reranking.
+        score_threshold (int): The threshold for score filtering.
+        fusion (bool): Flag to perform fusion.
+        query_context: Additional context for the query.
+        fusion_concurrency (int): The maximum number of query variations to retrieve concurrently.
+        rerank_concurrency (int): The maximum number of rerank batches to score concurrently.
+        lexical_index (Optional[BM25Index]): The BM25 index of the index's nodes, for hybrid retrieval.
+        lexical_top_k (Optional[int]): The number of lexical results per variation. Defaults to the number of vector results per variation.
+        candidate_top_n (Optional[int]): The number of top fused candidates kept for reranking. Defaults to vector_top_k.
+        rerank_candidate_budget (Optional[int]): The number of candidates sent to the reranker. Defaults to twice reranker_top_n.
+        fusion_latency_budget (Optional[float]): The seconds fusion may add when the query variations are not cached. Fusion is skipped when it is expected to take longer. None always waits for the variations.
+        trace (Optional[RAGTrace]): Trace to record the retrieval stages on.
+        query_embedding (Optional[List[float]]): Precomputed embedding of query_str, reused for the query among the variations.
+
+    Returns:
+        List: A list of retrieved nodes.
+    """
+    logger.info(f"Getting top {vector_top_k} nodes")
+
+    if fusion:
+        query_variations = await a_rag_fusion(
+            query_str,
+            query_context,
+            trace=trace,
+            latency_budget=fusion_latency_budget,
+        )
+        query_variations.append(query_str)
+        logger.info(f"Query variations for RAG fusion: {query_variations}")
+    else:
+        query_variations = [query_str]
+
+    num_of_variations = len(query_variations)
+    results_per_variation = get_results_per_variation(query_variations, vector_top_k)
+
+    # Embed every variation in a single request instead of one per retriever
+    if index.vector_store.is_embedding_query:
+        known_embeddings = {} if query_embedding is None else {query_str: query_embedding}
+        missing_variations = get_missing_embeddings(query_variations, known_embeddings)
+        missing_embeddings = []
+        if missing_variations:
+            missing_embeddings = await a_embed_queries(
+                index, missing_variations, trace=trace
+            )
+        query_embeddings = get_variation_embeddings(
+            query_variations, known_embeddings, missing_variations, missing_embeddings
+        )
+    else:
+        query_embeddings = [None] * num_of_variations
+
+    semaphore = asyncio.Semaphore(max(1, fusion_concurrency))
+
+    async def retrieve_variation(variation, query_embedding):
+        async with semaphore:
+            return await a_retrieve_variation_nodes(
+                index,
+                variation,
+                results_per_variation,
+                query_embedding=query_embedding,
+                trace=trace,
+            )
+
+    if None not in query_embeddings and await asyncio.to_thread(
+        can_search_variations, index
+    ):
+        # The search is CPU and file IO bound, keep it off the event loop
+        variation_results = await asyncio.to_thread(
+            search_variation_nodes,
+            index,
+            query_variations,
+            query_embeddings,
+            results_per_variation,
+            trace,
+        )
+    else:
+        # gather keeps the results in the same order as the variations
+        variation_results = await asyncio.gather(
+            *(
+                retrieve_variation(variation, query_embedding)
+                for variation, query_embedding in zip(query_variations, query_embeddings)
+            )
+        )
+
+    retrieved_nodes = get_rerank_candidates(
+        index,
+        query_variations,
+        variation_results,
+        results_per_variation,
+        vector_top_k,
+        reranker_top_n,
+        rerank=rerank,
+        lexical_index=lexical_index,
+        lexical_top_k=lexical_top_k,
+        candidate_top_n=candidate_top_n,
+        rerank_candidate_budget=rerank_candidate_budget,
+        trace=trace,
+    )
+
+    if rerank:
+        retrieved_nodes = await a_rerank_nodes(
+            nodes=retrieved_nodes,
+            query_str=query_str,
+            query_context=query_context,
+            context=get_reranker_service_context(
+                callback_manager=trace.callback_manager if trace is not None else None
+            ),
+            top_n=reranker_top_n,
+            score_threshold=score_threshold,
+            max_concurrency=rerank_concurrency,
+            trace=trace,
+        )
+
+    log_node_tokens(retrieved_nodes)
+    return retrieved_nodes
+
+
+def get_results_per_variation(query_variations, vector_top_k):
+    """
+    Splits the vector results to retrieve between the query variations.
+
+    Args:
+        query_variations (List[str]): The query variations.
+        vector_top_k (int): The number of top vectors to retrieve in total.
+
+    Returns:
+        int: The number of vector results per variation.
+    """
+    logger.info(f"Number of variations: {len(query_variations)}")
+    results_per_variation = int(vector_top_k / len(query_variations))
+    logger.info(f"Results per variation: {results_per_variation}")
+    return results_per_variation
+
+
+def get_variation_embeddings(
+    query_variations, known_embeddings, missing_variations, missing_embeddings
+):
+    """
+    Orders the embeddings of the query variations like the variations.
+
+    Args:
+        query_variations (List[str]): The query variations.
+        known_embeddings (Dict[str, List[float]]): Embeddings that were precomputed, by query.
+        missing_variations (List[str]): The variations that were embedded, see get_missing_embeddings.
+        missing_embeddings (List[List[float]]): The embeddings of missing_variations.
+
+    Returns:
+        List[List[float]]: The embedding of every variation.
+    """
+    embeddings = dict(known_embeddings)
+    embeddings.update(zip(missing_variations, missing_embeddings))
+    return [embeddings[variation] for variation in query_variations]
+
+
+def get_rerank_candidates(
+    index,
+    query_variations,
+    variation_results,
+    results_per_variation,
+    vector_top_k,
+    reranker_top_n,
+    rerank=True,
+    lexical_index=None,
+    lexical_top_k=None,
+    candidate_top_n=None,
+    rerank_candidate_budget=None,
+    trace=None,
+):
+    """
+    Fuses the results of the query variations and, when reranking, prunes them to the candidates sent to the reranker.
+
+    Args:
+        index: The index that was searched.
+        query_variations (List[str]): The query variations.
+        variation_results (List[List[NodeWithScore]]): The vector results of every variation.
+        results_per_variation (int): The number of vector results per variation.
+        vector_top_k (int): The number of top vectors retrieved.
+        reranker_top_n (int): The number of top nodes to keep after reranking.
+        rerank (bool): Flag to prune the candidates for reranking.
+        lexical_index (Optional[BM25Index]): The BM25 index of the index's nodes, for hybrid retrieval.
+        lexical_top_k (Optional[int]): The number of lexical results per variation. Defaults to results_per_variation.
+        candidate_top_n (Optional[int]): The number of top fused candidates kept. Defaults to vector_top_k.
+        rerank_candidate_budget (Optional[int]): The number of candidates sent to the reranker. Defaults to twice reranker_top_n.
+        trace (Optional[RAGTrace]): Trace to record the fusion and prune stages on.
+
+    Returns:
+        List[NodeWithScore]: The fused, and when reranking pruned, nodes.
+    """
+    retrieved_nodes = fuse_variation_results(
+        index,
+        query_variations,
+        variation_results,
+        lexical_index=lexical_index,
+        lexical_top_k=(
+            results_per_variation if lexical_top_k is None else lexical_top_k
+        ),
+        top_n=vector_top_k if candidate_top_n is None else candidate_top_n,
+        trace=trace,
+    )
+    if not rerank:
+        return retrieved_nodes
+
+    if rerank_candidate_budget is None:
+        rerank_candidate_budget = 2 * reranker_top_n
+    with trace_stage(trace, "prune", nodes_in=len(retrieved_nodes)) as stage:
+        retrieved_nodes = prune_rerank_candidates(
+            index, retrieved_nodes, rerank_candidate_budget
+        )
+        stage["nodes_out"] = len(retrieved_nodes)
+    return retrieved_nodes
+
+
+def log_node_tokens(nodes):
+    """
+    Logs the total token count of the retrieved nodes.
+
+    Args:
+        nodes (List[NodeWithScore]): The retrieved nodes.
+    """
+    total_tokens = sum(get_node_token_count(node) for node in nodes)
+    logger.info(f"Total node tokens: {total_tokens}")
+
+
+def get_reranker_service_context(callback_manager=None):
+    """
+    Creates the service context of the LLM reranker, which requests JSON responses.
+
+    Args:
+        callback_manager (Optional[CallbackManager]): The callback manager of the reranker LLM, e.g. a trace's.
+
+    Returns:
+        ServiceContext: The service context.
+    """
+    json_llm_predictor = JSONLLMPredictor(
+        llm=get_callback_llm(llm3_general, callback_manager)
+    )
+    return ServiceContext.from_defaults(
+        llm_predictor=json_llm_predictor, callback_manager=callback_manager
+    )
+
+
+def get_callback_llm(llm, callback_manager):
+    """
+    Gets the LLM to give a callback manager to.
+
+    The service context sets its callback manager on its LLM, so an LLM shared by
+    concurrent questions would end up reporting to the last question's callbacks.
+
+    Args:
+        llm (LLM): The shared LLM.
+        callback_manager (Optional[CallbackManager]): The callback manager, or None for the default one.
+
+    Returns:
+        LLM: The shared LLM without a callback manager, or else a copy of it.
+    """
+    return llm if callback_manager is None else llm.copy()
+
+
+def fuse_variation_results(
+    index,
+    query_variations,
+    variation_results,
+    lexical_index,
+    lexical_top_k,
+    top_n,
+    trace=None,
+):
+    """
+    Fuses the vector results of every query variation, plus their lexical results with a lexical index.
+
+    Args:
+        index: The index the nodes were retrieved from.
+        query_variations (List[str]): The query variations.
+        variation_results (List[List[NodeWithScore]]): The vector results of each variation.
+        lexical_index (Optional[BM25Index]): The BM25 index of the index's nodes.
+        lexical_top_k (int): The number of lexical results per variation.
+        top_n (int): The number of top fused candidates to keep.
+        trace (Optional[RAGTrace]): Trace to record the lexical retrieval and fusion stages on.
+
+    Returns:
+        List[NodeWithScore]: The fused candidates, best first.
+    """
+    ranked_node_lists = list(variation_results)
+    if lexical_index is not None:
+        with trace_stage(trace, "lexical_retrieval") as stage:
+            for variation in query_variations:
+                ranked_node_lists.append(
+                    retrieve_lexical_nodes(index, lexical_index, variation, lexical_top_k)
+                )
+            stage["nodes_out"] = sum(
+                len(nodes) for nodes in ranked_node_lists[len(variation_results) :]
+            )
+    with trace_stage(
+        trace,
+        "fusion",
+        lists_in=len(ranked_node_lists),
+        nodes_in=sum(len(nodes) for nodes in ranked_node_lists),
+    ) as stage:
+        fused_nodes = fuse_ranked_nodes(ranked_node_lists, top_n=top_n)
+        stage["nodes_out"] = len(fused_nodes)
+    return fused_nodes
+
+
+def get_missing_embeddings(queries, known_embeddings):
+    """
+    Lists the distinct queries that still need to be embedded.
+
+    Args:
+        queries (List[str]): The queries.
+        known_embeddings (dict): The already computed embeddings, by query.
+
+    Returns:
+        List[str]: The queries without a known embedding, each once, in order.
+    """
+    return list(dict.fromkeys(query for query in queries if query not in known_embeddings))
+
+
+def embed_queries(index, queries, max_retries=3, trace=None):
+    """
+    Embeds a list of queries with a single batched embedding request.
+
+    NOTE: The batch goes through the text embedding path. For the OpenAI embedding models used by this project, query and text embeddings come from the same engine, so the results match what the retriever would have computed per query.
+
+    Args:
+        index: The index whose embedding model should be used.
+        queries (List[str]): The queries to embed.
+        max_retries (int): Maximum number of retries.
+        trace (Optional[RAGTrace]): Trace to record the embedding stage on.
+
+    Returns:
+        List[List[float]]: One embedding per query, in the same order.
+    """
+    embed_model = get_query_embed_model(index)
+    logger.info(f"Embedding {len(queries)} queries in one batch")
+    with trace_stage(trace, "embed_queries", queries_in=len(queries)):
+        return call_with_retry(
+            lambda: embed_model.get_text_embedding_batch(queries),
+            max_retries,
+            "embed queries",
+        )
+
+
+async def a_embed_queries(index, queries, max_retries=3, trace=None):
+    """
+    Async counterpart of embed_queries.
+
+    Args:
+        index: The index whose embedding model should be used.
+        queries (List[str]): The queries to embed.
+        max_retries (int): Maximum number of retries.
+        trace (Optional[RAGTrace]): Trace to record the embedding stage on.
+
+    Returns:
+        List[List[float]]: One embedding per query, in the same order.
+    """
+    embed_model = get_query_embed_model(index)
+    logger.info(f"Embedding {len(queries)} queries in one batch")
+    with trace_stage(trace, "embed_queries", queries_in=len(queries)):
+        return await a_call_with_retry(
+            lambda: embed_model.aget_text_embedding_batch(queries),
+            max_retries,
+            "embed queries",
+        )
+
+
+def retrieve_variation_nodes(
+    index, variation, similarity_top_k, query_embedding=None, trace=None
+):
+    """
+    Retrieves the nodes for a single query variation.
+
+    Args:
+        index: The index to search in.
+        variation (str): The query variation.
+        similarity_top_k (int): The number of top vectors to retrieve.
+        query_embedding (List[float], optional): A precomputed embedding for the variation. If omitted the retriever embeds the variation itself.
+        trace (Optional[RAGTrace]): Trace to record the retrieval stage on.
+
+    Returns:
+        List: A list of retrieved nodes.
+    """
+    retriever = get_variation_retriever(index, similarity_top_k)
+    query_bundle = QueryBundle(variation, embedding=query_embedding)
+
+    # Variations are retrieved in parallel, so LLM usage is not attributed to them
+    with trace_stage(
+        trace, "retrieve_variation", count_llm_usage=False, variation=variation
+    ) as stage:
+        variation_nodes = retrieve_nodes_with_retry(retriever, query_bundle)
+        stage["nodes_out"] = len(variation_nodes)
+
+    log_variation_nodes(variation, variation_nodes)
+    return variation_nodes
+
+
+async def a_retrieve_variation_nodes(
+    index, variation, similarity_top_k, query_embedding=None, trace=None
+):
+    """
+    Async counterpart of retrieve_variation_nodes.
+
+    Args:
+        index: The index to search in.
+        variation (str): The query variation.
+        similarity_top_k (int): The number of top vectors to retrieve.
+        query_embedding (List[float], optional): A precomputed embedding for the variation. If omitted the retriever embeds the variation itself.
+        trace (Optional[RAGTrace]): Trace to record the retrieval stage on.
+
+    Returns:
+        List: A list of retrieved nodes.
+    """
+    retriever = get_variation_retriever(index, similarity_top_k)
+    query_bundle = QueryBundle(variation, embedding=query_embedding)
+
+    with trace_stage(
+        trace, "retrieve_variation", count_llm_usage=False, variation=variation
+    ) as stage:
+        variation_nodes = await a_retrieve_nodes_with_retry(retriever, query_bundle)
+        stage["nodes_out"] = len(variation_nodes)
+
+    log_variation_nodes(variation, variation_nodes)
+    return variation_nodes
+
+
+def get_variation_retriever(index, similarity_top_k):
+    """
+    Creates the retriever used for each query variation.
+
+    Args:
+        index: The index to search in.
+        similarity_top_k (int): The number of top vectors to retrieve.
+
+    Returns:
+        Union[AutoMergingRetriever, ShardedRetriever]: The retriever.
+    """
+    if isinstance(index, ShardedIndex):
+        return ShardedRetriever(index, similarity_top_k, get_variation_retriever)
+
+    base_retriever = VectorIndexRetriever(
+        index=index,
+        similarity_top_k=similarity_top_k,
+    )
+
+    return AutoMergingRetriever(base_retriever, index.storage_context, verbose=False)
+
+
+def can_search_variations(index):
+    """
+    Checks whether the query variations of an index can be searched with one multi-query search.
+
+    The shards of a sharded index that are not loaded yet are checked from their
+    persisted vector store files, so the check does not load them.
+
+    Args:
+        index: The index to search in.
+
+    Returns:
+        bool: True if every vector store of the index is a NumpyVectorStore.
+    """
+    if isinstance(index, ShardedIndex):
+        loaded_shards = index.get_loaded_shards()
+        return all(
+            can_search_variations(loaded_shards[name])
+            if name in loaded_shards
+            else NumpyVectorStore.exists(
+                ShardedIndex.get_shard_dir(index.storage_dir, name)
+            )
+            for name in index.shard_names
+        )
+    return isinstance(index.vector_store, NumpyVectorStore)
+
+
+def search_variation_nodes(
+    index, query_variations, query_embeddings, similarity_top_k, trace=None
+):
+    """
+    Retrieves the nodes of every query variation with a single multi-query vector search.
+
+    Instead of one retriever and one scan of the embeddings per variation, the
+    (variations x dim) query matrix is scored against the embeddings in one pass, and
+    the top-k of each variation is taken from its row. The results of each variation
+    then go through the same auto-merging as retrieve_variation_nodes. Sharded
+    indexes are searched shard by shard in parallel, and the per-shard results are
+    merged by score.
+
+    Args:
+        index: The index to search in, see can_search_variations.
+        query_variations (List[str]): The query variations.
+        query_embeddings (List[List[float]]): The embedding of each variation.
+        similarity_top_k (int): The number of top vectors to retrieve per variation.
+        trace (Optional[RAGTrace]): Trace to record the search stage on.
+
+    Returns:
+        List[List[NodeWithScore]]: The retrieved nodes of each variation, in the same order.
+    """
+    with trace_stage(
+        trace, "search_variations", count_llm_usage=False, queries_in=len(query_variations)
+    ) as stage:
+        variation_results = _search_variation_nodes(
+            index, query_variations, query_embeddings, similarity_top_k
+        )
+        stage["nodes_out"] = sum(len(nodes) for nodes in variation_results)
+
+    for variation, variation_nodes in zip(query_variations, variation_results):
+        log_variation_nodes(variation, variation_nodes)
+    return variation_results
+
+
+def _search_variation_nodes(index, query_variations, query_embeddings, similarity_top_k):
+    if isinstance(index, ShardedIndex):
+        # Each shard is loaded by the worker that searches it
+        def search_shard(shard_name):
+            return _search_variation_nodes(
+                index.get_shard(shard_name),
+                query_variations,
+                query_embeddings,
+                similarity_top_k,
+            )
+
+        max_workers = max(1, min(SHARD_QUERY_CONCURRENCY, len(index.shard_names)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            shard_results = list(executor.map(search_shard, index.shard_names))
+        return [
+            merge_shard_results(
+                [results[idx] for results in shard_results], similarity_top_k
+            )
+            for idx in range(len(query_variations))
+        ]
+
+    vector_store = index.vector_store
+    variation_results = []
+    for variation, (rows, similarities) in zip(
+        query_variations, vector_store.search_many(query_embeddings, similarity_top_k)
+    ):
+        nodes = index.docstore.get_nodes(vector_store.get_row_ids(rows))
+        retriever = AutoMergingRetriever(
+            PrecomputedRetriever(
+                [
+                    NodeWithScore(node=node, score=float(similarity))
+                    for node, similarity in zip(nodes, similarities)
+                ]
+            ),
+            index.storage_context,
+            verbose=False,
+        )
+        variation_results.append(retriever.retrieve(QueryBundle(variation)))
+    return variation_results
+
+
+def log_variation_nodes(variation, variation_nodes):
+    """
+    Logs the nodes retrieved for a query variation at debug level.
+
+    Args:
+        variation (str): The query variation.
+        variation_nodes (List[NodeWithScore]): The retrieved nodes.
+    """
+    logger.debug(f"ORIGINAL NODES for query: {variation}\n\n")
+    for node in variation_nodes:
+        file_info = node.metadata.get("file_name") or node.metadata.get("file_path")
+        node_info = (
+            f"FILE INFO: {file_info}\n"
+            f"NODE ID: {node.id_}\n"
+            f"NODE Score: {node.score}\n"
+            f"NODE Length: {len(node.text)}\n"
+            f"NODE Text: {node.text}\n-----------\n"
+        )
+        logger.debug(node_info)
+
+
+def retrieve_lexical_nodes(index, lexical_index, query_str, top_k):
+    """
+    Retrieves the nodes with the best BM25 score for a query.
+
+    Args:
+        index: The index the lexical index was built from.
+        lexical_index (BM25Index): The lexical index.
+        query_str (str): The query.
+        top_k (int): The number of nodes to retrieve.
+
+    Returns:
+        List[NodeWithScore]: The retrieved nodes, with scores scaled so the best match scores 1.
+    """
+    results = lexical_index.query(query_str, top_k)
+    if not results:
+        return []
+    max_score = results[0][1]
+    lexical_nodes = []
+    for node_id, score in results:
+        node = index.docstore.get_node(node_id, raise_error=False)
+        if node is not None:
+            lexical_nodes.append(NodeWithScore(node=node, score=score / max_score))
+    logger.debug(f"Lexical nodes for query: {query_str}: {len(lexical_nodes)}")
+    return lexical_nodes
+
+
+def retrieve_nodes_with_retry(retriever, query_bundle, max_retries=3):
+    """
+    Attempts to retrieve nodes with a retry mechanism.
+
+    Args:
+        retriever: The retriever to use for node retrieval.
+        query_bundle: The query bundle for the retriever.
+        max_retries (int): Maximum number of retries.
+
+    Returns:
+        List: A list of retrieved nodes.
+    """
+    return call_with_retry(
+        lambda: retriever.retrieve(query_bundle), max_retries, "retrieve nodes"
+    )
+
+
+async def a_retrieve_nodes_with_retry(retriever, query_bundle, max_retries=3):
+    """
+    Async counterpart of retrieve_nodes_with_retry.
+
+    Args:
+        retriever: The retriever to use for node retrieval.
+        query_bundle: The query bundle for the retriever.
+        max_retries (int): Maximum number of retries.
+
+    Returns:
+        List: A list of retrieved nodes.
+    """
+    return await a_call_with_retry(
+        lambda: retriever.aretrieve(query_bundle), max_retries, "retrieve nodes"
+    )
+
+
+def call_with_retry(
+    fn,
+    max_retries,
+    action,
+    retry_errors=openai.APITimeoutError,
+    exhausted_error=TimeoutError,
+):
+    """
+    Calls a function, retrying it when it raises one of the given errors.
+
+    Args:
+        fn (Callable[[], Any]): The function to call.
+        max_retries (int): Maximum number of attempts.
+        action (str): What the call does, for the log and error messages.
+        retry_errors (Union[type, Tuple[type, ...]]): The errors that are retried.
+        exhausted_error (type): The error raised once every attempt failed.
+
+    Returns:
+        Any: The result of fn.
+    """
+    for attempt in range(max_retries):
+        try:
+            return fn()
+        except retry_errors as e:
+            log_retry(action, attempt, e)
+    raise exhausted_error(f"Failed to {action} after {max_retries} attempts")
+
+
+async def a_call_with_retry(
+    fn,
+    max_retries,
+    action,
+    retry_errors=openai.APITimeoutError,
+    exhausted_error=TimeoutError,
+):
+    """
+    Async counterpart of call_with_retry.
+
+    Args:
+        fn (Callable[[], Awaitable[Any]]): The coroutine function to call.
+        max_retries (int): Maximum number of attempts.
+        action (str): What the call does, for the log and error messages.
+        retry_errors (Union[type, Tuple[type, ...]]): The errors that are retried.
+        exhausted_error (type): The error raised once every attempt failed.
+
+    Returns:
+        Any: The result of fn.
+    """
+    for attempt in range(max_retries):
+        try:
+            return await fn()
+        except retry_errors as e:
+            log_retry(action, attempt, e)
+    raise exhausted_error(f"Failed to {action} after {max_retries} attempts")
+
+
+def log_retry(action, attempt, error):
+    """
+    Logs a failed attempt of a retried call.
+
+    Args:
+        action (str): What the call does.
+        attempt (int): The zero-based attempt that failed.
+        error (Exception): The error of the attempt.
+    """
+    logger.warning(
+        f"{type(error).__name__} on attempt {attempt + 1} to {action}: {error}"
+    )
+
+
+def get_node_token_count(node):
+    """
+    Gets the token count of a node's LLM content.
+
+    Args:
+        node (Union[BaseNode, NodeWithScore]): The node.
+
+    Returns:
+        int: The token count stored at index time, or counted now for nodes indexed without one.
+    """
+    node = node.node if isinstance(node, NodeWithScore) else node
+    token_count = node.metadata.get(NODE_TOKEN_COUNT_KEY)
+    if token_count is None:
+        token_count = count_token(node.get_content(metadata_mode=MetadataMode.LLM))
+    return token_count
+
+
+def pack_context_nodes(nodes, token_budget):
+    """
+    Picks the highest scoring nodes that fit in a token budget.
+
+    Nodes are considered from the highest score down. A node that does not fit in the
+    remaining budget is skipped, and smaller lower scoring nodes can still fill the
+    space. If no node fits, the top node is kept on its own.
+
+    Args:
+        nodes (List[NodeWithScore]): The candidate nodes.
+        token_budget (int): The maximum total token count of the picked nodes.
+
+    Returns:
+        List[NodeWithScore]: The picked nodes, highest score first.
+    """
+    # Stable sort, so nodes without scores keep their retrieval order
+    ranked_nodes = sorted(
+        nodes, key=lambda node: node.score if node.score is not None else 0, reverse=True
+    )
+    packed_nodes = []
+    packed_tokens = 0
+    for node in ranked_nodes:
+        token_count = get_node_token_count(node)
+        if packed_tokens + token_count <= token_budget:
+            packed_nodes.append(node)
+            packed_tokens += token_count
+    if not packed_nodes and ranked_nodes:
+        packed_nodes = ranked_nodes[:1]
+        packed_tokens = get_node_token_count(packed_nodes[0])
+
+    logger.info(
+        f"Packed {len(packed_nodes)}/{len(nodes)} nodes into the context "
+        f"({packed_tokens}/{token_budget} tokens)"
+    )
+    return packed_nodes
+
+
+def fuse_ranked_nodes(ranked_node_lists, top_n=None, k=RRF_K):
+    """
+    Merges ranked node lists with reciprocal rank fusion.
+
+    Each node scores the sum of 1 / (k + rank) over the lists it appears in, so nodes
+    ranked highly by several variations (or by both lexical and vector retrieval) rise
+    to the top.
+
+    Args:
+        ranked_node_lists (List[List[NodeWithScore]]): The node lists, each sorted best first.
+        top_n (Optional[int]): The number of top fused nodes to keep. None keeps every node.
+        k (int): The rank offset, larger values flatten the contribution of top ranks.
+
+    Returns:
+        List[NodeWithScore]: The unique nodes, best first, scored by their fused score.
+    """
+    fused_scores = {}
+    fused_nodes = {}
+    for ranked_nodes in ranked_node_lists:
+        seen_node_ids = set()
+        for rank, node in enumerate(ranked_nodes, start=1):
+            if node.node.node_id in seen_node_ids:
+                continue
+            seen_node_ids.add(node.node.node_id)
+            fused_scores[node.node.node_id] = (
+                fused_scores.get(node.node.node_id, 0.0) + 1.0 / (k + rank)
+            )
+            fused_nodes.setdefault(node.node.node_id, node.node)
+
+    # Stable sort, ties keep the order in which nodes were first retrieved
+    ranked_node_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)
+    logger.info(
+        f"Fused {sum(len(nodes) for nodes in ranked_node_lists)} results from "
+        f"{len(ranked_node_lists)} lists into {len(ranked_node_ids)} unique nodes"
+    )
+    if top_n is not None:
+        ranked_node_ids = ranked_node_ids[:top_n]
+        logger.info(f"Kept top {len(ranked_node_ids)} fused candidates")
+
+    return [
+        NodeWithScore(node=fused_nodes[node_id], score=fused_scores[node_id])
+        for node_id in ranked_node_ids
+    ]
+
+
+def prune_rerank_candidates(
+    index,
+    nodes,
+    candidate_budget,
+    duplicate_threshold=RERANK_DUPLICATE_THRESHOLD,
+    mmr_lambda=RERANK_MMR_LAMBDA,
+):
+    """
+    Collapses near-duplicate candidates and picks a diverse subset for the reranker.
+
+    Uses the node embeddings already in the vector store. Relevance is the candidate's
+    score scaled so the best candidate scores 1. Nodes without a stored embedding are
+    never treated as duplicates.
+
+    Args:
+        index: The index the nodes were retrieved from.
+        nodes (List[NodeWithScore]): The candidates, best first.
+        candidate_budget (int): The maximum number of candidates to keep.
+        duplicate_threshold (float): The cosine similarity above which a candidate duplicates a better one.
+        mmr_lambda (float): The weight of relevance against diversity, between 0 and 1.
+
+    Returns:
+        List[NodeWithScore]: The kept candidates, in selection order.
+    """
+    if not nodes:
+        return nodes
+    embeddings = get_node_embeddings(index, nodes)
+    similarities = embeddings @ embeddings.T
+
+    max_score = max(node.score or 0.0 for node in nodes) or 1.0
+    relevance = np.array([(node.score or 0.0) / max_score for node in nodes])
+
+    remaining = []
+    for candidate in range(len(nodes)):
+        if any(similarities[candidate, kept] >= duplicate_threshold for kept in remaining):
+            continue
+        remaining.append(candidate)
+    num_unique = len(remaining)
+
+    selected = []
+    max_similarity = np.zeros(len(nodes))
+    while remaining and len(selected) < candidate_budget:
+        mmr_scores = [
+            mmr_lambda * relevance[candidate]
+            - (1 - mmr_lambda) * max_similarity[candidate]
+            for candidate in remaining
+        ]
+        best = remaining.pop(int(np.argmax(mmr_scores)))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, similarities[best])
+
+    logger.info(
+        f"Rerank candidates: {len(nodes)} retrieved, {len(nodes) - num_unique} "
+        f"near-duplicates collapsed, {len(selected)} kept"
+    )
+    return [nodes[candidate] for candidate in selected]
+
+
+def get_node_embeddings(index, nodes):
+    """
+    Looks up the normalized embeddings of nodes in an index's vector store.
+
+    Args:
+        index: The index the nodes belong to.
+        nodes (List[NodeWithScore]): The nodes.
+
+    Returns:
+        np.ndarray: A (num_nodes, dim) array of unit vectors, with zero rows for nodes that have no stored embedding.
+    """
+    embeddings = []
+    for node in nodes:
         try:
-            return retriever.retrieve(query_bundle)
-        except openai.APITimeoutError as e:
-            logger.warning(f"Timeout error on attempt {attempt + 1}: {e}")
-            attempt += 1
-    raise TimeoutError(f"Failed to retrieve nodes after {max_retries} attempts")
+            embeddings.append(index.vector_store.get(node.node.node_id))
+        except (KeyError, NotImplementedError, ValueError):
+            embeddings.append(None)
+
+    dim = max((len(embedding) for embedding in embeddings if embedding), default=0)
+    matrix = np.zeros((len(nodes), dim), dtype=np.float32)
+    for row, embedding in enumerate(embeddings):
+        if embedding:
+            matrix[row] = embedding
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def rerank_nodes(
+    nodes,
+    query_str,
+    query_context,
+    context,
+    top_n,
+    score_threshold=5,
+    max_concurrency=4,
+    use_cache=True,
+    trace=None,
+):
+    """
+    Reranks the nodes based on the provided context and thresholds.
+
+    Args:
+        nodes (List): A list of nodes to rerank.
+        query_bundle: The query bundle for the reranker.
+        context: The service context for reranking.
+        top_n (int): The number of top nodes to keep after reranking.
+        score_threshold (int): The threshold for score filtering.
+        max_concurrency (int): The maximum number of rerank batches to run in parallel.
+        use_cache (bool): Flag to reuse and store scores in the persistent rerank cache.
+        trace (Optional[RAGTrace]): Trace to record the rerank stages on.
+
+    Returns:
+        List: A list of reranked nodes.
+    """
+    logger.info(
+        f"Reranking top {top_n} nodes with a score threshold of {score_threshold}"
+    )
+    reranker = get_reranker(
+        context,
+        top_n,
+        query_context,
+        max_concurrency=max_concurrency,
+        use_cache=use_cache,
+        trace=trace,
+    )
+
+    query_bundle = QueryBundle(query_str)
+    with trace_stage(trace, "rerank", nodes_in=len(nodes)) as stage:
+        reranked_nodes = reranker.postprocess_nodes(nodes, query_bundle)
+        filtered_nodes = filter_reranked_nodes(reranked_nodes, score_threshold)
+        stage["nodes_out"] = len(filtered_nodes)
+
+    return filtered_nodes
+
+
+async def a_rerank_nodes(
+    nodes,
+    query_str,
+    query_context,
+    context,
+    top_n,
+    score_threshold=5,
+    max_concurrency=4,
+    use_cache=True,
+    trace=None,
+):
+    """
+    Async counterpart of rerank_nodes.
+
+    Args:
+        nodes (List): A list of nodes to rerank.
+        query_str (str): The query string.
+        query_context (str, optional): Context added to the question in the rerank prompt.
+        context: The service context for reranking.
+        top_n (int): The number of top nodes to keep after reranking.
+        score_threshold (int): The threshold for score filtering.
+        max_concurrency (int): The maximum number of rerank batches to score concurrently.
+        use_cache (bool): Flag to reuse and store scores in the persistent rerank cache.
+        trace (Optional[RAGTrace]): Trace to record the rerank stages on.
+
+    Returns:
+        List: A list of reranked nodes.
+    """
+    logger.info(
+        f"Reranking top {top_n} nodes with a score threshold of {score_threshold}"
+    )
+    reranker = get_reranker(
+        context,
+        top_n,
+        query_context,
+        max_concurrency=max_concurrency,
+        use_cache=use_cache,
+        trace=trace,
+    )
+
+    query_bundle = QueryBundle(query_str)
+    with trace_stage(trace, "rerank", nodes_in=len(nodes)) as stage:
+        reranked_nodes = await reranker.apostprocess_nodes(nodes, query_bundle)
+        filtered_nodes = filter_reranked_nodes(reranked_nodes, score_threshold)
+        stage["nodes_out"] = len(filtered_nodes)
+
+    return filtered_nodes
+
+
+def get_reranker(
+    context, top_n, query_context, max_concurrency=4, use_cache=True, trace=None
+):
+    """
+    Creates the LLM reranker.
+
+    Args:
+        context: The service context for reranking.
+        top_n (int): The number of top nodes to keep after reranking.
+        query_context (str, optional): Context added to the question in the rerank prompt.
+        max_concurrency (int): The maximum number of rerank batches to run in parallel.
+        use_cache (bool): Flag to reuse and store scores in the persistent rerank cache.
+        trace (Optional[RAGTrace]): Trace to record the cache lookup and rerank batches on.
+
+    Returns:
+        ModifiedLLMRerank: The reranker.
+    """
+    return ModifiedLLMRerank(
+        choice_batch_size=5,
+        top_n=top_n,
+        service_context=context,
+        max_concurrency=max_concurrency,
+        query_context=query_context,
+        rerank_cache=rerank_cache if use_cache else None,
+        trace=trace,
+    )
+
+
+def filter_reranked_nodes(reranked_nodes, score_threshold):
+    """
+    Drops reranked nodes at or below the score threshold.
+
+    Args:
+        reranked_nodes (List[NodeWithScore]): The reranked nodes.
+        score_threshold (int): The threshold for score filtering.
+
+    Returns:
+        List[NodeWithScore]: The nodes scored above the threshold.
+    """
+    logger.debug(f"RERANKED NODES:\n\n")
+    for node in reranked_nodes:
+        file_info = node.metadata.get("file_name") or node.metadata.get("file_path")
+        node_info = (
+            f"FILE INFO: {file_info}\n"
+            f"NODE ID: {node.id_}\n"
+            f"NODE Score: {node.score}\n"
+            f"NODE Length: {len(node.text)}\n"
+            f"NODE Text: {node.text}\n-----------\n"
+        )
+        logger.debug(node_info)
+
+    filtered_nodes = [node for node in reranked_nodes if node.score > score_threshold]
+    logger.info(
+        f"Number of nodes after re-ranking and filtering: {len(filtered_nodes)}"
+    )
+
+    return filtered_nodes
 
 
-def remove_duplicate_nodes(nodes):
+def get_synthesizer_service_context(trace):
     """
-    Removes duplicate nodes based on their id.
+    Gets the service context of the answer synthesizer, counting its LLM usage on a trace.
 
     Args:
-        nodes (List): A list of nodes.
+        trace (RAGTrace): The trace of the question.
 
     Returns:
-        List: A list of unique nodes.
+        ServiceContext: The synthesizer's service context.
+    """
+    return ServiceContext.from_defaults(
+        llm=get_callback_llm(llm4, trace.callback_manager),
+        callback_manager=trace.callback_manager,
+    )
+
+
+def pack_question_context(nodes, context_token_budget, trace):
     """
-    logger.info("Removing duplicate nodes")
-    logger.info(f"Node count before deduplication: {len(nodes)}")
-    nodes = list({node.id_: node for node in nodes}.values())
-    logger.info(f"Node count after deduplication: {len(nodes)}")
+    Packs the retrieved nodes of a question into the synthesizer's token budget.
+
+    Args:
+        nodes (List[NodeWithScore]): The retrieved nodes.
+        context_token_budget (Optional[int]): The maximum number of node tokens. None keeps every node.
+        trace (RAGTrace): The trace of the question.
 
+    Returns:
+        List[NodeWithScore]: The nodes sent to the synthesizer.
+    """
+    if context_token_budget is None:
+        return nodes
+    with trace_stage(trace, "pack_context", nodes_in=len(nodes)) as stage:
+        nodes = pack_context_nodes(nodes, context_token_budget)
+        stage["nodes_out"] = len(nodes)
     return nodes
 
 
-def rerank_nodes(nodes, query_str, query_context, context, top_n, score_threshold=5):
+def lookup_cached_answer(answer_cache_scope, index_version, question_embedding, trace):
     """
-    Reranks the nodes based on the provided context and thresholds.
+    Looks up the cached answer to a question similar enough to the given one.
 
     Args:
-        nodes (List): A list of nodes to rerank.
-        query_bundle: The query bundle for the reranker.
-        context: The service context for reranking.
-        top_n (int): The number of top nodes to keep after reranking.
-        score_threshold (int): The threshold for score filtering.
+        answer_cache_scope (str): The scope of the answer settings, see get_answer_cache_scope.
+        index_version (str): The version of the index, see get_index_version.
+        question_embedding (List[float]): The embedding of the question.
+        trace (RAGTrace): The trace of the question.
 
     Returns:
-        List: A list of reranked nodes.
+        Optional[dict]: The cached answer, or None on a miss.
     """
-    logger.info(
-        f"Reranking top {top_n} nodes with a score threshold of {score_threshold}"
+    with trace_stage(trace, "answer_cache") as stage:
+        cached_answer = answer_cache.lookup(
+            answer_cache_scope,
+            index_version,
+            question_embedding,
+            ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        )
+        stage["cache_hit"] = cached_answer is not None
+    if cached_answer is not None:
+        logger.info(
+            f"Answer cache hit (similarity {cached_answer['similarity']:.3f}) "
+            f"for question: {cached_answer['question']}"
+        )
+    return cached_answer
+
+
+def cache_answer(
+    answer_cache_scope, index_version, question, question_embedding, response, answer
+):
+    """
+    Stores a synthesized answer in the answer cache.
+
+    Args:
+        answer_cache_scope (str): The scope of the answer settings, see get_answer_cache_scope.
+        index_version (str): The version of the index, see get_index_version.
+        question (str): The question.
+        question_embedding (List[float]): The embedding of the question.
+        response (Union[Response, StreamingResponse]): The response, for its source nodes.
+        answer (str): The answer text.
+    """
+    answer_cache.put(
+        answer_cache_scope,
+        index_version,
+        question,
+        question_embedding,
+        answer,
+        [(node.node.node_id, node.score) for node in response.source_nodes],
     )
-    reranker = ModifiedLLMRerank(
-        choice_batch_size=5, top_n=top_n, service_context=context
+
+
+def get_informed_answer(
+    question,
+    docs_dir,
+    storage_dir,
+    domain=None,
+    domain_description=None,
+    vector_top_k=40,
+    reranker_top_n=20,
+    rerank=False,
+    fusion=False,
+    fusion_concurrency=4,
+    rerank_concurrency=4,
+    refresh=False,
+    context_token_budget=CONTEXT_TOKEN_BUDGET,
+    use_answer_cache=False,
+    stream=False,
+    hybrid=True,
+    candidate_top_n=None,
+    rerank_candidate_budget=None,
+    fusion_latency_budget=None,
+    trace_path=RAG_TRACE_PATH,
+):
+    """
+    Retrieves an informed answer to the given question using the specified document directories and settings.
+
+    Args:
+        question (str): The question to retrieve an answer for.
+        docs_dir (str): The directory containing the documents to query.
+        storage_dir (str): The directory for storing the index.
+        domain (str, optional): The specific domain of the question.
+        domain_description (str, optional): The description of the domain.
+        vector_top_k (int): The number of top vectors to retrieve.
+        reranker_top_n (int): The number of top nodes to keep after reranking.
+        rerank (bool): Flag to perform reranking.
+        fusion (bool): Flag to perform fusion.
+        fusion_concurrency (int): The maximum number of query variations to retrieve in parallel.
+        rerank_concurrency (int): The maximum number of rerank batches to run in parallel.
+        refresh (bool): Flag to incrementally update an existing index with changed documents before answering.
+        context_token_budget (Optional[int]): The maximum number of node tokens sent to the synthesizer. None sends every retrieved node.
+        use_answer_cache (bool): Flag to reuse the answer to an earlier question at least ANSWER_CACHE_SIMILARITY_THRESHOLD similar, asked with the same settings, while the index is unchanged. A question that differs from a cached one only in a detail can get the cached answer.
+        stream (bool): Flag to return a StreamingResponse that yields the answer tokens as they are synthesized.
+        hybrid (bool): Flag to merge BM25 lexical candidates with the vector candidates, when the index has a lexical index.
+        candidate_top_n (Optional[int]): The number of top fused candidates kept for reranking. Defaults to vector_top_k.
+        rerank_candidate_budget (Optional[int]): The number of candidates sent to the reranker. Defaults to twice reranker_top_n.
+        fusion_latency_budget (Optional[float]): The seconds fusion may add when the query variations are not cached. Fusion is skipped when it is expected to take longer, and the variations are cached in the background. None always waits for the variations.
+        trace_path (Optional[str]): The JSON lines file the trace of the question is appended to. Defaults to RAG_TRACE_PATH, None does not write it.
+
+    Returns:
+        Union[Response, StreamingResponse]: The synthesized response to the question. response.metadata["trace"] holds the trace of every pipeline stage; for a StreamingResponse it is completed once the stream is drained.
+    """
+    trace = RAGTrace(
+        question,
+        domain=domain,
+        vector_top_k=vector_top_k,
+        reranker_top_n=reranker_top_n,
+        rerank=rerank,
+        fusion=fusion,
+        hybrid=hybrid,
     )
-    if query_context:
-        query_str = (
-            "\nQUESTION_CONTEXT:\n---------------------\n"
-            f"{query_context}\n"
-            "---------------------\n"
-            f"QUESTION:\n---------------------\n"
-            f"{query_str}\n"
-            "---------------------\n"
-        )
 
-    query_bundle = QueryBundle(query_str)
-    reranked_nodes = reranker.postprocess_nodes(nodes, query_bundle)
+    response_synthesizer_context = get_synthesizer_service_context(trace)
 
-    logger.debug(f"RERANKED NODES:\n\n")
-    for node in reranked_nodes:
-        file_info = node.metadata.get("file_name") or node.metadata.get("file_path")
-        node_info = (
-            f"FILE INFO: {file_info}\n"
-            f"NODE ID: {node.id_}\n"
-            f"NODE Score: {node.score}\n"
-            f"NODE Length: {len(node.text)}\n"
-            f"NODE Text: {node.text}\n-----------\n"
+    storage_dir = f"{storage_dir}/{domain}" if domain else storage_dir
+    docs_dir = f"{docs_dir}/{domain}" if domain else docs_dir
+
+    with trace_stage(trace, "index_load") as stage:
+        index_cache_hits = index_cache.hits
+        index = prepare_index(docs_dir, storage_dir, refresh=refresh)
+        stage["cache_hit"] = index_cache.hits > index_cache_hits
+
+    # The question's embedding is computed once, for the lookup and for retrieval
+    question_embedding = None
+    if use_answer_cache:
+        question_embedding = embed_queries(index, [question], trace=trace)[0]
+        answer_cache_scope = get_answer_cache_scope(
+            storage_dir,
+            domain_description=domain_description,
+            vector_top_k=vector_top_k,
+            reranker_top_n=reranker_top_n,
+            rerank=rerank,
+            fusion=fusion,
+            context_token_budget=context_token_budget,
+            hybrid=hybrid,
+            candidate_top_n=candidate_top_n,
+            rerank_candidate_budget=rerank_candidate_budget,
         )
-        logger.debug(node_info)
+        index_version = get_index_version(storage_dir)
+        cached_answer = lookup_cached_answer(
+            answer_cache_scope, index_version, question_embedding, trace
+        )
+        if cached_answer is not None:
+            response = get_cached_response(index, cached_answer, stream=stream)
+            response.metadata["trace"] = trace.finish(trace_path)
+            return response
+
+    with trace_stage(trace, "lexical_index_load"):
+        lexical_index = load_lexical_index(storage_dir) if hybrid else None
+
+    nodes = call_with_retry(
+        lambda: get_retrieved_nodes(
+            question,
+            index,
+            vector_top_k=vector_top_k,
+            reranker_top_n=reranker_top_n,
+            rerank=rerank,
+            fusion=fusion,
+            query_context=domain_description,
+            fusion_concurrency=fusion_concurrency,
+            rerank_concurrency=rerank_concurrency,
+            lexical_index=lexical_index,
+            candidate_top_n=candidate_top_n,
+            rerank_candidate_budget=rerank_candidate_budget,
+            fusion_latency_budget=fusion_latency_budget,
+            trace=trace,
+            query_embedding=question_embedding,
+        ),
+        RETRIEVAL_MAX_RETRIES,
+        "retrieve nodes",
+        # This happens with the default re-ranker, but not the modified one due to the JSON response
+        retry_errors=IndexError,
+        exhausted_error=RuntimeError,
+    )
 
-    filtered_nodes = [node for node in reranked_nodes if node.score > score_threshold]
-    logger.info(
-        f"Number of nodes after re-ranking and filtering: {len(filtered_nodes)}"
+    nodes = pack_question_context(nodes, context_token_budget, trace)
+
+    logger.info(f"\nRAG Question:\n{question}")
+
+    response_synthesizer = get_qa_response_synthesizer(
+        domain, domain_description, response_synthesizer_context, streaming=stream
     )
 
-    return filtered_nodes
+    with trace_stage(trace, "synthesis", nodes_in=len(nodes)):
+        response = response_synthesizer.synthesize(question, nodes=nodes)
+    if stream and not isinstance(response, StreamingResponse):
+        # Without nodes to answer from, the synthesizer returns a plain response
+        response = StreamingResponse(
+            response_gen=iter([response.response or ""]),
+            source_nodes=response.source_nodes,
+            metadata=response.metadata,
+        )
+    if response.metadata is None:
+        response.metadata = {}
+    response.metadata["trace"] = trace.record
+
+    if stream:
+
+        def on_stream_complete(answer):
+            if use_answer_cache:
+                cache_answer(
+                    answer_cache_scope,
+                    index_version,
+                    question,
+                    question_embedding,
+                    response,
+                    answer,
+                )
+            trace.finish(trace_path)
+
+        # The answer is only complete, cached and traced once the caller drains the stream
+        response.response_gen = stream_and_collect(
+            trace_stream(trace, response.response_gen), on_complete=on_stream_complete
+        )
+    else:
+        if use_answer_cache:
+            cache_answer(
+                answer_cache_scope,
+                index_version,
+                question,
+                question_embedding,
+                response,
+                response.response,
+            )
+        trace.finish(trace_path)
 
+    return response
 
-def get_informed_answer(
+
+async def a_get_informed_answer(
     question,
     docs_dir,
     storage_dir,
@@ -496,9 +3267,25 @@ def get_informed_answer(
     reranker_top_n=20,
     rerank=False,
     fusion=False,
+    fusion_concurrency=4,
+    rerank_concurrency=4,
+    refresh=False,
+    context_token_budget=CONTEXT_TOKEN_BUDGET,
+    use_answer_cache=False,
+    hybrid=True,
+    candidate_top_n=None,
+    rerank_candidate_budget=None,
+    fusion_latency_budget=None,
+    trace_path=RAG_TRACE_PATH,
 ):
     """
-    Retrieves an informed answer to the given question using the specified document directories and settings.
+    Async counterpart of get_informed_answer, so one event loop can answer many questions concurrently.
+
+    Fusion, embedding, retrieval, reranking and synthesis await the async LLM and
+    embedding APIs. Creating, refreshing and loading the index run in a worker thread.
+
+    NOTE: Streaming is not supported, llama_index's async synthesizers cannot stream.
+    Use a_iter_informed_answer to stream an answer from async code.
 
     Args:
         question (str): The question to retrieve an answer for.
@@ -510,49 +3297,402 @@ def get_informed_answer(
         reranker_top_n (int): The number of top nodes to keep after reranking.
         rerank (bool): Flag to perform reranking.
         fusion (bool): Flag to perform fusion.
+        fusion_concurrency (int): The maximum number of query variations to retrieve concurrently.
+        rerank_concurrency (int): The maximum number of rerank batches to score concurrently.
+        refresh (bool): Flag to incrementally update an existing index with changed documents before answering.
+        context_token_budget (Optional[int]): The maximum number of node tokens sent to the synthesizer. None sends every retrieved node.
+        use_answer_cache (bool): Flag to reuse the answer to an earlier question at least ANSWER_CACHE_SIMILARITY_THRESHOLD similar, asked with the same settings, while the index is unchanged. A question that differs from a cached one only in a detail can get the cached answer.
+        hybrid (bool): Flag to merge BM25 lexical candidates with the vector candidates, when the index has a lexical index.
+        candidate_top_n (Optional[int]): The number of top fused candidates kept for reranking. Defaults to vector_top_k.
+        rerank_candidate_budget (Optional[int]): The number of candidates sent to the reranker. Defaults to twice reranker_top_n.
+        fusion_latency_budget (Optional[float]): The seconds fusion may add when the query variations are not cached. Fusion is skipped when it is expected to take longer, and the variations are cached in the background. None always waits for the variations.
+        trace_path (Optional[str]): The JSON lines file the trace of the question is appended to. Defaults to RAG_TRACE_PATH, None does not write it.
 
     Returns:
-        str: The synthesized response to the question.
+        Response: The synthesized response to the question, with the trace of every pipeline stage in response.metadata["trace"].
+    """
+    trace = RAGTrace(
+        question,
+        domain=domain,
+        vector_top_k=vector_top_k,
+        reranker_top_n=reranker_top_n,
+        rerank=rerank,
+        fusion=fusion,
+        hybrid=hybrid,
+    )
+
+    response_synthesizer_context = get_synthesizer_service_context(trace)
+
+    storage_dir = f"{storage_dir}/{domain}" if domain else storage_dir
+    docs_dir = f"{docs_dir}/{domain}" if domain else docs_dir
+
+    with trace_stage(trace, "index_load") as stage:
+        index_cache_hits = index_cache.hits
+        index = await asyncio.to_thread(prepare_index, docs_dir, storage_dir, refresh)
+        stage["cache_hit"] = index_cache.hits > index_cache_hits
+
+    # The question's embedding is computed once, for the lookup and for retrieval
+    question_embedding = None
+    if use_answer_cache:
+        question_embedding = (await a_embed_queries(index, [question], trace=trace))[0]
+        answer_cache_scope = get_answer_cache_scope(
+            storage_dir,
+            domain_description=domain_description,
+            vector_top_k=vector_top_k,
+            reranker_top_n=reranker_top_n,
+            rerank=rerank,
+            fusion=fusion,
+            context_token_budget=context_token_budget,
+            hybrid=hybrid,
+            candidate_top_n=candidate_top_n,
+            rerank_candidate_budget=rerank_candidate_budget,
+        )
+        index_version = get_index_version(storage_dir)
+        cached_answer = lookup_cached_answer(
+            answer_cache_scope, index_version, question_embedding, trace
+        )
+        if cached_answer is not None:
+            response = get_cached_response(index, cached_answer)
+            response.metadata["trace"] = trace.finish(trace_path)
+            return response
+
+    with trace_stage(trace, "lexical_index_load"):
+        lexical_index = (
+            await asyncio.to_thread(load_lexical_index, storage_dir) if hybrid else None
+        )
+
+    nodes = await a_call_with_retry(
+        lambda: a_get_retrieved_nodes(
+            question,
+            index,
+            vector_top_k=vector_top_k,
+            reranker_top_n=reranker_top_n,
+            rerank=rerank,
+            fusion=fusion,
+            query_context=domain_description,
+            fusion_concurrency=fusion_concurrency,
+            rerank_concurrency=rerank_concurrency,
+            lexical_index=lexical_index,
+            candidate_top_n=candidate_top_n,
+            rerank_candidate_budget=rerank_candidate_budget,
+            fusion_latency_budget=fusion_latency_budget,
+            trace=trace,
+            query_embedding=question_embedding,
+        ),
+        RETRIEVAL_MAX_RETRIES,
+        "retrieve nodes",
+        retry_errors=IndexError,
+        exhausted_error=RuntimeError,
+    )
+
+    nodes = pack_question_context(nodes, context_token_budget, trace)
+
+    logger.info(f"\nRAG Question:\n{question}")
+
+    response_synthesizer = get_qa_response_synthesizer(
+        domain, domain_description, response_synthesizer_context
+    )
+
+    with trace_stage(trace, "synthesis", nodes_in=len(nodes)):
+        response = await response_synthesizer.asynthesize(question, nodes=nodes)
+
+    if use_answer_cache:
+        cache_answer(
+            answer_cache_scope,
+            index_version,
+            question,
+            question_embedding,
+            response,
+            response.response,
+        )
+
+    if response.metadata is None:
+        response.metadata = {}
+    response.metadata["trace"] = trace.finish(trace_path)
+    return response
+
+
+def get_informed_answers(
+    questions,
+    docs_dir,
+    storage_dir,
+    domain=None,
+    domain_description=None,
+    vector_top_k=40,
+    reranker_top_n=20,
+    rerank=False,
+    fusion=False,
+    concurrency=4,
+    fusion_concurrency=4,
+    rerank_concurrency=4,
+    refresh=False,
+    context_token_budget=CONTEXT_TOKEN_BUDGET,
+    use_answer_cache=False,
+    hybrid=True,
+    candidate_top_n=None,
+    rerank_candidate_budget=None,
+    fusion_latency_budget=None,
+    trace_path=RAG_TRACE_PATH,
+):
     """
-    service_context3_synthesizer = ServiceContext.from_defaults(llm=llm3_synthesizer)
-    service_context4 = ServiceContext.from_defaults(llm=llm4)
-    response_synthesizer_context = service_context4
+    Retrieves informed answers to several questions about the same domain.
+
+    The index is prepared once, the questions and all their query variations are
+    embedded in shared batched requests, and the questions are then retrieved, reranked
+    and synthesized concurrently. Repeated questions are answered once. Rerank scores
+    are specific to a question, so candidates shared by different questions are scored
+    for each of them, but every question's scores go through the rerank cache.
+
+    Args:
+        questions (List[str]): The questions to retrieve answers for.
+        docs_dir (str): The directory containing the documents to query.
+        storage_dir (str): The directory for storing the index.
+        domain (str, optional): The specific domain of the questions.
+        domain_description (str, optional): The description of the domain.
+        vector_top_k (int): The number of top vectors to retrieve.
+        reranker_top_n (int): The number of top nodes to keep after reranking.
+        rerank (bool): Flag to perform reranking.
+        fusion (bool): Flag to perform fusion.
+        concurrency (int): The maximum number of questions to process in parallel.
+        fusion_concurrency (int): The maximum number of query variations of a question to retrieve in parallel.
+        rerank_concurrency (int): The maximum number of rerank batches of a question to run in parallel.
+        refresh (bool): Flag to incrementally update an existing index with changed documents before answering.
+        context_token_budget (Optional[int]): The maximum number of node tokens sent to the synthesizer. None sends every retrieved node.
+        use_answer_cache (bool): Flag to reuse the answer to an earlier question at least ANSWER_CACHE_SIMILARITY_THRESHOLD similar, asked with the same settings, while the index is unchanged. A question that differs from a cached one only in a detail can get the cached answer.
+        hybrid (bool): Flag to merge BM25 lexical candidates with the vector candidates, when the index has a lexical index.
+        candidate_top_n (Optional[int]): The number of top fused candidates kept for reranking. Defaults to vector_top_k.
+        rerank_candidate_budget (Optional[int]): The number of candidates sent to the reranker. Defaults to twice reranker_top_n.
+        fusion_latency_budget (Optional[float]): The seconds fusion may add when the query variations are not cached. Fusion is skipped when it is expected to take longer, and the variations are cached in the background. None always waits for the variations.
+        trace_path (Optional[str]): The JSON lines file the trace of every question is appended to. Defaults to RAG_TRACE_PATH, None does not write them.
 
+    Returns:
+        List[Response]: The synthesized response to each question, in the same order as the questions. Each has its trace in response.metadata["trace"], including the stages shared by the batch.
+    """
     storage_dir = f"{storage_dir}/{domain}" if domain else storage_dir
     docs_dir = f"{docs_dir}/{domain}" if domain else docs_dir
 
-    if not os.path.exists(storage_dir):
-        index = create_index(docs_dir=docs_dir, storage_dir=storage_dir)
+    unique_questions = list(dict.fromkeys(questions))
+    shared_trace = RAGTrace(None, domain=domain, num_questions=len(unique_questions))
+    traces = {
+        question: RAGTrace(
+            question,
+            domain=domain,
+            vector_top_k=vector_top_k,
+            reranker_top_n=reranker_top_n,
+            rerank=rerank,
+            fusion=fusion,
+            hybrid=hybrid,
+        )
+        for question in unique_questions
+    }
+    max_workers = max(1, min(concurrency, len(unique_questions)))
+    logger.info(
+        f"Answering {len(unique_questions)} unique questions with concurrency: {max_workers}"
+    )
+
+    with trace_stage(shared_trace, "index_load") as stage:
+        index_cache_hits = index_cache.hits
+        index = prepare_index(docs_dir, storage_dir, refresh=refresh)
+        stage["cache_hit"] = index_cache.hits > index_cache_hits
+    with trace_stage(shared_trace, "lexical_index_load"):
+        lexical_index = load_lexical_index(storage_dir) if hybrid else None
+
+    responses = {}
+    question_embeddings = {}
+    if use_answer_cache:
+        question_embeddings = dict(
+            zip(
+                unique_questions,
+                embed_queries(index, unique_questions, trace=shared_trace),
+            )
+        )
+        answer_cache_scope = get_answer_cache_scope(
+            storage_dir,
+            domain_description=domain_description,
+            vector_top_k=vector_top_k,
+            reranker_top_n=reranker_top_n,
+            rerank=rerank,
+            fusion=fusion,
+            context_token_budget=context_token_budget,
+            hybrid=hybrid,
+            candidate_top_n=candidate_top_n,
+            rerank_candidate_budget=rerank_candidate_budget,
+        )
+        index_version = get_index_version(storage_dir)
+        for question in unique_questions:
+            cached_answer = lookup_cached_answer(
+                answer_cache_scope,
+                index_version,
+                question_embeddings[question],
+                traces[question],
+            )
+            if cached_answer is not None:
+                responses[question] = get_cached_response(index, cached_answer)
+    pending_questions = [
+        question for question in unique_questions if question not in responses
+    ]
+
+    def get_question_variations(question):
+        if not fusion:
+            return [question]
+        query_variations = rag_fusion(
+            question,
+            domain_description,
+            trace=traces[question],
+            latency_budget=fusion_latency_budget,
+        )
+        query_variations.append(question)
+        return query_variations
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map keeps the results in the same order as the questions
+        variations = dict(
+            zip(
+                pending_questions,
+                executor.map(get_question_variations, pending_questions),
+            )
+        )
+
+    # Embed the variations of every question together, each distinct text once
+    unique_variations = list(
+        dict.fromkeys(
+            variation for question in pending_questions for variation in variations[question]
+        )
+    )
+    if unique_variations and index.vector_store.is_embedding_query:
+        # Questions embedded for the answer cache lookup are not embedded again
+        variation_embeddings = dict(question_embeddings)
+        missing_variations = get_missing_embeddings(unique_variations, variation_embeddings)
+        if missing_variations:
+            variation_embeddings.update(
+                zip(
+                    missing_variations,
+                    embed_queries(index, missing_variations, trace=shared_trace),
+                )
+            )
     else:
-        logger.info(f"Loading index at: {storage_dir}")
-        storage_context = StorageContext.from_defaults(persist_dir=storage_dir)
-        index = load_index_from_storage(storage_context)
-
-    nodes = None
-    max_retries = 3
-    attempt = 0
-    while nodes is None and attempt < max_retries:
-        try:
-            nodes = get_retrieved_nodes(
+        variation_embeddings = {variation: None for variation in unique_variations}
+
+    def answer_question(question):
+        trace = traces[question]
+        nodes = call_with_retry(
+            lambda: get_retrieved_nodes(
                 question,
                 index,
-                vector_top_k,
-                reranker_top_n,
-                rerank,
-                fusion,
-                domain_description,
+                vector_top_k=vector_top_k,
+                reranker_top_n=reranker_top_n,
+                rerank=rerank,
+                fusion=fusion,
+                query_context=domain_description,
+                fusion_concurrency=fusion_concurrency,
+                rerank_concurrency=rerank_concurrency,
+                lexical_index=lexical_index,
+                candidate_top_n=candidate_top_n,
+                rerank_candidate_budget=rerank_candidate_budget,
+                trace=trace,
+                query_variations=variations[question],
+                query_embeddings=[
+                    variation_embeddings[variation]
+                    for variation in variations[question]
+                ],
+            ),
+            RETRIEVAL_MAX_RETRIES,
+            "retrieve nodes",
+            retry_errors=IndexError,
+            exhausted_error=RuntimeError,
+        )
+
+        nodes = pack_question_context(nodes, context_token_budget, trace)
+
+        response_synthesizer = get_qa_response_synthesizer(
+            domain,
+            domain_description,
+            get_synthesizer_service_context(trace),
+        )
+        with trace_stage(trace, "synthesis", nodes_in=len(nodes)):
+            response = response_synthesizer.synthesize(question, nodes=nodes)
+
+        if use_answer_cache:
+            cache_answer(
+                answer_cache_scope,
+                index_version,
+                question,
+                question_embeddings[question],
+                response,
+                response.response,
             )
-        except (
-            IndexError
-        ) as e:  # This happens with the default re-ranker, but not the modified one due to the JSON response
-            logger.error(f"Index error: {e}")
-            attempt += 1
+        return response
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses.update(
+            zip(pending_questions, executor.map(answer_question, pending_questions))
+        )
 
-    if nodes is None:
-        raise RuntimeError("Failed to retrieve nodes after multiple attempts.")
+    for question in unique_questions:
+        response = responses[question]
+        traces[question].add_shared_stages(shared_trace)
+        if response.metadata is None:
+            response.metadata = {}
+        response.metadata["trace"] = traces[question].finish(trace_path)
 
-    logger.info(f"\nRAG Question:\n{question}")
+    return [responses[question] for question in questions]
+
+
+def prepare_index(docs_dir, storage_dir, refresh=False):
+    """
+    Gets the index of a document directory, creating it if it was never persisted.
+
+    Concurrent calls for the same storage directory in this process are serialized, so
+    questions asked at the same time about a new domain build its index once, and no
+    call loads an index while another one is still writing it.
+
+    Args:
+        docs_dir (str): The directory containing the documents.
+        storage_dir (str): The directory the index is persisted in.
+        refresh (bool): Flag to incrementally update an existing index with changed documents.
+
+    Returns:
+        VectorStoreIndex: The index.
+    """
+    with get_index_build_lock(storage_dir):
+        if not os.path.exists(storage_dir):
+            return create_index(docs_dir=docs_dir, storage_dir=storage_dir)
+        elif refresh:
+            return refresh_index(docs_dir=docs_dir, storage_dir=storage_dir)
+        return load_index(storage_dir)
+
+
+def get_index_build_lock(storage_dir):
+    """
+    Gets the lock that serializes building, refreshing and loading an index in prepare_index.
+
+    Args:
+        storage_dir (str): The directory the index is persisted in.
+
+    Returns:
+        threading.Lock: The lock of the storage directory.
+    """
+    with index_build_locks_lock:
+        return index_build_locks.setdefault(
+            os.path.abspath(storage_dir), threading.Lock()
+        )
+
+
+def get_qa_response_synthesizer(
+    domain, domain_description, service_context, streaming=False
+):
+    """
+    Creates the response synthesizer that answers questions from retrieved nodes.
+
+    Args:
+        domain (str, optional): The specific domain of the question.
+        domain_description (str, optional): The description of the domain.
+        service_context (ServiceContext): The service context of the synthesis LLM.
+        streaming (bool): Flag to stream the synthesized tokens.
 
+    Returns:
+        BaseSynthesizer: The response synthesizer.
+    """
     text_qa_template_str = (
         GENERAL_QA_PROMPT_TMPL_STR
         if domain is None or domain_description is None
@@ -563,11 +3703,153 @@ def get_informed_answer(
     )
     text_qa_template = PromptTemplate(text_qa_template_str)
 
-    response_synthesizer = get_response_synthesizer(
+    return get_response_synthesizer(
         response_mode=ResponseMode.COMPACT,
         text_qa_template=text_qa_template,
-        service_context=response_synthesizer_context,
+        service_context=service_context,
+        streaming=streaming,
     )
 
-    response = response_synthesizer.synthesize(question, nodes=nodes)
-    return response
+
+def iter_informed_answer(question, docs_dir, storage_dir, **kwargs):
+    """
+    Yields the tokens of an informed answer as they are synthesized.
+
+    Args:
+        question (str): The question to retrieve an answer for.
+        docs_dir (str): The directory containing the documents to query.
+        storage_dir (str): The directory for storing the index.
+        **kwargs: Additional arguments passed to get_informed_answer.
+
+    Yields:
+        str: The answer tokens.
+    """
+    response = get_informed_answer(
+        question, docs_dir=docs_dir, storage_dir=storage_dir, stream=True, **kwargs
+    )
+    yield from response.response_gen
+
+
+async def a_iter_informed_answer(question, docs_dir, storage_dir, **kwargs):
+    """
+    Async counterpart of iter_informed_answer.
+
+    llama_index's async synthesizers cannot stream, so the answer is streamed by
+    iter_informed_answer in a worker thread, and its tokens are handed to the event
+    loop as they arrive. The event loop is never blocked on the LLM.
+
+    NOTE: Closing the generator early does not stop the worker thread, it still drains the answer, so it is cached and traced.
+
+    Args:
+        question (str): The question to retrieve an answer for.
+        docs_dir (str): The directory containing the documents to query.
+        storage_dir (str): The directory for storing the index.
+        **kwargs: Additional arguments passed to get_informed_answer.
+
+    Yields:
+        str: The answer tokens.
+    """
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    end_of_answer = object()
+
+    def produce():
+        try:
+            for token in iter_informed_answer(
+                question, docs_dir=docs_dir, storage_dir=storage_dir, **kwargs
+            ):
+                loop.call_soon_threadsafe(tokens.put_nowait, token)
+        finally:
+            loop.call_soon_threadsafe(tokens.put_nowait, end_of_answer)
+
+    producer = asyncio.ensure_future(asyncio.to_thread(produce))
+    while True:
+        token = await tokens.get()
+        if token is end_of_answer:
+            break
+        yield token
+    # Raises the error of the worker thread, if any
+    await producer
+
+
+def stream_and_collect(token_gen, on_complete):
+    """
+    Passes through a token stream, and calls on_complete with the full text once it is drained.
+
+    Args:
+        token_gen (Generator[str, None, None]): The token stream.
+        on_complete (Callable[[str], None]): Called with the joined tokens.
+
+    Yields:
+        str: The tokens of token_gen.
+    """
+    tokens = []
+    for token in token_gen:
+        tokens.append(token)
+        yield token
+    on_complete("".join(tokens))
+
+
+def get_index_version(storage_dir):
+    """
+    Gets a version id of a persisted index that changes whenever it is rebuilt or refreshed.
+
+    Args:
+        storage_dir (str): The directory the index is persisted in.
+
+    Returns:
+        str: The hex sha256 digest of the storage signature.
+    """
+    signature = json.dumps(get_storage_signature(storage_dir))
+    return hashlib.sha256(signature.encode("utf-8")).hexdigest()
+
+
+def get_answer_cache_scope(storage_dir, **settings):
+    """
+    Builds the answer cache scope of an index and the settings that shape its answers.
+
+    Args:
+        storage_dir (str): The directory the index is persisted in.
+        **settings: The retrieval and synthesis settings.
+
+    Returns:
+        str: The hex sha256 digest of the scope.
+    """
+    scope = json.dumps(
+        {"storage_dir": os.path.abspath(storage_dir), **settings}, sort_keys=True
+    )
+    return hashlib.sha256(scope.encode("utf-8")).hexdigest()
+
+
+def get_cached_response(index, cached_answer, stream=False):
+    """
+    Rebuilds a response from an answer cache entry.
+
+    Args:
+        index (VectorStoreIndex): The index the answer was synthesized from.
+        cached_answer (dict): The entry returned by AnswerCache.lookup.
+        stream (bool): Flag to return a StreamingResponse that yields the whole answer at once.
+
+    Returns:
+        Union[Response, StreamingResponse]: The cached answer, with its source nodes loaded from the docstore.
+    """
+    source_nodes = []
+    for node_id, score in cached_answer["source_nodes"]:
+        node = index.docstore.get_node(node_id, raise_error=False)
+        if node is not None:
+            source_nodes.append(NodeWithScore(node=node, score=score))
+    # Same node metadata as a synthesized response, plus the details of the cache hit
+    metadata = {node.node.node_id: node.node.metadata for node in source_nodes}
+    metadata["answer_cache"] = {
+        "cached_question": cached_answer["question"],
+        "similarity": cached_answer["similarity"],
+    }
+    if stream:
+        return StreamingResponse(
+            response_gen=iter([cached_answer["answer"]]),
+            source_nodes=source_nodes,
+            metadata=metadata,
+        )
+    return Response(
+        response=cached_answer["answer"], source_nodes=source_nodes, metadata=metadata
+    )
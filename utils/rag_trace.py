@@ -0,0 +1,215 @@
+"""
+This file contains a per-question trace of the RAG pipeline stages (wall time, LLM usage, candidate counts and cache hits).
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Dict, Iterator, Optional
+
+from llama_index.callbacks import CallbackManager, TokenCountingHandler
+
+logger = logging.getLogger(__name__)
+
+
+class RAGTrace:
+    """
+    Records the stages of answering a single question.
+
+    Each stage is a dict with its name, wall time, LLM usage (calls, prompt and completion
+    tokens) and stage specific counts such as candidates in and out and cache hits. LLM
+    usage of llama_index LLMs is counted by a TokenCountingHandler, so every LLM whose
+    usage should be traced must use the trace's callback_manager. Stages are kept in the
+    order they started, and the whole trace is a plain JSON-serializable dict.
+    """
+
+    def __init__(self, question: Optional[str], **attributes: Any):
+        """
+        Initialize the RAGTrace.
+
+        Args:
+            question (Optional[str]): The question being answered, None for work shared by several questions.
+            **attributes: Additional JSON-serializable fields of the trace, e.g. the domain and retrieval settings.
+        """
+        self.token_counter = TokenCountingHandler()
+        self.callback_manager = CallbackManager([self.token_counter])
+        self.record: Dict[str, Any] = {
+            "trace_id": uuid.uuid4().hex,
+            "question": question,
+            "started_at": time.time(),
+            **attributes,
+            "stages": [],
+        }
+        self._start = perf_counter()
+        self._lock = threading.Lock()
+
+    def get_llm_usage(self) -> Dict[str, int]:
+        """
+        Returns the LLM usage counted through the callback manager so far.
+
+        Returns:
+            Dict[str, int]: The "llm_calls", "prompt_tokens" and "completion_tokens" counts.
+        """
+        events = list(self.token_counter.llm_token_counts)
+        return {
+            "llm_calls": len(events),
+            "prompt_tokens": sum(event.prompt_token_count for event in events),
+            "completion_tokens": sum(event.completion_token_count for event in events),
+        }
+
+    @contextmanager
+    def stage(self, name: str, count_llm_usage: bool = True, **counts: Any):
+        """
+        Records a stage around the wrapped block.
+
+        Args:
+            name (str): The stage name.
+            count_llm_usage (bool): Flag to attribute the LLM usage counted while the stage runs to it. Disable it for stages that run concurrently with LLM calls of other stages.
+            **counts: Initial stage specific counts.
+
+        Yields:
+            Dict[str, Any]: The stage record, to add counts to.
+        """
+        stage = {
+            "stage": name,
+            "wall_time": 0.0,
+            "llm_calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            **counts,
+        }
+        with self._lock:
+            self.record["stages"].append(stage)
+        usage_before = self.get_llm_usage() if count_llm_usage else None
+        start = perf_counter()
+        try:
+            yield stage
+        finally:
+            stage["wall_time"] = perf_counter() - start
+            if usage_before is not None:
+                for key, value in self.get_llm_usage().items():
+                    stage[key] += value - usage_before[key]
+
+    def add_shared_stages(self, shared_trace: "RAGTrace") -> None:
+        """
+        Adds the stages of a trace of work shared by several questions, e.g. a batched embedding request.
+
+        The stages are listed after this trace's own stages and are marked with the
+        number of questions that share them. Their LLM usage is not added to this trace's
+        totals.
+
+        Args:
+            shared_trace (RAGTrace): The trace of the shared work.
+        """
+        num_questions = shared_trace.record.get("num_questions", 1)
+        with self._lock:
+            for stage in shared_trace.record["stages"]:
+                self.record["stages"].append({**stage, "shared_by": num_questions})
+
+    def finish(self, trace_path: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Adds the totals to the trace, and appends it to a JSON lines file.
+
+        Args:
+            trace_path (Optional[str]): The JSON lines file to append the trace to. None only finishes the trace.
+
+        Returns:
+            Dict[str, Any]: The trace record.
+        """
+        self.record["wall_time"] = perf_counter() - self._start
+        for key in ("llm_calls", "prompt_tokens", "completion_tokens"):
+            self.record[key] = sum(
+                stage[key] for stage in self.record["stages"] if "shared_by" not in stage
+            )
+        logger.info(
+            f"RAG trace: {self.record['wall_time']:.2f}s, "
+            f"{self.record['llm_calls']} LLM calls, "
+            f"{self.record['prompt_tokens']} prompt / "
+            f"{self.record['completion_tokens']} completion tokens"
+        )
+        if trace_path:
+            write_trace(self.record, trace_path)
+        return self.record
+
+
+def trace_stage(trace: Optional[RAGTrace], name: str, **kwargs: Any):
+    """
+    Records a stage on a trace, or only runs the wrapped block when there is no trace.
+
+    Args:
+        trace (Optional[RAGTrace]): The trace, or None.
+        name (str): The stage name.
+        **kwargs: Arguments passed to RAGTrace.stage.
+
+    Returns:
+        ContextManager[Dict[str, Any]]: Yields the stage record (a throwaway dict without a trace).
+    """
+    if trace is None:
+        return _untraced_stage()
+    return trace.stage(name, **kwargs)
+
+
+@contextmanager
+def _untraced_stage():
+    yield {}
+
+
+def record_llm_call(stage: Dict[str, Any], prompt_tokens: int, completion_tokens: int) -> None:
+    """
+    Adds an LLM call made outside llama_index (e.g. through autogen) to a stage.
+
+    Args:
+        stage (Dict[str, Any]): The stage record.
+        prompt_tokens (int): The prompt token count.
+        completion_tokens (int): The completion token count.
+    """
+    stage["llm_calls"] = stage.get("llm_calls", 0) + 1
+    stage["prompt_tokens"] = stage.get("prompt_tokens", 0) + prompt_tokens
+    stage["completion_tokens"] = stage.get("completion_tokens", 0) + completion_tokens
+
+
+def trace_stream(
+    trace: Optional[RAGTrace], token_gen: Iterator[str], name: str = "synthesis_stream"
+) -> Iterator[str]:
+    """
+    Passes through a token stream, recording the time it takes to drain as a stage.
+
+    Args:
+        trace (Optional[RAGTrace]): The trace, or None.
+        token_gen (Iterator[str]): The token stream.
+        name (str): The stage name.
+
+    Yields:
+        str: The tokens of token_gen.
+    """
+    with trace_stage(trace, name) as stage:
+        num_chunks = 0
+        for token in token_gen:
+            num_chunks += 1
+            yield token
+        stage["chunks_out"] = num_chunks
+
+
+_write_lock = threading.Lock()
+
+
+def write_trace(record: Dict[str, Any], trace_path: str) -> None:
+    """
+    Appends a trace record to a JSON lines file.
+
+    Args:
+        record (Dict[str, Any]): The trace record.
+        trace_path (str): The JSON lines file.
+    """
+    directory = os.path.dirname(trace_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    line = json.dumps(record, default=str)
+    with _write_lock:
+        with open(trace_path, "a") as f:
+            f.write(line + "\n")
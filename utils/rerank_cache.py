@@ -0,0 +1,195 @@
+"""
+This file contains a persistent (SQLite) cache of LLM rerank scores.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (scorer_hash, query_hash, context_hash, node_id, content_hash)
+RerankCacheKey = Tuple[str, str, str, str, str]
+
+# Keys looked up per query, SQLite allows at most 999 bound variables per statement
+LOOKUP_BATCH_SIZE = 150
+
+
+def normalize_query(query):
+    """
+    Normalizes query text so trivially different phrasings share cache entries.
+
+    Lowercases the query, collapses whitespace, and strips trailing punctuation.
+
+    Args:
+        query (str): The query text.
+
+    Returns:
+        str: The normalized query text.
+    """
+    query = re.sub(r"\s+", " ", query or "").strip().lower()
+    return query.rstrip("?!. ")
+
+
+def hash_text(text):
+    """
+    Hashes text for use in cache keys.
+
+    Args:
+        text (str): The text to hash. None hashes the same as an empty string.
+
+    Returns:
+        str: The hex sha256 digest of the text.
+    """
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+class RerankCache:
+    """
+    A disk-backed cache of rerank scores keyed by scorer (rerank model and prompt),
+    normalized query text, query context hash, node id, and node content hash.
+
+    A cached score of None records that the reranker judged the node not relevant, so
+    the node is dropped on a cache hit just like it would be on a fresh rerank.
+    Entries expire after ttl seconds, and a changed model or prompt never reads the
+    scores of the previous one.
+    """
+
+    def __init__(self, db_path: str, ttl: float):
+        """
+        Initialize the RerankCache. The database is opened on first use.
+
+        Args:
+            db_path (str): The path of the SQLite database file.
+            ttl (float): The number of seconds cached scores stay valid.
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            # The reranker writes from worker threads, all access goes through _lock
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rerank_scores ("
+                "scorer_hash TEXT NOT NULL, "
+                "query_hash TEXT NOT NULL, "
+                "context_hash TEXT NOT NULL, "
+                "node_id TEXT NOT NULL, "
+                "content_hash TEXT NOT NULL, "
+                "score REAL, "
+                "created_at REAL NOT NULL, "
+                "PRIMARY KEY (scorer_hash, query_hash, context_hash, node_id, content_hash))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_scorer_hash(model_name, prompt_template):
+        """
+        Hashes the rerank model and prompt that produce the scores.
+
+        Args:
+            model_name (str): The name of the rerank LLM.
+            prompt_template (str): The rerank prompt template.
+
+        Returns:
+            str: The scorer hash, the first component of the cache keys.
+        """
+        return hash_text(f"{model_name}\n{prompt_template}")
+
+    @staticmethod
+    def make_key(
+        scorer_hash, query, query_context, node_id, node_content
+    ) -> RerankCacheKey:
+        """
+        Builds the cache key for a (query, node) pair.
+
+        Args:
+            scorer_hash (str): The hash of the rerank model and prompt, see make_scorer_hash.
+            query (str): The query text, without the query context.
+            query_context (Optional[str]): The query context, if any.
+            node_id (str): The id of the node.
+            node_content (str): The node content as sent to the reranker.
+
+        Returns:
+            RerankCacheKey: The cache key.
+        """
+        return (
+            scorer_hash,
+            hash_text(normalize_query(query)),
+            hash_text(query_context),
+            node_id,
+            hash_text(node_content),
+        )
+
+    def get_many(
+        self, keys: Iterable[RerankCacheKey]
+    ) -> Dict[RerankCacheKey, Optional[float]]:
+        """
+        Looks up cached scores that have not expired.
+
+        Args:
+            keys (Iterable[RerankCacheKey]): The keys to look up.
+
+        Returns:
+            Dict[RerankCacheKey, Optional[float]]: The cached scores of the keys that were found.
+        """
+        keys = list(keys)
+        min_created_at = time.time() - self.ttl
+        results = {}
+        with self._lock:
+            conn = self._connect()
+            for idx in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                batch = keys[idx : idx + LOOKUP_BATCH_SIZE]
+                rows = conn.execute(
+                    "SELECT scorer_hash, query_hash, context_hash, node_id, "
+                    "content_hash, score FROM rerank_scores "
+                    "WHERE (scorer_hash, query_hash, context_hash, node_id, content_hash) "
+                    f"IN (VALUES {', '.join(['(?, ?, ?, ?, ?)'] * len(batch))}) "
+                    "AND created_at >= ?",
+                    [value for key in batch for value in key] + [min_created_at],
+                ).fetchall()
+                for row in rows:
+                    results[tuple(row[:5])] = row[5]
+        return results
+
+    def set_many(self, scores: Dict[RerankCacheKey, Optional[float]]) -> None:
+        """
+        Stores rerank scores, and removes expired scores.
+
+        Args:
+            scores (Dict[RerankCacheKey, Optional[float]]): The scores to store, None for nodes judged not relevant.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM rerank_scores WHERE created_at < ?", (now - self.ttl,)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO rerank_scores "
+                "(scorer_hash, query_hash, context_hash, node_id, content_hash, "
+                "score, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*key, score, now) for key, score in scores.items()],
+            )
+            conn.commit()
+
+    def clear(self) -> None:
+        """
+        Removes every cached score.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM rerank_scores")
+            conn.commit()
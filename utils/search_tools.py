@@ -32,6 +32,8 @@ from utils.misc import (
     light_gpt4_wrapper_autogen,
 )
 
+from utils.domain_catalog import get_domain_catalog
+
 # from utils.fetch_docs import fetch_and_save
 
 logger = logging.getLogger(__name__)
@@ -329,6 +331,16 @@ def find_relevant_github_repo(domain_description, rating_threshold=6, search_eng
             top_repo["name"] = repo_desc["name"]
             break
 
+    # The domain name is the repo name without the org/user
+    domain_name = top_repo["name"].split("/")[1]
+
+    # Reuse the domain if the repo was already downloaded
+    domain_catalog = get_domain_catalog(DOMAIN_KNOWLEDGE_DOCS_DIR)
+    existing_domain = domain_catalog.get_domain(domain_name)
+    if existing_domain is not None:
+        logger.info(f"Repo already downloaded: {domain_name}")
+        return domain_name, existing_domain["domain_description"]
+
     str_desc += f"URL: {top_repo['url']}\n\Title:\n{top_repo['title']}\nDescription:\n{'*' * 50}\n{top_repo['readme']}\n{'*' * 50}\n\n"
 
     summarize_repo_message = RESEARCH_AGENT_SUMMARIZE_REPO_PROMPT.format(
@@ -340,8 +352,6 @@ def find_relevant_github_repo(domain_description, rating_threshold=6, search_eng
     logger.info(f"Repo summary:\n{repo_summary_response}\n")
 
     # Create the domain directory under the "DOMAIN_KNOWLEDGE_DIR"
-    # The domain name is the repo name without the org/user
-    domain_name = top_repo["name"].split("/")[1]
     domain_dir = os.path.join(DOMAIN_KNOWLEDGE_DOCS_DIR, domain_name)
 
     logger.info(f"Downloading repo: {top_repo['name']}...")
@@ -355,6 +365,7 @@ def find_relevant_github_repo(domain_description, rating_threshold=6, search_eng
     # Save the domain description to the domain directory
     with open(os.path.join(domain_dir, "domain_description.txt"), "w") as f:
         f.write(domain_description)
+    domain_catalog.update_domain(domain_name)
 
     return domain_name, domain_description
 
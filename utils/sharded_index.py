@@ -0,0 +1,544 @@
+"""
+This file contains a sharded index format for very large domains: one persisted llama_index index per shard, loaded lazily and queried in parallel.
+"""
+
+import os
+import json
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from llama_index.core import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle
+
+logger = logging.getLogger(__name__)
+
+SHARDED_INDEX_MANIFEST_FNAME = "sharded_index.json"
+SHARDS_DIRNAME = "shards"
+# Sorted node ids and the shard holding each, to route node lookups to one shard
+NODE_SHARDS_FNAME = "node_shards.npz"
+
+# The maximum number of shards loaded or searched at the same time
+SHARD_LOAD_WORKERS = int(os.getenv("RAG_SHARD_LOAD_WORKERS", 4))
+SHARD_QUERY_CONCURRENCY = int(os.getenv("RAG_SHARD_QUERY_CONCURRENCY", 4))
+
+
+def get_top_level_dir(docs_dir, path):
+    """
+    Gets the first path component of a file below a document directory.
+
+    Args:
+        docs_dir (str): The directory containing the documents.
+        path (str): The file path.
+
+    Returns:
+        str: The top-level subdirectory of the file, or "" for files directly in docs_dir.
+    """
+    parts = os.path.relpath(path, docs_dir).split(os.sep)
+    return parts[0] if len(parts) > 1 else ""
+
+
+def plan_shards(docs_dir, input_files, max_shard_bytes):
+    """
+    Splits the files of a document directory into shards of at most max_shard_bytes.
+
+    Files are grouped by top-level subdirectory, and whole subdirectories are packed
+    into shards in name order. A subdirectory larger than max_shard_bytes gets shards of
+    its own, split in file order.
+
+    Args:
+        docs_dir (str): The directory containing the documents.
+        input_files (List[str]): The file paths to index.
+        max_shard_bytes (int): The maximum total file size of a shard.
+
+    Returns:
+        List[Dict[str, Any]]: The "files" and top-level "dirs" of each shard.
+    """
+    groups = OrderedDict()
+    for path in input_files:
+        groups.setdefault(get_top_level_dir(docs_dir, path), []).append(path)
+
+    shards = []
+    current = {"files": [], "dirs": []}
+    current_bytes = 0
+
+    def flush():
+        nonlocal current, current_bytes
+        if current["files"]:
+            shards.append(current)
+        current = {"files": [], "dirs": []}
+        current_bytes = 0
+
+    for top_level_dir in sorted(groups):
+        files = groups[top_level_dir]
+        sizes = [os.path.getsize(path) for path in files]
+        group_bytes = sum(sizes)
+        if current_bytes + group_bytes > max_shard_bytes:
+            flush()
+        if group_bytes <= max_shard_bytes:
+            current["files"].extend(files)
+            current["dirs"].append(top_level_dir)
+            current_bytes += group_bytes
+            continue
+        for path, size in zip(files, sizes):
+            if current_bytes + size > max_shard_bytes:
+                flush()
+            current["files"].append(path)
+            if top_level_dir not in current["dirs"]:
+                current["dirs"].append(top_level_dir)
+            current_bytes += size
+        flush()
+    flush()
+    return shards
+
+
+class ShardedIndex:
+    """
+    A domain index split into shards, each persisted as a regular index in its own directory.
+
+    Shards are loaded on first use, not when the sharded index is opened, and vector
+    searches run on every shard in parallel with the per-shard top-k merged by score.
+    The docstore and vector_store attributes route node lookups to the shard holding
+    the node, so the sharded index can be used wherever the RAG tools use an index.
+    A node id to shard table persisted next to the manifest sends each lookup to its
+    shard directly, so a lookup loads at most one shard.
+    """
+
+    def __init__(
+        self,
+        storage_dir: str,
+        shard_names: List[str],
+        load_shard: Callable[[str], Any],
+        service_context: Any,
+        shards: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        Initialize the ShardedIndex.
+
+        Args:
+            storage_dir (str): The directory the sharded index is persisted in.
+            shard_names (List[str]): The names of the shards.
+            load_shard (Callable[[str], Any]): Loads a shard index from its storage directory.
+            service_context (ServiceContext): The service context shared by every shard.
+            shards (Optional[Dict[str, Any]]): Shards that are already loaded, by name.
+        """
+        self.storage_dir = storage_dir
+        self.shard_names = list(shard_names)
+        self.service_context = service_context
+        self._load_shard = load_shard
+        self._shards: Dict[str, Any] = dict(shards or {})
+        self._shard_locks = {name: threading.Lock() for name in self.shard_names}
+        self._node_shards = None
+        self._node_shards_lock = threading.Lock()
+        self.docstore = ShardedDocStore(self)
+        self.vector_store = ShardedVectorStore(self)
+
+    @staticmethod
+    def get_manifest_path(storage_dir: str) -> str:
+        """
+        Returns the path of the manifest of a sharded index.
+
+        Args:
+            storage_dir (str): The directory the sharded index is persisted in.
+
+        Returns:
+            str: The manifest path.
+        """
+        return os.path.join(storage_dir, SHARDED_INDEX_MANIFEST_FNAME)
+
+    @staticmethod
+    def get_shard_dir(storage_dir: str, shard_name: str) -> str:
+        """
+        Returns the storage directory of a shard.
+
+        Args:
+            storage_dir (str): The directory the sharded index is persisted in.
+            shard_name (str): The shard name.
+
+        Returns:
+            str: The shard's storage directory.
+        """
+        return os.path.join(storage_dir, SHARDS_DIRNAME, shard_name)
+
+    @classmethod
+    def exists(cls, storage_dir: str) -> bool:
+        """
+        Checks whether a sharded index is persisted in a storage directory.
+
+        Args:
+            storage_dir (str): The directory to check.
+
+        Returns:
+            bool: True if the sharded index manifest exists.
+        """
+        return os.path.exists(cls.get_manifest_path(storage_dir))
+
+    @classmethod
+    def load_manifest(cls, storage_dir: str) -> Dict[str, Any]:
+        """
+        Loads the manifest of a sharded index.
+
+        Args:
+            storage_dir (str): The directory the sharded index is persisted in.
+
+        Returns:
+            Dict[str, Any]: The manifest, with the "name" and top-level "dirs" of each shard under "shards".
+        """
+        with open(cls.get_manifest_path(storage_dir), "r") as f:
+            return json.load(f)
+
+    @classmethod
+    def save_manifest(cls, storage_dir: str, manifest: Dict[str, Any]) -> None:
+        """
+        Saves the manifest of a sharded index.
+
+        Args:
+            storage_dir (str): The directory the sharded index is persisted in.
+            manifest (Dict[str, Any]): The manifest.
+        """
+        os.makedirs(storage_dir, exist_ok=True)
+        path = cls.get_manifest_path(storage_dir)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def save_node_shards(cls, storage_dir: str, node_shards: Dict[str, List[str]]) -> None:
+        """
+        Saves the table of the shard holding each node of a sharded index.
+
+        Args:
+            storage_dir (str): The directory the sharded index is persisted in.
+            node_shards (Dict[str, List[str]]): The node ids of each shard, by shard name.
+        """
+        shard_names = list(node_shards)
+        node_ids = []
+        shard_ids = []
+        for shard_id, shard_name in enumerate(shard_names):
+            node_ids.extend(node_id.encode("utf-8") for node_id in node_shards[shard_name])
+            shard_ids.extend([shard_id] * len(node_shards[shard_name]))
+        node_ids = np.array(node_ids, dtype=bytes)
+        order = np.argsort(node_ids, kind="stable")
+
+        os.makedirs(storage_dir, exist_ok=True)
+        path = os.path.join(storage_dir, NODE_SHARDS_FNAME)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            shard_names=np.array(shard_names, dtype=str),
+            node_ids=node_ids[order],
+            shard_ids=np.array(shard_ids, dtype=np.int32)[order],
+        )
+        os.replace(tmp_path, path)
+
+    def _get_node_shards(self) -> Optional[Dict[str, np.ndarray]]:
+        with self._node_shards_lock:
+            if self._node_shards is None:
+                path = os.path.join(self.storage_dir, NODE_SHARDS_FNAME)
+                # Sharded indexes persisted without the table search every shard
+                if not os.path.exists(path):
+                    return None
+                with np.load(path) as node_shards:
+                    self._node_shards = {key: node_shards[key] for key in node_shards.files}
+            return self._node_shards
+
+    def get_node_shard(self, node_id: str) -> Optional[str]:
+        """
+        Returns the name of the shard holding a node, from the persisted node table.
+
+        Args:
+            node_id (str): The node id.
+
+        Returns:
+            Optional[str]: The shard name, or None if no shard has the node.
+
+        Raises:
+            KeyError: If the sharded index was persisted without a node table.
+        """
+        node_shards = self._get_node_shards()
+        if node_shards is None:
+            raise KeyError(NODE_SHARDS_FNAME)
+        key = node_id.encode("utf-8")
+        node_ids = node_shards["node_ids"]
+        row = int(np.searchsorted(node_ids, key))
+        if row == len(node_ids) or node_ids[row] != key:
+            return None
+        return str(node_shards["shard_names"][node_shards["shard_ids"][row]])
+
+    @classmethod
+    def load(
+        cls, storage_dir: str, load_shard: Callable[[str], Any], service_context: Any
+    ) -> "ShardedIndex":
+        """
+        Opens a persisted sharded index. Only the manifest is read, shards load on first use.
+
+        Args:
+            storage_dir (str): The directory the sharded index is persisted in.
+            load_shard (Callable[[str], Any]): Loads a shard index from its storage directory.
+            service_context (ServiceContext): The service context shared by every shard.
+
+        Returns:
+            ShardedIndex: The sharded index.
+        """
+        manifest = cls.load_manifest(storage_dir)
+        shard_names = [shard["name"] for shard in manifest["shards"]]
+        logger.info(f"Opened sharded index with {len(shard_names)} shards: {storage_dir}")
+        return cls(storage_dir, shard_names, load_shard, service_context)
+
+    def get_shard(self, shard_name: str) -> Any:
+        """
+        Returns a shard, loading it if it is not loaded yet.
+
+        Args:
+            shard_name (str): The shard name.
+
+        Returns:
+            VectorStoreIndex: The shard index.
+        """
+        with self._shard_locks[shard_name]:
+            shard = self._shards.get(shard_name)
+            if shard is None:
+                logger.info(f"Loading shard: {shard_name}")
+                shard = self._load_shard(self.get_shard_dir(self.storage_dir, shard_name))
+                self._shards[shard_name] = shard
+        return shard
+
+    def get_shards(self) -> List[Any]:
+        """
+        Returns every shard, loading the missing ones in parallel.
+
+        Returns:
+            List[VectorStoreIndex]: The shard indexes, in shard order.
+        """
+        missing = [name for name in self.shard_names if name not in self._shards]
+        if len(missing) > 1:
+            with ThreadPoolExecutor(
+                max_workers=max(1, min(SHARD_LOAD_WORKERS, len(missing)))
+            ) as executor:
+                list(executor.map(self.get_shard, missing))
+        return [self.get_shard(name) for name in self.shard_names]
+
+    def get_loaded_shards(self) -> Dict[str, Any]:
+        """
+        Returns the shards that are loaded.
+
+        Returns:
+            Dict[str, VectorStoreIndex]: The loaded shard indexes, by name.
+        """
+        return {name: self._shards[name] for name in self.shard_names if name in self._shards}
+
+    def find_in_shards(
+        self, lookup: Callable[[Any], Any], node_id: Optional[str] = None
+    ) -> Any:
+        """
+        Calls lookup on the shard holding a node, or else on each shard until it returns a result, trying the loaded shards first.
+
+        Args:
+            lookup (Callable[[Any], Any]): Called with a shard index, returns None if the shard does not have the result.
+            node_id (Optional[str]): The node the lookup is for, routed with the persisted node table when there is one.
+
+        Returns:
+            Any: The first result, or None if no shard has it.
+        """
+        if node_id is not None:
+            try:
+                shard_name = self.get_node_shard(node_id)
+            except KeyError:
+                pass
+            else:
+                if shard_name is None or shard_name not in self._shard_locks:
+                    return None
+                return lookup(self.get_shard(shard_name))
+
+        loaded = [name for name in self.shard_names if name in self._shards]
+        unloaded = [name for name in self.shard_names if name not in self._shards]
+        for name in loaded + unloaded:
+            result = lookup(self.get_shard(name))
+            if result is not None:
+                return result
+        return None
+
+
+class ShardedDocStore:
+    """
+    The node lookups of a docstore, routed to the shards of a sharded index.
+    """
+
+    def __init__(self, sharded_index: ShardedIndex):
+        self.sharded_index = sharded_index
+
+    def get_node(self, node_id: str, raise_error: bool = True) -> Any:
+        """
+        Looks up a node in the shards.
+
+        Args:
+            node_id (str): The node id.
+            raise_error (bool): Flag to raise a ValueError if no shard has the node.
+
+        Returns:
+            Optional[BaseNode]: The node, or None if it was not found and raise_error is False.
+        """
+        # docstore.get_node raises for missing ids even without raise_error
+        node = self.sharded_index.find_in_shards(
+            lambda shard: shard.docstore.get_document(node_id, raise_error=False),
+            node_id=node_id,
+        )
+        if node is None and raise_error:
+            raise ValueError(f"node_id {node_id} not found.")
+        return node
+
+    @property
+    def docs(self) -> Dict[str, Any]:
+        """The nodes of every shard, by node id. Loads every shard."""
+        docs = {}
+        for shard in self.sharded_index.get_shards():
+            docs.update(shard.docstore.docs)
+        return docs
+
+
+class ShardedVectorStore:
+    """
+    The embedding lookups of a vector store, routed to the shards of a sharded index.
+    """
+
+    stores_text: bool = False
+    is_embedding_query: bool = True
+
+    def __init__(self, sharded_index: ShardedIndex):
+        self.sharded_index = sharded_index
+
+    def get(self, text_id: str) -> List[float]:
+        """Get embedding."""
+
+        def lookup(shard):
+            try:
+                return shard.vector_store.get(text_id)
+            except (KeyError, NotImplementedError, ValueError):
+                return None
+
+        embedding = self.sharded_index.find_in_shards(lookup, node_id=text_id)
+        if embedding is None:
+            raise KeyError(text_id)
+        return embedding
+
+
+class ShardedRetriever(BaseRetriever):
+    """
+    Retrieves the top-k nodes of a sharded index by searching every shard in parallel and merging the results by score.
+    """
+
+    def __init__(
+        self,
+        sharded_index: ShardedIndex,
+        similarity_top_k: int,
+        get_shard_retriever: Callable[[Any, int], BaseRetriever],
+        max_concurrency: int = SHARD_QUERY_CONCURRENCY,
+    ):
+        """
+        Initialize the ShardedRetriever.
+
+        Args:
+            sharded_index (ShardedIndex): The sharded index.
+            similarity_top_k (int): The number of nodes to retrieve.
+            get_shard_retriever (Callable[[Any, int], BaseRetriever]): Creates the retriever of a shard for a top-k.
+            max_concurrency (int): The maximum number of shards to search at the same time.
+        """
+        super().__init__()
+        self.sharded_index = sharded_index
+        self.similarity_top_k = similarity_top_k
+        self.get_shard_retriever = get_shard_retriever
+        self.max_concurrency = max_concurrency
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        shard_names = self.sharded_index.shard_names
+
+        # Each shard is loaded by the worker that searches it
+        def retrieve_shard(shard_name):
+            shard = self.sharded_index.get_shard(shard_name)
+            return self.get_shard_retriever(shard, self.similarity_top_k).retrieve(
+                query_bundle
+            )
+
+        max_workers = max(1, min(self.max_concurrency, len(shard_names)))
+        if max_workers == 1:
+            shard_results = [retrieve_shard(name) for name in shard_names]
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                shard_results = list(executor.map(retrieve_shard, shard_names))
+        return merge_shard_results(shard_results, self.similarity_top_k)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+
+        async def retrieve_shard(shard_name):
+            async with semaphore:
+                # Loading a shard is blocking file IO, keep it off the event loop
+                shard = await asyncio.to_thread(self.sharded_index.get_shard, shard_name)
+                return await self.get_shard_retriever(
+                    shard, self.similarity_top_k
+                ).aretrieve(query_bundle)
+
+        shard_results = await asyncio.gather(
+            *(retrieve_shard(name) for name in self.sharded_index.shard_names)
+        )
+        return merge_shard_results(shard_results, self.similarity_top_k)
+
+
+def merge_shard_results(shard_results, top_k):
+    """
+    Merges the ranked results of several shards into one top-k.
+
+    Args:
+        shard_results (List[List[NodeWithScore]]): The results of each shard.
+        top_k (int): The number of nodes to keep.
+
+    Returns:
+        List[NodeWithScore]: The nodes with the highest scores, best first.
+    """
+    nodes = [node for results in shard_results for node in results]
+    nodes.sort(key=lambda node: node.score if node.score is not None else float("-inf"), reverse=True)
+    return nodes[:top_k]
+
+
+class ShardedLexicalIndex:
+    """
+    The BM25 lexical indexes of the shards of a sharded index, loaded lazily and queried together.
+
+    NOTE: Each shard has its own term statistics, so scores of different shards are
+    only approximately comparable.
+    """
+
+    def __init__(self, shard_dirs: List[str], load_lexical_index: Callable[[str], Any]):
+        """
+        Initialize the ShardedLexicalIndex.
+
+        Args:
+            shard_dirs (List[str]): The storage directory of each shard.
+            load_lexical_index (Callable[[str], Any]): Loads the lexical index of a shard, returns None for shards without one.
+        """
+        self.shard_dirs = shard_dirs
+        self.load_lexical_index = load_lexical_index
+
+    def query(self, query_str: str, top_k: int) -> List[Any]:
+        """
+        Finds the documents with the highest BM25 score for a query in every shard.
+
+        Args:
+            query_str (str): The query text.
+            top_k (int): The maximum number of documents to return.
+
+        Returns:
+            List[Tuple[str, float]]: The (node_id, score) of the top documents, best first.
+        """
+        results = []
+        for shard_dir in self.shard_dirs:
+            lexical_index = self.load_lexical_index(shard_dir)
+            if lexical_index is not None:
+                results.extend(lexical_index.query(query_str, top_k))
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results[:top_k]
@@ -0,0 +1,591 @@
+"""
+This file contains custom vector store backends for llama_index indexes.
+"""
+
+import os
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import fsspec
+import numpy as np
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.simple import DEFAULT_VECTOR_STORE, NAMESPACE_SEP
+from llama_index.vector_stores.types import (
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+logger = logging.getLogger(__name__)
+
+NUMPY_VECTOR_STORE_FNAME = "vector_store"
+EMBEDDINGS_SUFFIX = ".embeddings.npy"
+IDS_SUFFIX = ".ids.npy"
+REF_DOC_IDS_SUFFIX = ".ref_doc_ids.npy"
+NORMS_SUFFIX = ".norms.npy"
+SCALES_SUFFIX = ".scales.npy"
+
+# Reduced-precision copies of the embeddings used for the similarity scan
+QUANTIZED_EMBEDDINGS_SUFFIXES = {
+    "float16": ".embeddings.float16.npy",
+    "int8": ".embeddings.int8.npy",
+}
+
+# Quantized searches rescore this many times top_k candidates with the exact embeddings
+RESCORE_FACTOR = int(os.getenv("RAG_RESCORE_FACTOR", 4))
+
+# Rows of quantized embeddings converted to float32 at a time during a scan
+SCAN_CHUNK_ROWS = 16384
+
+
+def _save_npy(path: str, array: np.ndarray) -> None:
+    # Write to a temporary file and swap it in, so readers that have the old file
+    # memory-mapped keep a consistent view
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def quantize_embeddings(
+    embeddings: np.ndarray, quantization: str
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Converts embeddings to a reduced-precision copy.
+
+    int8 quantization is symmetric per vector: each row is scaled so its largest
+    absolute component maps to 127, and the scale is kept to undo it.
+
+    Args:
+        embeddings (np.ndarray): A (num_nodes, dim) float32 array.
+        quantization (str): "float16" or "int8".
+
+    Returns:
+        Tuple[np.ndarray, Optional[np.ndarray]]: The quantized embeddings, and the per-row scales for int8 (None for float16).
+    """
+    if quantization == "float16":
+        return np.asarray(embeddings, dtype=np.float16), None
+    if quantization != "int8":
+        raise ValueError(f"Unknown embedding quantization: {quantization}")
+
+    quantized = np.zeros(embeddings.shape, dtype=np.int8)
+    scales = np.ones(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), SCAN_CHUNK_ROWS):
+        chunk = np.asarray(embeddings[start : start + SCAN_CHUNK_ROWS], dtype=np.float32)
+        max_abs = np.abs(chunk).max(axis=1) if chunk.size else np.zeros(len(chunk))
+        chunk_scales = np.where(max_abs == 0, 1.0, max_abs / 127).astype(np.float32)
+        quantized[start : start + len(chunk)] = np.clip(
+            np.rint(chunk / chunk_scales[:, None]), -127, 127
+        )
+        scales[start : start + len(chunk)] = chunk_scales
+    return quantized, scales
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    A vector store that keeps embeddings in a contiguous float32 .npy file.
+
+    The embeddings file is opened with mmap, so loading an index only reads the file
+    header, and the OS pages embeddings in as they are scanned. Node ids and ref doc ids
+    live in side arrays. Top-k is a single matrix product plus argpartition, and
+    search_many scores several queries (e.g. the variations of a RAG fusion query)
+    with one pass over the embeddings.
+
+    With quantization ("float16" or "int8", with per-vector scales), a reduced-precision
+    copy of the embeddings is persisted next to the float32 file and scanned instead,
+    which reads 2-4x less memory. The best rescore_factor * top_k candidates of the scan
+    are then rescored exactly from the memory-mapped float32 rows, so the returned
+    similarities are exact and only the candidates' float32 rows are paged in.
+
+    Quantization trades disk for memory: the float32 file is always kept, since any row
+    can be a rescoring candidate, so a quantized store takes 1.25x (int8) or 1.5x
+    (float16) the disk space of a float32 store while its scans read 2-4x less memory.
+
+    NOTE: Only the default (dense similarity) query mode is supported, without metadata
+    filters. add and delete are meant for index builds and refreshes, not for use while
+    the store is being queried from other threads.
+    """
+
+    stores_text: bool = False
+
+    def __init__(
+        self,
+        embeddings: Optional[np.ndarray] = None,
+        ids: Optional[np.ndarray] = None,
+        ref_doc_ids: Optional[np.ndarray] = None,
+        norms: Optional[np.ndarray] = None,
+        quantization: Optional[str] = None,
+        quantized: Optional[np.ndarray] = None,
+        scales: Optional[np.ndarray] = None,
+        rescore_factor: int = RESCORE_FACTOR,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Initialize the NumpyVectorStore.
+
+        Args:
+            embeddings (Optional[np.ndarray]): A (num_nodes, dim) float32 array, possibly memory-mapped.
+            ids (Optional[np.ndarray]): The node id of each embedding row.
+            ref_doc_ids (Optional[np.ndarray]): The ref doc id of each embedding row.
+            norms (Optional[np.ndarray]): The precomputed L2 norm of each embedding row.
+            quantization (Optional[str]): "float16" or "int8" to scan reduced-precision embeddings. None or "float32" scans the float32 embeddings.
+            quantized (Optional[np.ndarray]): The precomputed quantized embeddings, possibly memory-mapped.
+            scales (Optional[np.ndarray]): The precomputed per-row scales of int8 embeddings.
+            rescore_factor (int): The number of candidates per result rescored with the float32 embeddings.
+        """
+        if quantization == "float32":
+            quantization = None
+        if quantization is not None and quantization not in QUANTIZED_EMBEDDINGS_SUFFIXES:
+            raise ValueError(f"Unknown embedding quantization: {quantization}")
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self._pending: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._set_arrays(
+            embeddings if embeddings is not None else np.zeros((0, 0), np.float32),
+            ids if ids is not None else np.array([], dtype=str),
+            ref_doc_ids if ref_doc_ids is not None else np.array([], dtype=str),
+            norms,
+            quantized,
+            scales,
+        )
+
+    @staticmethod
+    def _compute_norms(embeddings: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(embeddings, axis=1) if len(embeddings) else np.zeros(0)
+        # Avoid dividing by zero for empty vectors, their similarity is then 0
+        return np.where(norms == 0, 1.0, norms).astype(np.float32)
+
+    @staticmethod
+    def get_persist_base(persist_dir: str, namespace: Optional[str] = None) -> str:
+        """
+        Returns the path prefix of the persisted files of a store.
+
+        Args:
+            persist_dir (str): The directory the store is persisted in.
+            namespace (Optional[str]): The vector store namespace. Defaults to "default".
+
+        Returns:
+            str: The path prefix.
+        """
+        namespace = namespace or DEFAULT_VECTOR_STORE
+        return os.path.join(
+            persist_dir, f"{namespace}{NAMESPACE_SEP}{NUMPY_VECTOR_STORE_FNAME}"
+        )
+
+    @classmethod
+    def exists(cls, persist_dir: str, namespace: Optional[str] = None) -> bool:
+        """
+        Checks whether a NumpyVectorStore is persisted in a directory.
+
+        Args:
+            persist_dir (str): The directory to check.
+            namespace (Optional[str]): The vector store namespace. Defaults to "default".
+
+        Returns:
+            bool: True if the store's embeddings file exists.
+        """
+        return os.path.exists(
+            cls.get_persist_base(persist_dir, namespace) + EMBEDDINGS_SUFFIX
+        )
+
+    @classmethod
+    def get_persisted_quantization(
+        cls, persist_dir: str, namespace: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Returns the quantization of the reduced-precision embeddings persisted with a store.
+
+        Args:
+            persist_dir (str): The directory the store is persisted in.
+            namespace (Optional[str]): The vector store namespace. Defaults to "default".
+
+        Returns:
+            Optional[str]: "float16" or "int8", or None if only float32 embeddings are persisted.
+        """
+        base = cls.get_persist_base(persist_dir, namespace)
+        for quantization, suffix in QUANTIZED_EMBEDDINGS_SUFFIXES.items():
+            if os.path.exists(base + suffix):
+                return quantization
+        return None
+
+    @classmethod
+    def from_persist_dir(
+        cls,
+        persist_dir: str,
+        namespace: Optional[str] = None,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+        quantization: Optional[str] = None,
+    ) -> "NumpyVectorStore":
+        """
+        Opens a persisted store, memory-mapping its embeddings.
+
+        Args:
+            persist_dir (str): The directory the store is persisted in.
+            namespace (Optional[str]): The vector store namespace. Defaults to "default".
+            fs (Optional[fsspec.AbstractFileSystem]): Unused, only local files are supported.
+            quantization (Optional[str]): "float32", "float16" or "int8". Defaults to the quantization the store was persisted with. A quantization that was not persisted is computed on load.
+
+        Returns:
+            NumpyVectorStore: The opened store.
+        """
+        base = cls.get_persist_base(persist_dir, namespace)
+        logger.debug(f"Loading {__name__} from {base}.")
+        embeddings = np.load(base + EMBEDDINGS_SUFFIX, mmap_mode="r")
+        ids = np.load(base + IDS_SUFFIX)
+        ref_doc_ids = np.load(base + REF_DOC_IDS_SUFFIX)
+        # Norms are persisted so opening the store does not scan every embedding
+        norms = np.load(base + NORMS_SUFFIX)
+
+        if quantization is None:
+            quantization = cls.get_persisted_quantization(persist_dir, namespace)
+        quantized = scales = None
+        quantized_path = base + QUANTIZED_EMBEDDINGS_SUFFIXES.get(quantization, "")
+        if quantization in QUANTIZED_EMBEDDINGS_SUFFIXES and os.path.exists(
+            quantized_path
+        ):
+            quantized = np.load(quantized_path, mmap_mode="r")
+            if quantization == "int8":
+                scales = np.load(base + SCALES_SUFFIX)
+        return cls(
+            embeddings=embeddings,
+            ids=ids,
+            ref_doc_ids=ref_doc_ids,
+            norms=norms,
+            quantization=quantization,
+            quantized=quantized,
+            scales=scales,
+        )
+
+    @property
+    def client(self) -> None:
+        """Get client."""
+        return
+
+    def get(self, text_id: str) -> List[float]:
+        """Get embedding."""
+        self._flush_pending()
+        return self._embeddings[self._id_to_row[text_id]].tolist()
+
+    def add(
+        self,
+        nodes: List[BaseNode],
+        **add_kwargs: Any,
+    ) -> List[str]:
+        """Add nodes to index."""
+        if not nodes:
+            return []
+        # Index builds add many small batches, they are only concatenated once the
+        # store is read, instead of copying every embedding on each add
+        self._pending.append(
+            (
+                np.asarray([node.get_embedding() for node in nodes], dtype=np.float32),
+                np.array([node.node_id for node in nodes]),
+                np.array([node.ref_doc_id or "None" for node in nodes]),
+            )
+        )
+        return [node.node_id for node in nodes]
+
+    def _flush_pending(self) -> None:
+        if not self._pending:
+            return
+        chunks = [(self._embeddings, self._ids, self._ref_doc_ids)] + self._pending
+        if not len(self._embeddings):
+            chunks = chunks[1:]
+        self._pending = []
+        self._set_arrays(
+            np.concatenate([embeddings for embeddings, _, _ in chunks]),
+            np.concatenate([ids for _, ids, _ in chunks]),
+            np.concatenate([ref_doc_ids for _, _, ref_doc_ids in chunks]),
+        )
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Delete nodes using with ref_doc_id.
+
+        Args:
+            ref_doc_id (str): The doc_id of the document to delete.
+
+        """
+        self._flush_pending()
+        keep = self._ref_doc_ids != ref_doc_id
+        if keep.all():
+            return
+        self._set_arrays(
+            np.asarray(self._embeddings[keep]),
+            self._ids[keep],
+            self._ref_doc_ids[keep],
+            self._norms[keep],
+            None if self._quantized is None else np.asarray(self._quantized[keep]),
+            None if self._scales is None else self._scales[keep],
+        )
+
+    def _set_arrays(
+        self,
+        embeddings: np.ndarray,
+        ids: np.ndarray,
+        ref_doc_ids: np.ndarray,
+        norms: Optional[np.ndarray] = None,
+        quantized: Optional[np.ndarray] = None,
+        scales: Optional[np.ndarray] = None,
+    ) -> None:
+        self._embeddings = embeddings
+        self._ids = ids
+        self._ref_doc_ids = ref_doc_ids
+        self._norms = norms if norms is not None else self._compute_norms(embeddings)
+        if self.quantization is not None and quantized is None:
+            quantized, scales = quantize_embeddings(embeddings, self.quantization)
+        self._quantized = quantized
+        self._scales = scales
+        self._id_to_row = {node_id: row for row, node_id in enumerate(ids)}
+
+    def query(
+        self,
+        query: VectorStoreQuery,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        """Get nodes for response."""
+        if query.filters is not None:
+            raise ValueError("NumpyVectorStore does not support metadata filters.")
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+
+        self._flush_pending()
+        rows = None
+        if query.node_ids is not None:
+            rows = np.flatnonzero(np.isin(self._ids, query.node_ids))
+        top_rows, similarities = self.search(
+            query.query_embedding, query.similarity_top_k, rows=rows
+        )
+        return VectorStoreQueryResult(
+            similarities=similarities.tolist(), ids=self._ids[top_rows].tolist()
+        )
+
+    def get_node_ids(self) -> List[str]:
+        """
+        Returns the node id of every embedding.
+
+        Returns:
+            List[str]: The node ids, in row order.
+        """
+        self._flush_pending()
+        return self._ids.tolist()
+
+    def get_memory_usage(self) -> Dict[str, int]:
+        """
+        Returns the size of the embeddings a similarity scan reads, of the float32 embeddings, and of all the persisted embeddings.
+
+        Returns:
+            Dict[str, int]: The "scan_bytes" (the quantized embeddings and scales, or the float32 embeddings if the store is not quantized), "float32_bytes", and "disk_bytes" (the float32 embeddings plus the quantized embeddings and scales).
+        """
+        self._flush_pending()
+        scan_bytes = self._embeddings.nbytes
+        if self._quantized is not None:
+            scales_bytes = 0 if self._scales is None else self._scales.nbytes
+            scan_bytes = self._quantized.nbytes + scales_bytes
+        disk_bytes = self._embeddings.nbytes
+        if self._quantized is not None:
+            disk_bytes += scan_bytes
+        return {
+            "scan_bytes": int(scan_bytes),
+            "float32_bytes": int(self._embeddings.nbytes),
+            "disk_bytes": int(disk_bytes),
+        }
+
+    def search(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        rows: Optional[np.ndarray] = None,
+        exact: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the rows with the highest cosine similarity to a query embedding.
+
+        Args:
+            query_embedding (List[float]): The query embedding.
+            top_k (int): The number of rows to return.
+            rows (Optional[np.ndarray]): The rows to search, defaults to every row.
+            exact (bool): Flag to scan the float32 embeddings even if the store is quantized.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The top rows, best first, and their exact similarities.
+        """
+        return self.search_many([query_embedding], top_k, rows=rows, exact=exact)[0]
+
+    def search_many(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int,
+        rows: Optional[np.ndarray] = None,
+        exact: bool = False,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Finds the rows with the highest cosine similarity to each of several query embeddings.
+
+        The queries are scored together, so the embeddings are scanned once for all of
+        them, and a quantized store reads the float32 rows of the union of the queries'
+        rescoring candidates once.
+
+        Args:
+            query_embeddings (List[List[float]]): The query embeddings.
+            top_k (int): The number of rows to return per query.
+            rows (Optional[np.ndarray]): The rows to search, defaults to every row.
+            exact (bool): Flag to scan the float32 embeddings even if the store is quantized.
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: The top rows of each query, best first, and their exact similarities.
+        """
+        self._flush_pending()
+        if rows is None:
+            rows = np.arange(len(self._ids))
+        top_k = min(top_k, len(rows))
+        if top_k <= 0:
+            empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+            return [empty for _ in query_embeddings]
+
+        # (num_queries, dim), similarities below are (num_rows, num_queries)
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        query_norms = np.linalg.norm(queries, axis=1)
+        query_norms[query_norms == 0] = 1.0
+        all_rows = len(rows) == len(self._ids)
+
+        if self.quantization is None or exact:
+            embeddings = self._embeddings if all_rows else self._embeddings[rows]
+            similarities = (embeddings @ queries.T) / (
+                self._norms[rows][:, None] * query_norms
+            )
+            results = []
+            for column in similarities.T:
+                top = np.argpartition(-column, top_k - 1)[:top_k]
+                top = top[np.argsort(-column[top], kind="stable")]
+                results.append((rows[top], column[top]))
+            return results
+
+        quantized = self._quantized if all_rows else self._quantized[rows]
+        scales = None
+        if self._scales is not None:
+            scales = self._scales if all_rows else self._scales[rows]
+        approximate = self._scan_quantized(quantized, scales, queries) / (
+            self._norms[rows][:, None] * query_norms
+        )
+
+        # Rescore the best candidates of the approximate scan with the exact embeddings
+        num_candidates = min(len(rows), top_k * max(1, self.rescore_factor))
+        candidates = np.argpartition(-approximate, num_candidates - 1, axis=0)[
+            :num_candidates
+        ]
+        # Sorted rows read the memory-mapped float32 file front to back, and rows that
+        # are candidates of several queries are read once
+        union_rows = np.unique(rows[candidates])
+        union_similarities = (
+            np.asarray(self._embeddings[union_rows], dtype=np.float32) @ queries.T
+        ) / (self._norms[union_rows][:, None] * query_norms)
+        results = []
+        for query_idx in range(len(queries)):
+            candidate_rows = np.sort(rows[candidates[:, query_idx]])
+            similarities = union_similarities[
+                np.searchsorted(union_rows, candidate_rows), query_idx
+            ]
+            top = np.argsort(-similarities, kind="stable")[:top_k]
+            results.append((candidate_rows[top], similarities[top]))
+        return results
+
+    def get_row_ids(self, rows: np.ndarray) -> List[str]:
+        """
+        Returns the node ids of embedding rows, e.g. of the rows returned by search.
+
+        Args:
+            rows (np.ndarray): The rows.
+
+        Returns:
+            List[str]: The node id of each row.
+        """
+        return self._ids[rows].tolist()
+
+    @staticmethod
+    def _scan_quantized(
+        quantized: np.ndarray, scales: Optional[np.ndarray], queries: np.ndarray
+    ) -> np.ndarray:
+        # Convert a chunk at a time, so the scan never holds a float32 copy of every row
+        dot_products = np.empty((len(quantized), len(queries)), dtype=np.float32)
+        for start in range(0, len(quantized), SCAN_CHUNK_ROWS):
+            chunk = np.asarray(quantized[start : start + SCAN_CHUNK_ROWS], dtype=np.float32)
+            dot_products[start : start + len(chunk)] = chunk @ queries.T
+        if scales is not None:
+            dot_products *= scales[:, None]
+        return dot_products
+
+    def persist(
+        self,
+        persist_path: str,
+        fs: Optional[fsspec.AbstractFileSystem] = None,
+    ) -> None:
+        """
+        Persist the store next to the other storage context files.
+
+        The StorageContext passes the path of the JSON file a SimpleVectorStore would
+        write; the .npy files use the same name without the extension. A quantized store
+        persists its quantized embeddings in addition to, not instead of, the float32
+        embeddings that rescoring reads.
+        """
+        dirpath = os.path.dirname(persist_path)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+
+        base = os.path.splitext(persist_path)[0]
+        self._flush_pending()
+        embeddings = self._embeddings
+        if embeddings.ndim != 2 or not len(embeddings):
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        _save_npy(base + EMBEDDINGS_SUFFIX, np.ascontiguousarray(embeddings, np.float32))
+        _save_npy(base + IDS_SUFFIX, self._ids.astype(str))
+        _save_npy(base + REF_DOC_IDS_SUFFIX, self._ref_doc_ids.astype(str))
+        _save_npy(base + NORMS_SUFFIX, np.asarray(self._norms, dtype=np.float32))
+
+        # Only keep the reduced-precision files of the current quantization
+        for quantization, suffix in QUANTIZED_EMBEDDINGS_SUFFIXES.items():
+            if quantization == self.quantization:
+                _save_npy(base + suffix, np.ascontiguousarray(self._quantized))
+            elif os.path.exists(base + suffix):
+                os.remove(base + suffix)
+        if self._scales is not None:
+            _save_npy(base + SCALES_SUFFIX, np.asarray(self._scales, dtype=np.float32))
+        elif os.path.exists(base + SCALES_SUFFIX):
+            os.remove(base + SCALES_SUFFIX)
+
+
+def measure_recall(
+    stores: List[NumpyVectorStore], query_embeddings: List[List[float]], top_k: int
+) -> float:
+    """
+    Measures the recall of the (possibly quantized) search of vector stores against an exact float32 search.
+
+    The results of several stores (e.g. the shards of an index) are merged by
+    similarity, as they are when they are searched together.
+
+    Args:
+        stores (List[NumpyVectorStore]): The vector stores.
+        query_embeddings (List[List[float]]): The query embeddings.
+        top_k (int): The number of results per query.
+
+    Returns:
+        float: The mean fraction of the exact top_k ids that the store search returns.
+    """
+
+    def search_ids(query_embedding, exact):
+        results = []
+        for store in stores:
+            rows, similarities = store.search(query_embedding, top_k, exact=exact)
+            results.extend(zip(similarities.tolist(), store.get_row_ids(rows)))
+        results.sort(key=lambda result: result[0], reverse=True)
+        return {node_id for _, node_id in results[:top_k]}
+
+    recalls = []
+    for query_embedding in query_embeddings:
+        exact_ids = search_ids(query_embedding, exact=True)
+        if exact_ids:
+            recalls.append(
+                len(exact_ids & search_ids(query_embedding, exact=False)) / len(exact_ids)
+            )
+    return float(np.mean(recalls)) if recalls else 1.0